@@ -0,0 +1,214 @@
+import os
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+from metrics import LLM_ADMISSION_REJECTED
+from cluster import WORKER_PROCESSES, is_worker_process
+
+logger = logging.getLogger(__name__)
+
+# 优先级：私聊和@回复 > 自动回复 > 预生成的diss回复
+HIGH = 0
+NORMAL = 1
+LOW = 2
+PRIORITY_NAMES = {HIGH: "high", NORMAL: "normal", LOW: "low"}
+
+# 每个优先级必须留给更高优先级的容量比例（并发数和全局令牌都按这个比例预留）
+DEFAULT_RESERVES = {HIGH: 0.0, NORMAL: 0.25, LOW: 0.5}
+
+
+class AdmissionRejected(Exception):
+    """大模型调用被准入控制拒绝"""
+
+    def __init__(self, reason, priority):
+        super().__init__(f"大模型调用被拒绝（{PRIORITY_NAMES.get(priority, priority)}）: {reason}")
+        self.reason = reason
+        self.priority = priority
+
+
+class TokenBucket:
+    """令牌桶，rate为每秒补充的令牌数，capacity为桶容量（允许的突发量）"""
+
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate, capacity, now=None):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated = time.monotonic() if now is None else now
+
+    def _refill(self, now):
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, now, reserve=0.0):
+        """取出一个令牌后仍剩余reserve个令牌需要等待的秒数，0表示可以立即取出"""
+        self._refill(now)
+        missing = 1 + reserve - self.tokens
+        if missing <= 0:
+            return 0.0
+        if self.rate <= 0 or 1 + reserve > self.capacity:
+            return float("inf")
+        return missing / self.rate
+
+    def consume(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class AdmissionController:
+    """
+    大模型调用的准入控制
+
+    - 全局令牌桶和每个会话的令牌桶限制调用速率，另外限制同时进行的调用数
+    - 低优先级的请求只能使用扣除预留部分后的容量，容量不足时立即拒绝，由调用方降级处理
+    - 最高优先级的请求在容量不足时最多等待max_wait秒
+    - rate设为0表示不限制该项速率
+    """
+
+    def __init__(self, max_concurrent=8, global_rate=5.0, global_burst=20, session_rate=0.2, session_burst=5,
+                 max_wait=10.0, reserves=None, max_tracked_sessions=10000):
+        self.max_concurrent = max_concurrent
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.session_rate = session_rate
+        self.session_burst = session_burst
+        self.max_wait = max_wait
+        self.reserves = reserves or DEFAULT_RESERVES
+        self.max_tracked_sessions = max_tracked_sessions
+
+        self._cond = threading.Condition()
+        self._global = TokenBucket(global_rate, global_burst) if global_rate > 0 else None
+        self._sessions = OrderedDict()
+        self._in_flight = 0
+        self._waiting = 0
+        self._admitted = {name: 0 for name in PRIORITY_NAMES.values()}
+        self._rejected = {}
+        # try_acquire被拒绝的次数（额外的并发，不计入_rejected）
+        self._rejected_extra = 0
+
+    def _session_bucket(self, session_id, now):
+        if self.session_rate <= 0 or session_id is None:
+            return None
+        bucket = self._sessions.get(session_id)
+        if bucket is None:
+            bucket = self._sessions[session_id] = TokenBucket(self.session_rate, self.session_burst, now)
+            # 超出上限时丢弃最久未使用的会话，被丢弃的会话下次重新获得满桶
+            while len(self._sessions) > self.max_tracked_sessions:
+                self._sessions.popitem(last=False)
+        else:
+            self._sessions.move_to_end(session_id)
+        return bucket
+
+    def _check(self, session_bucket, priority, now):
+        """返回(拒绝原因, 需要等待的秒数)，可以立即放行时返回(None, 0)"""
+        reserve = self.reserves.get(priority, 0.0)
+        if self._in_flight >= max(1, self.max_concurrent * (1 - reserve)):
+            return "concurrency", None
+        if self._global is not None:
+            wait = self._global.wait_time(now, self.global_burst * reserve)
+            if wait > 0:
+                return "global_rate", wait
+        if session_bucket is not None:
+            wait = session_bucket.wait_time(now)
+            if wait > 0:
+                return "session_rate", wait
+        return None, 0.0
+
+    def _reject(self, reason, priority):
+        name = PRIORITY_NAMES.get(priority, str(priority))
+        key = f"{name}:{reason}"
+        self._rejected[key] = self._rejected.get(key, 0) + 1
+        LLM_ADMISSION_REJECTED.inc(priority=name, reason=reason)
+        raise AdmissionRejected(reason, priority)
+
+    @contextmanager
+    def admit(self, session_id=None, priority=HIGH):
+        """
+        申请一次大模型调用，with块结束时释放并发名额
+
+        Raises:
+            AdmissionRejected: 容量不足（最高优先级为等待超时）
+        """
+        deadline = time.monotonic() + (self.max_wait if priority == HIGH else 0.0)
+        with self._cond:
+            session_bucket = self._session_bucket(session_id, time.monotonic())
+            waited = False
+            try:
+                while True:
+                    now = time.monotonic()
+                    reason, wait = self._check(session_bucket, priority, now)
+                    if reason is None:
+                        break
+                    remaining = deadline - now
+                    if remaining <= 0 or (wait is not None and wait > remaining):
+                        self._reject(reason, priority)
+                    if not waited:
+                        waited = True
+                        self._waiting += 1
+                    # 并发已满时等待释放通知，速率不足时等待令牌补充
+                    self._cond.wait(remaining if wait is None else wait)
+            finally:
+                if waited:
+                    self._waiting -= 1
+            if self._global is not None:
+                self._global.consume(now)
+            if session_bucket is not None:
+                session_bucket.consume(now)
+            self._in_flight += 1
+            self._admitted[PRIORITY_NAMES.get(priority, str(priority))] += 1
+        try:
+            yield
+        finally:
+            self.release()
+
+    def try_acquire(self, priority=LOW):
+        """
+        不等待、不消耗令牌地占用一个并发名额（例如对冲请求），之后调用release()归还
+
+        Returns:
+            bool: 是否占用成功
+        """
+        with self._cond:
+            reserve = self.reserves.get(priority, 0.0)
+            if self._in_flight >= max(1, self.max_concurrent * (1 - reserve)):
+                self._rejected_extra += 1
+                return False
+            self._in_flight += 1
+            return True
+
+    def release(self):
+        with self._cond:
+            self._in_flight -= 1
+            self._cond.notify_all()
+
+    def get_stats(self):
+        with self._cond:
+            return {
+                "in_flight": self._in_flight,
+                "waiting": self._waiting,
+                "max_concurrent": self.max_concurrent,
+                "global_tokens": round(self._global.tokens, 2) if self._global is not None else None,
+                "tracked_sessions": len(self._sessions),
+                "admitted": dict(self._admitted),
+                "rejected": dict(self._rejected),
+                "extra_rejected": self._rejected_extra,
+            }
+
+
+# 多进程模式下每个工作进程各自做准入控制，全局的并发数和速率按进程数平分，所有进程加起来不超过配置值；
+# 会话固定由一个进程处理，每个会话的速率不需要平分
+_shares = WORKER_PROCESSES if is_worker_process() else 1
+
+# 创建全局实例
+admission_controller = AdmissionController(
+    max_concurrent=max(1, int(os.getenv("LLM_MAX_CONCURRENCY", "8")) // _shares),
+    global_rate=float(os.getenv("LLM_GLOBAL_RATE", "5")) / _shares,
+    global_burst=max(1, int(os.getenv("LLM_GLOBAL_BURST", "20")) // _shares),
+    session_rate=float(os.getenv("LLM_SESSION_RATE", "0.2")),
+    session_burst=int(os.getenv("LLM_SESSION_BURST", "5")),
+    max_wait=float(os.getenv("LLM_ADMISSION_WAIT", "10"))
+)
@@ -1,8 +1,25 @@
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, Response, jsonify, request
 import logging
-from llm_client import llm_client, cache_history, cache_time
+from llm_client import llm_client
+from session_store import session_store
 from utils import get_session_style, set_session_style, get_available_styles, get_all_session_styles
+from dispatcher import message_dispatcher, QueueFullError
+from cluster import worker_cluster
+from persistence import state_db
+from reply_pool import diss_pool
+from reply_cache import reply_cache
+from summarizer import history_summarizer
+from moderation import moderation_queue
+from flood_guard import flood_guard
+from readiness import readiness
+from session_admin import apply_batch, export_state, import_state, InvalidImportData, BATCH_MAX_SESSIONS
+from prompts import prompt_registry
+from admission import admission_controller
+from napcat_client import napcat_ws
+from metrics import registry as metrics_registry
 import time
+import json
+import itertools
 
 logger = logging.getLogger(__name__)
 
@@ -14,13 +31,175 @@ def test():
     """测试接口"""
     return jsonify({"status": "Bot is running!", "message": "QQ机器人正常运行"})
 
+@api_bp.route('/ready', methods=['GET'])
+def ready():
+    """就绪检查：预热完成、工作进程初始化完成且没有在停机时返回200，否则返回503"""
+    try:
+        is_ready, checks = readiness.status()
+        return jsonify({
+            "status": "success" if is_ready else "error",
+            "ready": is_ready,
+            "checks": checks
+        }), 200 if is_ready else 503
+    except Exception as e:
+        logger.error(f"就绪检查失败: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@api_bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus文本格式的运行指标"""
+    try:
+        return Response(metrics_registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+    except Exception as e:
+        logger.error(f"获取运行指标失败: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@api_bp.route('/queue/stats', methods=['GET'])
+def get_queue_stats():
+    """获取消息处理队列的深度和等待时间"""
+    try:
+        return jsonify({
+            "status": "success",
+            **message_dispatcher.get_stats()
+        })
+    except Exception as e:
+        logger.error(f"获取队列状态失败: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@api_bp.route('/cluster/stats', methods=['GET'])
+def get_cluster_stats():
+    """获取工作进程的存活状态、分发队列深度，以及状态存储的写入统计"""
+    try:
+        return jsonify({
+            "status": "success",
+            "processes": worker_cluster.num_workers if worker_cluster is not None else 1,
+            "cluster": worker_cluster.get_stats() if worker_cluster is not None else None,
+            "state_backend": state_db.get_stats() if state_db else {"backend": "memory"}
+        })
+    except Exception as e:
+        logger.error(f"获取多进程状态失败: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@api_bp.route('/llm/backends', methods=['GET'])
+def get_llm_backends():
+    """获取各大模型后端的耗时分位数、熔断状态和对冲请求胜出次数"""
+    try:
+        if not llm_client or not llm_client.client:
+            return jsonify({"status": "error", "message": "LLM客户端不可用"}), 500
+        return jsonify({
+            "status": "success",
+            **llm_client.client.get_stats()
+        })
+    except Exception as e:
+        logger.error(f"获取大模型后端状态失败: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@api_bp.route('/napcat/ws', methods=['GET'])
+def get_napcat_ws_stats():
+    """获取napcat WebSocket长连接的状态"""
+    try:
+        if napcat_ws is None:
+            return jsonify({"status": "success", "enabled": False})
+        return jsonify({
+            "status": "success",
+            "enabled": True,
+            **napcat_ws.get_stats()
+        })
+    except Exception as e:
+        logger.error(f"获取napcat WebSocket状态失败: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@api_bp.route('/admission/stats', methods=['GET'])
+def get_admission_stats():
+    """获取大模型调用的并发数、令牌余量和按优先级统计的放行/拒绝次数"""
+    try:
+        return jsonify({
+            "status": "success",
+            **admission_controller.get_stats()
+        })
+    except Exception as e:
+        logger.error(f"获取准入控制状态失败: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@api_bp.route('/sessions/stats', methods=['GET'])
+def get_session_store_stats():
+    """获取会话存储的数量、内存占用和淘汰统计"""
+    try:
+        return jsonify({
+            "status": "success",
+            **session_store.get_stats()
+        })
+    except Exception as e:
+        logger.error(f"获取会话存储状态失败: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@api_bp.route('/summarizer/stats', methods=['GET'])
+def get_summarizer_stats():
+    """获取历史记录滚动摘要的压缩次数和失败情况"""
+    try:
+        return jsonify({
+            "status": "success",
+            **history_summarizer.get_stats()
+        })
+    except Exception as e:
+        logger.error(f"获取摘要状态失败: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@api_bp.route('/moderation/stats', methods=['GET'])
+def get_moderation_stats():
+    """获取违禁词处理队列的积压、合并和禁言次数，以及清理的违规分数用户数"""
+    try:
+        return jsonify({
+            "status": "success",
+            **moderation_queue.get_stats()
+        })
+    except Exception as e:
+        logger.error(f"获取违禁词处理状态失败: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@api_bp.route('/flood/stats', methods=['GET'])
+def get_flood_stats():
+    """获取入站刷屏检测的限制、内存占用和丢弃的消息数"""
+    try:
+        return jsonify({
+            "status": "success",
+            **flood_guard.get_stats()
+        })
+    except Exception as e:
+        logger.error(f"获取刷屏检测状态失败: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@api_bp.route('/pool/stats', methods=['GET'])
+def get_reply_pool_stats():
+    """获取禁言diss回复池的库存和命中情况"""
+    try:
+        return jsonify({
+            "status": "success",
+            **diss_pool.get_stats()
+        })
+    except Exception as e:
+        logger.error(f"获取回复池状态失败: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+@api_bp.route('/cache/stats', methods=['GET'])
+def get_reply_cache_stats():
+    """获取自动回复缓存按风格统计的命中率"""
+    try:
+        return jsonify({
+            "status": "success",
+            **reply_cache.get_stats()
+        })
+    except Exception as e:
+        logger.error(f"获取回复缓存状态失败: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
 @api_bp.route('/history/<session_id>', methods=['GET'])
 def get_history(session_id):
     """获取指定会话的历史记录"""
     try:
         if llm_client:
             history_length = llm_client.get_history_length(session_id)
-            history = list(cache_history.get(session_id, []))
+            history = session_store.get_history(session_id)
             return jsonify({
                 "status": "success",
                 "session_id": session_id,
@@ -39,6 +218,9 @@ def clear_history(session_id):
     try:
         if llm_client:
             llm_client.clear_history(session_id)
+            if worker_cluster is not None:
+                # 会话在负责它的工作进程内存中，也要在那里清空
+                worker_cluster.submit(session_id, "clear_history", session_id)
             return jsonify({
                 "status": "success",
                 "message": f"已清空会话 {session_id} 的历史记录"
@@ -49,24 +231,119 @@ def clear_history(session_id):
         logger.error(f"清空历史记录失败: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
 
+# /sessions 每页最多返回的会话数
+SESSION_PAGE_MAX = 1000
+# 列表中最后一条消息最多保留的字数
+LAST_MESSAGE_PREVIEW = 100
+
+
+def _session_source():
+    """多进程模式下会话在工作进程内存中，从共享的状态存储读取；否则读取本进程的会话存储"""
+    if worker_cluster is not None and state_db:
+        return state_db
+    return session_store
+
+
+def _optional_float(name):
+    value = request.args.get(name)
+    return float(value) if value not in (None, "") else None
+
+
+def _iter_session_rows(cursor, prefix, min_idle, max_idle, style, preview=LAST_MESSAGE_PREVIEW):
+    """按session_id顺序遍历符合过滤条件的会话，返回每个会话的简要信息"""
+    now = time.time()
+    for session_id, length, last_active, last_message in _session_source().iter_sessions(after=cursor, prefix=prefix):
+        idle = now - last_active if last_active else None
+        if min_idle is not None and (idle is None or idle < min_idle):
+            continue
+        if max_idle is not None and (idle is None or idle > max_idle):
+            continue
+        if style and get_session_style(session_id) != style:
+            continue
+        if preview is not None and last_message and len(last_message) > preview:
+            last_message = last_message[:preview] + "…"
+        yield {
+            "session_id": session_id,
+            "length": length,
+            "last_message": last_message,
+            "last_active_time": last_active,
+            "idle_seconds": round(idle, 1) if idle is not None else None,
+        }
+
+
+@api_bp.route('/sessions', methods=['GET'])
+def list_sessions():
+    """
+    分页列出会话
+
+    参数：cursor（上一页返回的next_cursor）、limit（默认100，最多1000）、prefix（group_ / private_）、
+    min_idle / max_idle（未活跃秒数）、style（当前风格）、
+    format=ndjson（逐行流式输出，不分页，指定limit时最多输出limit条）、summary=1（只返回数量统计）
+    """
+    try:
+        cursor = request.args.get("cursor") or None
+        prefix = request.args.get("prefix") or None
+        style = request.args.get("style") or None
+        min_idle = _optional_float("min_idle")
+        max_idle = _optional_float("max_idle")
+        rows = _iter_session_rows(cursor, prefix, min_idle, max_idle, style)
+
+        if request.args.get("summary") in ("1", "true"):
+            total_sessions = 0
+            total_messages = 0
+            by_type = {}
+            for row in rows:
+                total_sessions += 1
+                total_messages += row["length"]
+                session_type = row["session_id"].split("_", 1)[0]
+                by_type[session_type] = by_type.get(session_type, 0) + 1
+            return jsonify({
+                "status": "success",
+                "total_sessions": total_sessions,
+                "total_messages": total_messages,
+                "by_type": by_type
+            })
+
+        if request.args.get("format") == "ndjson":
+            limit = request.args.get("limit", type=int)
+
+            def generate():
+                for count, row in enumerate(rows):
+                    if limit is not None and count >= limit:
+                        break
+                    yield json.dumps(row, ensure_ascii=False) + "\n"
+            return Response(generate(), content_type="application/x-ndjson; charset=utf-8")
+
+        limit = max(1, min(request.args.get("limit", 100, type=int), SESSION_PAGE_MAX))
+        # 多取一条判断是否还有下一页
+        page = list(itertools.islice(rows, limit + 1))
+        has_more = len(page) > limit
+        page = page[:limit]
+        return jsonify({
+            "status": "success",
+            "count": len(page),
+            "sessions": page,
+            "next_cursor": page[-1]["session_id"] if has_more else None
+        })
+    except ValueError as e:
+        return jsonify({"status": "error", "message": f"参数错误: {e}"}), 400
+    except Exception as e:
+        logger.error(f"列出会话失败: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+
 @api_bp.route('/history/all', methods=['GET'])
 def get_all_sessions():
-    """获取所有会话的信息"""
+    """获取所有会话的信息（已废弃：会话多时响应很大，请使用 /sessions 分页获取）"""
     try:
         sessions_info = {}
-        current_time = time.time()
-        
-        for session_id, history in cache_history.items():
-            last_active_time = cache_time.get(session_id)
-            time_since_last_active = None
-            if last_active_time:
-                time_since_last_active = current_time - last_active_time
-            
-            sessions_info[session_id] = {
-                "length": len(history),
-                "last_message": history[-1]["content"] if history else None,
-                "last_active_time": last_active_time,
-                "time_since_last_active_minutes": time_since_last_active / 60 if time_since_last_active else None
+        for row in _iter_session_rows(None, None, None, None, None, preview=None):
+            idle = row["idle_seconds"]
+            sessions_info[row["session_id"]] = {
+                "length": row["length"],
+                "last_message": row["last_message"],
+                "last_active_time": row["last_active_time"],
+                "time_since_last_active_minutes": idle / 60 if idle else None
             }
             
         return jsonify({
@@ -78,6 +355,75 @@ def get_all_sessions():
         logger.error(f"获取会话信息失败: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
 
+
+@api_bp.route('/sessions/batch', methods=['POST'])
+def batch_sessions():
+    """
+    批量修改会话
+
+    请求体：session_ids（会话ID列表）或 prefix（如 group_，对所有匹配的会话操作），
+    以及 style、probability（百分比，0-100）、clear_history 中的一项或多项
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        session_ids = data.get("session_ids")
+        prefix = data.get("prefix")
+        if session_ids is None and not prefix:
+            return jsonify({"status": "error", "message": "请提供session_ids或prefix参数"}), 400
+        if session_ids is None:
+            # 多取一个，超过上限时由apply_batch报错
+            rows = itertools.islice(_session_source().iter_sessions(prefix=prefix), BATCH_MAX_SESSIONS + 1)
+            session_ids = [row[0] for row in rows]
+        elif not isinstance(session_ids, list) or not all(isinstance(sid, str) for sid in session_ids):
+            return jsonify({"status": "error", "message": "session_ids必须是字符串列表"}), 400
+
+        result = apply_batch(
+            session_ids,
+            style=data.get("style"),
+            probability=data.get("probability"),
+            clear_history=bool(data.get("clear_history"))
+        )
+        return jsonify({"status": "success", **result})
+    except QueueFullError as e:
+        return jsonify({"status": "error", "message": f"工作进程繁忙，部分会话未清空: {e}"}), 503
+    except ValueError as e:
+        return jsonify({"status": "error", "message": f"参数错误: {e}"}), 400
+    except Exception as e:
+        logger.error(f"批量修改会话失败: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+
+@api_bp.route('/sessions/export', methods=['GET'])
+def export_sessions():
+    """流式导出所有会话的历史记录和风格、概率设置（gzip压缩的NDJSON，compress=0时不压缩）"""
+    try:
+        compress = request.args.get("compress", "1") not in ("0", "false")
+        filename = time.strftime("sessions-%Y%m%d-%H%M%S.ndjson") + (".gz" if compress else "")
+        return Response(
+            export_state(compress=compress),
+            content_type="application/gzip" if compress else "application/x-ndjson; charset=utf-8",
+            headers={"Content-Disposition": f"attachment; filename={filename}"}
+        )
+    except Exception as e:
+        logger.error(f"导出会话失败: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+
+@api_bp.route('/sessions/import', methods=['POST'])
+def import_sessions():
+    """导入 /sessions/export 导出的文件（请求体为原始文件内容，gzip或未压缩均可），已存在的会话会被替换"""
+    try:
+        result = import_state(request.stream)
+        return jsonify({"status": "success", **result})
+    except InvalidImportData as e:
+        # 出错之前的行已经导入
+        return jsonify({"status": "error", "message": f"导入中止: {e}"}), 400
+    except QueueFullError as e:
+        return jsonify({"status": "error", "message": f"工作进程繁忙，导入中止: {e}"}), 503
+    except Exception as e:
+        logger.error(f"导入会话失败: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
 @api_bp.route('/session/<session_id>/info', methods=['GET'])
 def get_session_info(session_id):
     """获取指定会话的详细信息，包括时间戳"""
@@ -110,6 +456,18 @@ def get_available_styles_api():
         logger.error(f"获取可用风格失败: {e}")
         return jsonify({"status": "error", "message": str(e)}), 500
 
+@api_bp.route('/styles/stats', methods=['GET'])
+def get_style_prompt_stats():
+    """获取每个风格的提示词大小、调用次数和前缀缓存命中情况"""
+    try:
+        return jsonify({
+            "status": "success",
+            "styles": prompt_registry.get_stats()
+        })
+    except Exception as e:
+        logger.error(f"获取风格统计失败: {e}")
+        return jsonify({"status": "error", "message": str(e)}), 500
+
 @api_bp.route('/session/<session_id>/style', methods=['GET'])
 def get_session_style_api(session_id):
     """获取指定会话的当前风格"""
@@ -0,0 +1,162 @@
+import os
+import logging
+import threading
+import unicodedata
+from collections import deque
+from src.utils.file_watcher import FileWatcher
+
+logger = logging.getLogger(__name__)
+
+BAN_LIST_PATH = os.getenv("BAN_LIST_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "ban.txt"))
+
+# 除标点(P*)和空白/分隔符(Z*)外，还需要去掉的控制字符和零宽字符
+_STRIP_CATEGORIES = ("Cc", "Cf")
+_strip_cache = {}
+
+
+def _should_strip(ch):
+    strip = _strip_cache.get(ch)
+    if strip is None:
+        category = unicodedata.category(ch)
+        strip = ch.isspace() or category[0] in ("P", "Z") or category in _STRIP_CATEGORIES
+        _strip_cache[ch] = strip
+    return strip
+
+
+def normalize_text(text):
+    """
+    归一化文本用于违禁词匹配
+
+    全角转半角（NFKC）、转小写、去掉标点和空白
+    """
+    text = unicodedata.normalize("NFKC", text).lower()
+    return "".join(ch for ch in text if not _should_strip(ch))
+
+
+class AhoCorasick:
+    """多模式匹配自动机，一次扫描即可判断文本中是否包含任意模式串"""
+
+    def __init__(self, patterns):
+        # goto[node]: 字符 -> 子节点
+        self._goto = [{}]
+        self._fail = [0]
+        # out[node]: 以该节点结尾（含失败链上）的任意一个模式串
+        self._out = [None]
+
+        for pattern in patterns:
+            if pattern:
+                self._insert(pattern)
+        self._build()
+        self.size = len(patterns)
+
+    def _insert(self, pattern):
+        node = 0
+        for ch in pattern:
+            nxt = self._goto[node].get(ch)
+            if nxt is None:
+                nxt = len(self._goto)
+                self._goto[node][ch] = nxt
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(None)
+            node = nxt
+        if self._out[node] is None:
+            self._out[node] = pattern
+
+    def _build(self):
+        queue = deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self._goto[node].items():
+                queue.append(child)
+                fail = self._fail[node]
+                while fail and ch not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[child] = self._goto[fail].get(ch, 0)
+                if self._out[child] is None:
+                    self._out[child] = self._out[self._fail[child]]
+
+    def search(self, text):
+        """返回文本中最先出现的模式串，没有匹配返回None"""
+        goto, fail, out = self._goto, self._fail, self._out
+        node = 0
+        for ch in text:
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            if out[node] is not None:
+                return out[node]
+        return None
+
+
+class BanWordFilter:
+    """
+    违禁词过滤器
+
+    从ban.txt构建自动机，文件变化时在后台重新构建并原子替换；
+    创建时不读取文件，start_watching()或第一次匹配时才加载
+    """
+
+    def __init__(self, path=BAN_LIST_PATH, reload_interval=5.0):
+        self.path = path
+        # (自动机, 归一化后的词 -> ban.txt中的原始词)，加载前为None
+        self._state = None
+        self._load_lock = threading.Lock()
+        self._watcher = FileWatcher(path, self.reload, reload_interval)
+
+    def _current(self):
+        state = self._state
+        if state is None:
+            with self._load_lock:
+                if self._state is None:
+                    self.reload()
+            state = self._state
+        return state
+
+    def reload(self):
+        """重新读取违禁词文件并构建自动机"""
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                words = [line.strip() for line in f]
+        except FileNotFoundError:
+            logger.warning(f"违禁词文件 {self.path} 不存在，违禁词检测已禁用")
+            words = []
+
+        originals = {}
+        for word in words:
+            normalized = normalize_text(word)
+            if normalized:
+                originals.setdefault(normalized, word)
+
+        automaton = AhoCorasick(list(originals))
+        # 一次赋值完成替换，匹配中的线程继续使用旧自动机
+        self._state = (automaton, originals)
+        logger.info(f"违禁词列表已加载，共 {len(originals)} 个词")
+
+    def start_watching(self):
+        """加载违禁词并启动后台线程监控ban.txt的变化"""
+        # 先记录文件状态再加载，加载期间的修改会在下一次检查时重新加载
+        self._watcher.start()
+        self._current()
+
+    def match(self, text):
+        """
+        检查文本是否包含违禁词
+
+        Returns:
+            str: 命中的违禁词（ban.txt中的原文），没有命中返回None
+        """
+        automaton, originals = self._current()
+        if not automaton.size:
+            return None
+        matched = automaton.search(normalize_text(text))
+        if matched is None:
+            return None
+        return originals.get(matched, matched)
+
+    def __len__(self):
+        return len(self._current()[1])
+
+
+# 创建全局实例
+ban_filter = BanWordFilter(reload_interval=float(os.getenv("BAN_LIST_RELOAD_INTERVAL", "5")))
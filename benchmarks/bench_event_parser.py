@@ -0,0 +1,103 @@
+"""
+事件解析微基准
+
+对比旧的处理方式（先完整解析JSON，再逐段.get拼接文本）和event_parser的解析速度，
+分别统计心跳事件、数组格式消息和CQ码字符串消息每秒能处理的事件数。
+
+    python benchmarks/bench_event_parser.py --seconds 1
+"""
+import os
+import sys
+import json
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from event_parser import parse_body
+
+SELF_ID = 10000
+
+HEARTBEAT = json.dumps({
+    "time": 1700000000, "self_id": SELF_ID, "post_type": "meta_event", "meta_event_type": "heartbeat",
+    "status": {"online": True, "good": True}, "interval": 30000,
+}).encode("utf-8")
+
+GROUP_SEGMENTS = json.dumps({
+    "time": 1700000000, "self_id": SELF_ID, "post_type": "message", "message_type": "group", "sub_type": "normal",
+    "message_id": 12345, "group_id": 100001, "user_id": 200001,
+    "sender": {"user_id": 200001, "nickname": "群友", "card": "群名片", "role": "member"},
+    "message": [
+        {"type": "reply", "data": {"id": "12344"}},
+        {"type": "at", "data": {"qq": str(SELF_ID)}},
+        {"type": "text", "data": {"text": " 今天天气怎么样，"}},
+        {"type": "face", "data": {"id": "178"}},
+        {"type": "text", "data": {"text": "顺便讲个笑话"}},
+    ],
+    "raw_message": "[CQ:reply,id=12344][CQ:at,qq=10000] 今天天气怎么样，[CQ:face,id=178]顺便讲个笑话",
+    "font": 14,
+}, ensure_ascii=False).encode("utf-8")
+
+GROUP_CQ_STRING = json.dumps({
+    "time": 1700000000, "self_id": SELF_ID, "post_type": "message", "message_type": "group", "sub_type": "normal",
+    "message_id": 12346, "group_id": 100001, "user_id": 200002,
+    "sender": {"user_id": 200002, "nickname": "另一个群友"},
+    "message": "[CQ:at,qq=10000] 你好&#44;机器人[CQ:face,id=178]今天吃什么",
+}, ensure_ascii=False).encode("utf-8")
+
+
+def legacy_parse(raw):
+    """旧的处理方式：完整解析JSON后再判断post_type，逐段拼接文本"""
+    data = json.loads(raw)
+    if not isinstance(data, dict):
+        return None
+    json.dumps(data, ensure_ascii=False, indent=2)  # 旧代码在INFO级别输出完整事件
+    if data.get('post_type') != 'message':
+        return None
+    message = data.get('message', [])
+    self_id = data.get('self_id')
+    message_text = ""
+    is_at_bot = False
+    if isinstance(message, list):
+        for msg_seg in message:
+            if isinstance(msg_seg, dict):
+                if msg_seg.get('type') == 'text':
+                    message_text += msg_seg.get('data', {}).get('text', '')
+                elif msg_seg.get('type') == 'at':
+                    at_qq = msg_seg.get('data', {}).get('qq')
+                    if str(at_qq) == str(self_id):
+                        is_at_bot = True
+    elif isinstance(message, str):
+        message_text = message
+        if self_id and f'[CQ:at,qq={self_id}]' in message:
+            is_at_bot = True
+    return message_text, is_at_bot
+
+
+def measure(func, raw, seconds):
+    count = 0
+    start = time.perf_counter()
+    deadline = start + seconds
+    while True:
+        for _ in range(1000):
+            func(raw)
+        count += 1000
+        if time.perf_counter() >= deadline:
+            break
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="事件解析微基准")
+    parser.add_argument("--seconds", type=float, default=1.0, help="每项测试的持续时间（秒）")
+    args = parser.parse_args()
+
+    print(f"{'事件':<12}{'旧方式(事件/秒)':>18}{'event_parser(事件/秒)':>24}{'倍数':>8}")
+    for name, raw in (("心跳", HEARTBEAT), ("数组消息", GROUP_SEGMENTS), ("CQ码字符串", GROUP_CQ_STRING)):
+        legacy = measure(legacy_parse, raw, args.seconds)
+        fast = measure(parse_body, raw, args.seconds)
+        print(f"{name:<12}{legacy:>18,.0f}{fast:>24,.0f}{fast / legacy:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
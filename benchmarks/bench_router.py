@@ -0,0 +1,86 @@
+"""
+大模型路由的对冲与熔断效果
+
+启动两个带长尾延迟的假OpenAI服务，分别在关闭和开启对冲请求时发送同样数量的请求，
+对比耗时分位数和实际发出的请求数；--fail-rate可以让第一个后端按比例返回错误，观察熔断效果。
+
+    python benchmarks/bench_router.py --requests 200 --slow-rate 0.1 --slow-latency 2
+    python benchmarks/bench_router.py --fail-rate 1.0
+"""
+import os
+import sys
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fakes import FakeOpenAI
+from benchmarks.load_test import percentile
+from llm_router import Backend, LLMRouter
+
+MESSAGES = [{"role": "user", "content": "你好"}]
+
+
+def run_round(args, hedge, stream):
+    servers = [
+        FakeOpenAI(latency=args.latency, token_delay=0, slow_rate=args.slow_rate, slow_latency=args.slow_latency,
+                   fail_rate=args.fail_rate, seed=1).start(),
+        FakeOpenAI(latency=args.latency * 1.2, token_delay=0, slow_rate=args.slow_rate,
+                   slow_latency=args.slow_latency, seed=2).start(),
+    ]
+    backends = [Backend(f"fake{i}", base_url=server.url, api_key="bench", model="bench", timeout=30,
+                        reset_timeout=args.reset_timeout) for i, server in enumerate(servers)]
+    router = LLMRouter(backends, hedge=hedge, default_hedge_delay=args.latency * 3)
+
+    def call(_):
+        start = time.perf_counter()
+        try:
+            if stream:
+                for _chunk in router.create(MESSAGES, stream=True):
+                    pass
+            else:
+                router.create(MESSAGES)
+            return time.perf_counter() - start, True
+        except Exception:
+            return time.perf_counter() - start, False
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(call, range(args.requests)))
+    latencies = [latency for latency, ok in results if ok]
+    report = {
+        "hedge": hedge,
+        "stream": stream,
+        "ok": len(latencies),
+        "errors": len(results) - len(latencies),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1),
+        "upstream_requests": [server.requests for server in servers],
+        "backends": {name: {k: v for k, v in stats.items() if k in ("state", "failures", "hedges_won")}
+                     for name, stats in router.get_stats()["backends"].items()},
+    }
+    for server in servers:
+        server.stop()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="大模型路由对冲/熔断压测")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--latency", type=float, default=0.1, help="假后端的基础延迟（秒）")
+    parser.add_argument("--slow-rate", type=float, default=0.1, help="长尾请求比例")
+    parser.add_argument("--slow-latency", type=float, default=1.0, help="长尾请求额外延迟（秒）")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="第一个后端返回错误的比例")
+    parser.add_argument("--reset-timeout", type=float, default=30.0, help="熔断后多久进入半开状态（秒）")
+    parser.add_argument("--stream", action="store_true", help="使用流式请求")
+    args = parser.parse_args()
+
+    for hedge in (False, True):
+        print(json.dumps(run_round(args, hedge, args.stream), ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,412 @@
+"""
+压测用的假napcat（HTTP和正向WebSocket）和假OpenAI兼容服务
+
+这些服务都只依赖标准库，监听本地端口，可以单独运行：
+
+    python benchmarks/fakes.py napcat --port 3000
+    python benchmarks/fakes.py openai --port 8000 --latency 0.5 --token-delay 0.02
+"""
+import re
+import json
+import time
+import base64
+import random
+import struct
+import hashlib
+import argparse
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 压测消息中携带的编号，假大模型会把它原样放进回复里，用于统计端到端耗时
+BENCH_ID_PATTERN = re.compile(r"bench:(\d+)")
+
+
+class _QuietHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_json(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        try:
+            return json.loads(body or b"{}")
+        except ValueError:
+            return {}
+
+    def _send_json(self, data, status=200):
+        body = json.dumps(data, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class _QuietHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # 客户端取消请求（例如对冲请求的输家）时连接被提前关闭，不输出异常
+        pass
+
+
+class _FakeServer:
+    handler_class = None
+
+    def __init__(self, host="127.0.0.1", port=0):
+        handler = type(self.handler_class.__name__, (self.handler_class,), {"fake": self})
+        self.httpd = _QuietHTTPServer((host, port), handler)
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, name=type(self).__name__, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class _NapCatHandler(_QuietHandler):
+    def do_POST(self):
+        action = self.path.strip("/").split("?")[0]
+        params = self._read_json()
+        self.fake.record(action, params)
+        if self.fake.latency:
+            time.sleep(self.fake.latency)
+        if action not in FakeNapCat.ACTIONS:
+            self._send_json({"status": "failed", "retcode": 1404, "data": None}, status=404)
+            return
+        self._send_json({"status": "ok", "retcode": 0, "data": {"message_id": self.fake.next_message_id()}})
+
+
+class FakeNapCat(_FakeServer):
+    """
+    假的napcat HTTP服务
+
+    记录每个动作的调用次数；发出的消息中带有bench编号时，记录该编号第一次到达的时间
+    """
+
+    ACTIONS = ("send_group_msg", "send_private_msg", "set_group_ban")
+    handler_class = _NapCatHandler
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.0):
+        super().__init__(host, port)
+        self.latency = latency
+        self._lock = threading.Lock()
+        self._message_id = 0
+        self.action_counts = {}
+        # bench编号 -> 第一次收到的时间（time.perf_counter）
+        self.replies = {}
+
+    def next_message_id(self):
+        with self._lock:
+            self._message_id += 1
+            return self._message_id
+
+    def record(self, action, params):
+        now = time.perf_counter()
+        ids = BENCH_ID_PATTERN.findall(str(params.get("message", "")))
+        with self._lock:
+            self.action_counts[action] = self.action_counts.get(action, 0) + 1
+            for bench_id in ids:
+                self.replies.setdefault(int(bench_id), now)
+
+
+class _WebSocketHandler(socketserver.StreamRequestHandler):
+    """最小的WebSocket服务端实现（RFC 6455），只支持文本帧、ping和close"""
+
+    GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+    def handle(self):
+        headers = {}
+        self.rfile.readline()
+        while True:
+            line = self.rfile.readline().decode("latin-1").strip()
+            if not line:
+                break
+            key, _, value = line.partition(":")
+            headers[key.strip().lower()] = value.strip()
+        accept = base64.b64encode(hashlib.sha1((headers.get("sec-websocket-key", "") + self.GUID)
+                                               .encode("ascii")).digest()).decode("ascii")
+        self.wfile.write(("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n"
+                          f"Sec-WebSocket-Accept: {accept}\r\n\r\n").encode("ascii"))
+        self.send_lock = threading.Lock()
+        self.server.fake.add_client(self)
+        try:
+            while True:
+                opcode, payload = self._read_frame()
+                if opcode is None or opcode == 0x8:
+                    self.send_frame(b"", 0x8)
+                    break
+                if opcode == 0x9:
+                    self.send_frame(payload, 0xA)
+                elif opcode == 0x1:
+                    self.server.fake.handle_action(self, payload)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.server.fake.remove_client(self)
+
+    def _read_exact(self, size):
+        data = self.rfile.read(size)
+        if len(data) < size:
+            raise ConnectionError("连接已关闭")
+        return data
+
+    def _read_frame(self):
+        first = self.rfile.read(2)
+        if len(first) < 2:
+            return None, b""
+        opcode = first[0] & 0x0F
+        length = first[1] & 0x7F
+        if length == 126:
+            length = struct.unpack(">H", self._read_exact(2))[0]
+        elif length == 127:
+            length = struct.unpack(">Q", self._read_exact(8))[0]
+        mask = self._read_exact(4) if first[1] & 0x80 else None
+        payload = self._read_exact(length)
+        if mask:
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        return opcode, payload
+
+    def send_frame(self, payload, opcode=0x1):
+        length = len(payload)
+        if length < 126:
+            header = struct.pack(">BB", 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack(">BBH", 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack(">BBQ", 0x80 | opcode, 127, length)
+        with self.send_lock:
+            self.wfile.write(header + payload)
+
+
+class _ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def handle_error(self, request, client_address):
+        pass
+
+
+class FakeNapCatWS:
+    """
+    假napcat的正向WebSocket服务
+
+    接收动作并返回带echo的响应，调用记录写入传入的FakeNapCat，便于与HTTP方式统一统计；
+    push_event向所有连接推送上报事件
+    """
+
+    def __init__(self, napcat, host="127.0.0.1", port=0):
+        self.napcat = napcat
+        self.server = _ThreadingTCPServer((host, port), _WebSocketHandler)
+        self.server.fake = self
+        self._clients = []
+        self._lock = threading.Lock()
+        self.connected = threading.Event()
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"ws://{host}:{port}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="FakeNapCatWS", daemon=True).start()
+        return self
+
+    def stop(self):
+        with self._lock:
+            clients = list(self._clients)
+        for client in clients:
+            try:
+                client.send_frame(b"", 0x8)
+            except OSError:
+                pass
+        self.server.shutdown()
+        self.server.server_close()
+
+    def add_client(self, client):
+        with self._lock:
+            self._clients.append(client)
+        self.connected.set()
+
+    def remove_client(self, client):
+        with self._lock:
+            if client in self._clients:
+                self._clients.remove(client)
+            if not self._clients:
+                self.connected.clear()
+
+    def handle_action(self, client, payload):
+        try:
+            request = json.loads(payload)
+        except ValueError:
+            return
+        action = request.get("action", "")
+        self.napcat.record(action, request.get("params") or {})
+        if action in FakeNapCat.ACTIONS:
+            response = {"status": "ok", "retcode": 0, "data": {"message_id": self.napcat.next_message_id()}}
+        else:
+            response = {"status": "failed", "retcode": 1404, "data": None}
+        response["echo"] = request.get("echo")
+        body = json.dumps(response, ensure_ascii=False).encode("utf-8")
+        if self.napcat.latency:
+            threading.Timer(self.napcat.latency, client.send_frame, (body,)).start()
+        else:
+            client.send_frame(body)
+
+    def push_event(self, event):
+        """向所有连接推送一条上报事件，没有连接时返回False"""
+        body = json.dumps(event, ensure_ascii=False).encode("utf-8")
+        with self._lock:
+            clients = list(self._clients)
+        for client in clients:
+            client.send_frame(body)
+        return bool(clients)
+
+
+class _OpenAIHandler(_QuietHandler):
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json({"error": {"message": "not found"}}, status=404)
+            return
+        request = self._read_json()
+        fake = self.fake
+        fake.count_request()
+        messages = request.get("messages") or [{}]
+        user_message = str(messages[-1].get("content", ""))
+        reply = fake.make_reply(user_message)
+        prompt_tokens = sum(len(str(m.get("content", ""))) for m in messages)
+        latency, fail = fake.plan_request()
+        time.sleep(latency)
+        if fail:
+            self._send_json({"error": {"message": "fake server error", "type": "server_error"}}, status=500)
+            return
+
+        if not request.get("stream"):
+            self._send_json({
+                "id": "chatcmpl-bench",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", "bench"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": reply},
+                             "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(reply),
+                          "total_tokens": prompt_tokens + len(reply)},
+            })
+            return
+
+        # 流式响应：不带Content-Length，发送完毕后关闭连接
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        for piece in fake.split_reply(reply):
+            chunk = {
+                "id": "chatcmpl-bench",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": request.get("model", "bench"),
+                "choices": [{"index": 0, "delta": {"content": piece}, "finish_reason": None}],
+            }
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            if fake.token_delay:
+                time.sleep(fake.token_delay)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+
+class FakeOpenAI(_FakeServer):
+    """
+    假的OpenAI兼容chat completions服务
+
+    latency为返回第一个token前的等待时间，token_delay为流式输出时每个片段之间的间隔；
+    回复中会带上用户消息里的所有bench编号；
+    slow_rate比例的请求额外等待slow_latency秒（模拟长尾），fail_rate比例的请求返回HTTP 500
+    """
+
+    handler_class = _OpenAIHandler
+
+    def __init__(self, host="127.0.0.1", port=0, latency=0.3, token_delay=0.01, reply_sentences=3,
+                 slow_rate=0.0, slow_latency=0.0, fail_rate=0.0, seed=None):
+        super().__init__(host, port)
+        self.latency = latency
+        self.token_delay = token_delay
+        self.reply_sentences = reply_sentences
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.fail_rate = fail_rate
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.failed = 0
+
+    def plan_request(self):
+        """返回本次请求的(延迟, 是否失败)"""
+        with self._lock:
+            latency = self.latency
+            if self.slow_rate and self._random.random() < self.slow_rate:
+                latency += self.slow_latency
+            fail = bool(self.fail_rate) and self._random.random() < self.fail_rate
+            if fail:
+                self.failed += 1
+            return latency, fail
+
+    @property
+    def url(self):
+        return super().url + "/v1"
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def make_reply(self, user_message):
+        ids = " ".join(f"bench:{bench_id}" for bench_id in BENCH_ID_PATTERN.findall(user_message))
+        sentences = [f"收到你的消息了，{ids}。" if ids else "收到你的消息了。"]
+        sentences += ["这是压测用的固定回复，内容没有意义。"] * (self.reply_sentences - 1)
+        return "".join(sentences)
+
+    @staticmethod
+    def split_reply(reply, size=4):
+        return [reply[i:i + size] for i in range(0, len(reply), size)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="启动假napcat或假OpenAI服务")
+    parser.add_argument("service", choices=["napcat", "openai"])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--latency", type=float, default=None, help="每个请求的固定延迟（秒）")
+    parser.add_argument("--token-delay", type=float, default=0.01, help="流式输出每个片段的间隔（秒）")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="额外变慢的请求比例")
+    parser.add_argument("--slow-latency", type=float, default=0.0, help="变慢的请求额外等待的秒数")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="返回HTTP 500的请求比例")
+    args = parser.parse_args()
+
+    if args.service == "napcat":
+        server = FakeNapCat(args.host, args.port, latency=args.latency or 0.0)
+    else:
+        server = FakeOpenAI(args.host, args.port, latency=0.3 if args.latency is None else args.latency,
+                            token_delay=args.token_delay, slow_rate=args.slow_rate,
+                            slow_latency=args.slow_latency, fail_rate=args.fail_rate)
+    print(f"{args.service} 已启动: {server.url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
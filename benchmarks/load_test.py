@@ -0,0 +1,281 @@
+"""
+机器人压测
+
+启动假napcat和假OpenAI服务，在本进程内运行main.create_app()创建的应用，按目标速率回放OneBot消息事件
+（群聊/私聊、@/非@、违禁词混合），统计吞吐量、webhook确认耗时、端到端回复耗时和内存增长。
+
+    python benchmarks/load_test.py --rate 50 --duration 20
+    python benchmarks/load_test.py --rate 100 --llm-latency 1.0 --no-stream
+    python benchmarks/load_test.py --rate 200 --workers 4
+"""
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import tempfile
+import threading
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import requests
+from benchmarks.fakes import FakeNapCat, FakeNapCatWS, FakeOpenAI
+
+SELF_ID = 10000
+BANNED_WORD = "压测违禁词"
+
+# 事件类型及其默认占比
+DEFAULT_MIX = {"group_at": 0.3, "group_plain": 0.5, "private": 0.1, "banned": 0.1}
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))
+    return values[index]
+
+
+def rss_bytes():
+    """当前进程的常驻内存，不支持时返回None"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return usage if sys.platform == "darwin" else usage * 1024
+    except ImportError:
+        return None
+
+
+class EventFactory:
+    """生成OneBot v11格式的消息事件"""
+
+    def __init__(self, groups=20, users=500, mix=None, seed=0):
+        self.groups = [100000 + i for i in range(groups)]
+        self.users = [200000 + i for i in range(users)]
+        self.mix = mix or DEFAULT_MIX
+        self.random = random.Random(seed)
+
+    def make(self, bench_id):
+        """返回(事件类型, 事件)；需要回复的消息带有bench编号"""
+        kind = self.random.choices(list(self.mix), weights=list(self.mix.values()))[0]
+        user_id = self.random.choice(self.users)
+        text = f"这是第{bench_id}条压测消息 bench:{bench_id}"
+        event = {
+            "time": int(time.time()),
+            "self_id": SELF_ID,
+            "post_type": "message",
+            "message_id": bench_id,
+            "user_id": user_id,
+            "sender": {"user_id": user_id, "nickname": f"用户{user_id}", "card": ""},
+        }
+        if kind == "private":
+            event.update(message_type="private", sub_type="friend",
+                         message=[{"type": "text", "data": {"text": text}}])
+            return kind, event
+
+        segments = []
+        if kind == "group_at":
+            segments.append({"type": "at", "data": {"qq": str(SELF_ID)}})
+        if kind == "banned":
+            text = f"{text} {BANNED_WORD}"
+        segments.append({"type": "text", "data": {"text": " " + text}})
+        event.update(message_type="group", sub_type="normal", group_id=self.random.choice(self.groups),
+                     message=segments)
+        return kind, event
+
+
+def start_bot(napcat_url, openai_url, ban_list_path, stream, ws_url=None, workers=1, state_db_path=""):
+    """配置环境变量后导入main，在后台线程中运行Flask应用；workers大于1时由工作进程处理消息"""
+    os.environ.update({
+        "NAPCAT_URL": napcat_url,
+        "NAPCAT_TRANSPORT": "ws" if ws_url else "http",
+        "NAPCAT_WS_URL": ws_url or "",
+        "BASE_URL": openai_url,
+        "OPENAI_API_KEY": os.environ.get("OPENAI_API_KEY", "bench"),
+        "BAN_LIST_PATH": ban_list_path,
+        "STATE_DB_PATH": state_db_path,
+        "WORKER_PROCESSES": str(workers),
+        "STREAM_REPLY": "1" if stream else "0",
+        "LOG_LEVEL": os.environ.get("LOG_LEVEL", "WARNING"),
+    })
+    import main
+    from werkzeug.serving import make_server
+
+    # 不输出每个请求的访问日志
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+
+    server = make_server("127.0.0.1", 0, main.create_app(), threaded=True)
+    threading.Thread(target=server.serve_forever, name="bench-bot", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/"
+
+
+def run(args):
+    napcat = FakeNapCat(latency=args.napcat_latency).start()
+    openai_server = FakeOpenAI(latency=args.llm_latency, token_delay=args.token_delay).start()
+    ban_file = tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False, encoding="utf-8")
+    ban_file.write(BANNED_WORD + "\n")
+    ban_file.close()
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    napcat_ws = FakeNapCatWS(napcat).start() if args.transport == "ws" else None
+    # 多进程时工作进程之间通过SQLite共享设置
+    state_dir = tempfile.mkdtemp() if args.workers > 1 else None
+    server, bot_url = start_bot(napcat.url, openai_server.url, ban_file.name, not args.no_stream,
+                                ws_url=napcat_ws.url if napcat_ws else None, workers=args.workers,
+                                state_db_path=os.path.join(state_dir, "state.db") if state_dir else "")
+    import main
+    if napcat_ws is not None and not napcat_ws.connected.wait(10):
+        raise RuntimeError("机器人没有连接到假napcat的WebSocket")
+    # 等待预热和工作进程初始化完成再开始发送
+    deadline = time.monotonic() + 60
+    while requests.get(bot_url + "ready", timeout=5).status_code != 200:
+        if time.monotonic() > deadline:
+            raise RuntimeError("机器人在60秒内没有就绪")
+        time.sleep(0.1)
+
+    factory = EventFactory(groups=args.groups, users=args.users, seed=args.seed)
+    http = requests.Session()
+    http.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=args.concurrency))
+    lock = threading.Lock()
+    sent_at = {}
+    expected = set()
+    ack_latencies = []
+    statuses = {}
+    kinds = {}
+
+    def post(bench_id, kind, event, scheduled):
+        if napcat_ws is not None:
+            # WebSocket方式：事件通过长连接推送，没有HTTP响应
+            status = 200 if napcat_ws.push_event(event) else "error"
+        else:
+            try:
+                response = http.post(bot_url, data=json.dumps(event), headers={"Content-Type": "application/json"},
+                                     timeout=30)
+                status = response.status_code
+            except requests.RequestException:
+                status = "error"
+        # 从计划发送时间开始计时，发送端排队的时间也计入
+        latency = time.perf_counter() - scheduled
+        with lock:
+            ack_latencies.append(latency)
+            statuses[status] = statuses.get(status, 0) + 1
+            if status == 200 and kind in ("group_at", "private"):
+                expected.add(bench_id)
+
+    rss_start = rss_bytes()
+    snapshot_start = tracemalloc.take_snapshot() if args.tracemalloc else None
+    total = int(args.rate * args.duration)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for bench_id in range(total):
+            scheduled = start + bench_id / args.rate
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            kind, event = factory.make(bench_id)
+            kinds[kind] = kinds.get(kind, 0) + 1
+            sent_at[bench_id] = scheduled
+            pool.submit(post, bench_id, kind, event, scheduled)
+    send_elapsed = time.perf_counter() - start
+
+    # 等待需要回复的消息全部收到回复，或者超时
+    deadline = time.perf_counter() + args.drain
+    while time.perf_counter() < deadline:
+        with napcat._lock:
+            if expected.issubset(napcat.replies):
+                break
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - start
+    rss_end = rss_bytes()
+
+    with napcat._lock:
+        replies = dict(napcat.replies)
+        action_counts = dict(napcat.action_counts)
+    e2e = [replies[i] - sent_at[i] for i in expected if i in replies]
+
+    report = {
+        "events": total,
+        "target_rate": args.rate,
+        "achieved_rate": round(total / send_elapsed, 1),
+        "mix": kinds,
+        "status_codes": {str(k): v for k, v in statuses.items()},
+        "ack_ms": {p: round(percentile(ack_latencies, q) * 1000, 2)
+                   for p, q in (("p50", 50), ("p95", 95), ("p99", 99))},
+        "e2e_ms": {p: round(percentile(e2e, q) * 1000, 1) for p, q in (("p50", 50), ("p95", 95), ("p99", 99))},
+        "replies_expected": len(expected),
+        "replies_received": len(e2e),
+        "reply_throughput_per_s": round(len(e2e) / elapsed, 1),
+        "napcat_actions": action_counts,
+        "llm_requests": openai_server.requests,
+        "queue": main.message_dispatcher.get_stats() if main.worker_cluster is None else
+                 {"rejected": main.worker_cluster.rejected, "p95_wait_ms": 0.0},
+        "rss_start_mb": round(rss_start / 2 ** 20, 1) if rss_start else None,
+        "rss_end_mb": round(rss_end / 2 ** 20, 1) if rss_end else None,
+        "rss_growth_mb": round((rss_end - rss_start) / 2 ** 20, 1) if rss_start and rss_end else None,
+    }
+    if args.tracemalloc:
+        stats = tracemalloc.take_snapshot().compare_to(snapshot_start, "lineno")
+        report["top_allocations"] = [str(stat) for stat in stats[:10]]
+
+    server.shutdown()
+    main.shutdown(timeout=5)
+    if napcat_ws is not None:
+        napcat_ws.stop()
+    napcat.stop()
+    openai_server.stop()
+    os.unlink(ban_file.name)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="QQ机器人压测")
+    parser.add_argument("--rate", type=float, default=50, help="每秒发送的事件数")
+    parser.add_argument("--duration", type=float, default=10, help="发送持续时间（秒）")
+    parser.add_argument("--concurrency", type=int, default=32, help="并发发送的线程数")
+    parser.add_argument("--groups", type=int, default=20)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="假大模型返回第一个token前的延迟（秒）")
+    parser.add_argument("--token-delay", type=float, default=0.01, help="假大模型流式片段间隔（秒）")
+    parser.add_argument("--napcat-latency", type=float, default=0.0, help="假napcat每个动作的延迟（秒）")
+    parser.add_argument("--no-stream", action="store_true", help="关闭流式回复")
+    parser.add_argument("--transport", choices=["http", "ws"], default="http",
+                        help="napcat上报事件和发送动作的方式")
+    parser.add_argument("--workers", type=int, default=1, help="处理消息的工作进程数")
+    parser.add_argument("--drain", type=float, default=30, help="发送结束后等待回复的最长时间（秒）")
+    parser.add_argument("--tracemalloc", action="store_true", help="用tracemalloc统计内存分配位置（会明显变慢）")
+    parser.add_argument("--json", action="store_true", help="以JSON输出结果")
+    args = parser.parse_args()
+
+    report = run(args)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        return
+    print(f"事件数: {report['events']}  目标速率: {report['target_rate']}/s  实际速率: {report['achieved_rate']}/s")
+    print(f"事件构成: {report['mix']}")
+    print(f"webhook状态码: {report['status_codes']}")
+    print(f"webhook确认耗时(ms): {report['ack_ms']}")
+    print(f"端到端回复耗时(ms): {report['e2e_ms']}  "
+          f"收到回复 {report['replies_received']}/{report['replies_expected']}  "
+          f"回复吞吐 {report['reply_throughput_per_s']}/s")
+    print(f"napcat动作: {report['napcat_actions']}  大模型请求: {report['llm_requests']}")
+    print(f"队列: 拒绝 {report['queue']['rejected']}  p95等待 {report['queue']['p95_wait_ms']:.1f}ms")
+    print(f"内存(RSS): {report['rss_start_mb']}MB -> {report['rss_end_mb']}MB（增长 {report['rss_growth_mb']}MB）")
+    for line in report.get("top_allocations", []):
+        print(f"  {line}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+import os
+import time
+import queue
+import atexit
+import signal
+import bisect
+import hashlib
+import logging
+import threading
+import multiprocessing
+from dispatcher import message_dispatcher, QueueFullError
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# 处理消息的工作进程数，大于1时主进程只接收事件，按会话分配给工作进程处理
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "1"))
+WORKER_NAME_PREFIX = "bot-worker-"
+# 工作进程向主进程上报指标的间隔（秒）
+METRICS_REPORT_INTERVAL = float(os.getenv("METRICS_REPORT_INTERVAL", "5"))
+
+
+def is_worker_process():
+    """
+    当前是否为工作进程
+
+    按进程名判断：spawn在导入主模块、还原启动参数之前就已经设置好进程名，
+    而multiprocessing.parent_process()要到那之后才可用
+    """
+    return multiprocessing.current_process().name.startswith(WORKER_NAME_PREFIX)
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """
+    一致性哈希环
+
+    每个节点在环上放置replicas个虚拟节点，key顺时针找到的第一个虚拟节点就是它所属的节点；
+    节点数变化时只有约1/N的key需要换节点
+    """
+
+    def __init__(self, nodes, replicas=256):
+        points = sorted((_hash(f"{node}#{i}"), node) for node in nodes for i in range(replicas))
+        if not points:
+            raise ValueError("哈希环至少需要一个节点")
+        self._points = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def get_node(self, key):
+        index = bisect.bisect(self._points, _hash(key))
+        return self._nodes[index % len(self._nodes)]
+
+
+def _report_metrics(index, report_queue):
+    try:
+        report_queue.put_nowait((index, os.getpid(), registry.snapshot()))
+    except Exception as e:
+        logger.warning(f"工作进程 {index} 上报指标失败: {e}")
+
+
+def _metrics_reporter(index, report_queue, stop):
+    while not stop.wait(METRICS_REPORT_INTERVAL):
+        _report_metrics(index, report_queue)
+
+
+def _worker_main(index, work_queue, ready, report_queue, setup, handlers, teardown, drain_timeout):
+    """工作进程入口：初始化后循环处理主进程分配过来的任务"""
+    # Ctrl+C和发给整个进程组的SIGTERM也会到达工作进程，由主进程负责通知它们处理完任务后退出
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    setup()
+    # 大模型、napcat、准入控制等指标都在工作进程中记录，定期上报给主进程，由主进程的/metrics汇总输出
+    stop_reporting = threading.Event()
+    threading.Thread(target=_metrics_reporter, args=(index, report_queue, stop_reporting),
+                     name="metrics-reporter", daemon=True).start()
+    ready.set()
+    logger.info(f"工作进程 {index} 已启动，pid: {os.getpid()}")
+    while True:
+        item = work_queue.get()
+        if item is None:
+            break
+        kind, payload = item
+        while True:
+            try:
+                handlers[kind](payload)
+                break
+            except QueueFullError:
+                # 本进程的处理队列满了就等待，让主进程的分发队列积压，由主进程返回503
+                time.sleep(0.05)
+            except Exception as e:
+                logger.error(f"工作进程 {index} 处理任务 {kind} 时出错: {e}")
+                break
+    # 处理完已经接收的消息再退出
+    if teardown is not None:
+        drained = teardown(drain_timeout)
+    else:
+        message_dispatcher.stop_accepting()
+        drained = message_dispatcher.drain(drain_timeout)
+    if not drained:
+        logger.warning(f"工作进程 {index} 退出时仍有未处理完的消息")
+    stop_reporting.set()
+    _report_metrics(index, report_queue)
+    logger.info(f"工作进程 {index} 已停止")
+
+
+class WorkerCluster:
+    """
+    多进程消息处理
+
+    - 主进程接收事件后，按session_id在一致性哈希环上选出工作进程，同一个会话始终由同一个进程处理，
+      会话历史只在该进程内存中修改，不会出现多个进程交替修改同一个会话
+    - 每个工作进程一个有上限的分发队列，满了之后submit抛出QueueFullError
+    - 工作进程意外退出后自动重启，分发队列中的任务保留
+    - 每个工作进程初始化完成后才算就绪（ready），停止后不再接收新任务
+    - 风格、概率等设置通过共享的状态存储（SQLite或Redis）在进程间同步
+    - 工作进程定期上报指标快照，由主进程汇总到自己的指标注册表中
+    """
+
+    def __init__(self, num_workers, max_pending=200, replicas=256, drain_timeout=30.0):
+        self.num_workers = num_workers
+        self.max_pending = max_pending
+        self.drain_timeout = drain_timeout
+        self.ring = HashRing(range(num_workers), replicas)
+        # 使用spawn启动，工作进程不继承主进程中已经启动的线程和锁
+        self._context = multiprocessing.get_context("spawn")
+        self._queues = [self._context.Queue(max_pending) for _ in range(num_workers)]
+        self._processes = [None] * num_workers
+        self._ready = [self._context.Event() for _ in range(num_workers)]
+        self._reports = self._context.Queue()
+        self._collector = None
+        self._setup = None
+        self._handlers = None
+        self._teardown = None
+        self._monitor = None
+        self._stopped = threading.Event()
+
+        self.submitted = [0] * num_workers
+        self.rejected = 0
+        self.restarts = 0
+
+    def start(self, setup, handlers, teardown=None):
+        """
+        启动工作进程
+
+        Args:
+            setup (Callable): 工作进程中首先调用的初始化函数（必须是模块级函数）
+            handlers (dict): 任务类型 -> 处理函数(payload)，处理函数必须是模块级函数
+            teardown (Callable, optional): 工作进程退出前调用的函数(timeout)，返回是否处理完了已接收的任务；
+                默认只等待消息处理队列清空
+        """
+        if self._monitor is not None:
+            return
+        self._setup = setup
+        self._handlers = handlers
+        self._teardown = teardown
+        for index in range(self.num_workers):
+            self._spawn(index)
+        self._monitor = threading.Thread(target=self._monitor_loop, name="worker-monitor", daemon=True)
+        self._monitor.start()
+        self._collector = threading.Thread(target=self._collect_metrics, name="metrics-collector", daemon=True)
+        self._collector.start()
+        atexit.register(self.stop)
+        logger.info(f"已启动 {self.num_workers} 个工作进程，每个进程的分发队列上限: {self.max_pending}")
+
+    def _spawn(self, index):
+        self._ready[index].clear()
+        process = self._context.Process(
+            target=_worker_main,
+            args=(index, self._queues[index], self._ready[index], self._reports, self._setup, self._handlers,
+                  self._teardown, self.drain_timeout),
+            name=f"{WORKER_NAME_PREFIX}{index}",
+            daemon=True
+        )
+        process.start()
+        self._processes[index] = process
+
+    def _monitor_loop(self):
+        while not self._stopped.wait(1.0):
+            for index, process in enumerate(self._processes):
+                if process is not None and not process.is_alive() and not self._stopped.is_set():
+                    logger.error(f"工作进程 {index} 意外退出（退出码 {process.exitcode}），正在重启")
+                    self.restarts += 1
+                    self._spawn(index)
+
+    def _collect_metrics(self):
+        while True:
+            try:
+                index, pid, snapshot = self._reports.get()
+            except (EOFError, OSError):
+                return
+            registry.update_remote(f"worker-{index}", pid, snapshot)
+
+    def worker_for(self, session_id):
+        return self.ring.get_node(session_id)
+
+    def submit(self, session_id, kind, payload, timeout=None):
+        """
+        把任务交给负责该会话的工作进程
+
+        Args:
+            timeout (float, optional): 队列满时最多等待的秒数，默认不等待（批量导入等后台操作可以等待）
+
+        Raises:
+            QueueFullError: 该工作进程的分发队列已满，或者工作进程正在停止
+        """
+        if self._stopped.is_set():
+            self.rejected += 1
+            raise QueueFullError("工作进程正在停止，不再接收新任务")
+        index = self.ring.get_node(session_id)
+        try:
+            if timeout is None:
+                self._queues[index].put_nowait((kind, payload))
+            else:
+                self._queues[index].put((kind, payload), timeout=timeout)
+        except queue.Full:
+            self.rejected += 1
+            raise QueueFullError(f"工作进程 {index} 的分发队列已满 ({self.max_pending})")
+        self.submitted[index] += 1
+
+    def ready(self):
+        """所有工作进程都在运行并且已经初始化完成"""
+        return all(process is not None and process.is_alive() and ready.is_set()
+                   for process, ready in zip(self._processes, self._ready))
+
+    def queue_depth(self):
+        return sum(self._safe_qsize(work_queue) for work_queue in self._queues)
+
+    @staticmethod
+    def _safe_qsize(work_queue):
+        try:
+            return work_queue.qsize()
+        except NotImplementedError:
+            # macOS不支持qsize
+            return 0
+
+    def stop(self, timeout=None):
+        """
+        通知工作进程处理完已分配的任务后退出
+
+        Returns:
+            bool: 是否所有工作进程都按时退出
+        """
+        if self._stopped.is_set():
+            return True
+        self._stopped.set()
+        timeout = self.drain_timeout if timeout is None else timeout
+        for work_queue in self._queues:
+            try:
+                work_queue.put(None, timeout=1)
+            except queue.Full:
+                pass
+        deadline = time.monotonic() + timeout
+        stopped = True
+        for index, process in enumerate(self._processes):
+            if process is None:
+                continue
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning(f"工作进程 {index} 未能按时退出，强制结束")
+                process.terminate()
+                stopped = False
+        return stopped
+
+    def get_stats(self):
+        workers = []
+        for index, process in enumerate(self._processes):
+            workers.append({
+                "index": index,
+                "pid": process.pid if process is not None else None,
+                "alive": process is not None and process.is_alive(),
+                "ready": self._ready[index].is_set(),
+                "queue_depth": self._safe_qsize(self._queues[index]),
+                "submitted": self.submitted[index],
+            })
+        return {"workers": workers, "max_pending": self.max_pending, "rejected": self.rejected,
+                "restarts": self.restarts}
+
+
+# 创建全局实例：只在主进程中、WORKER_PROCESSES大于1时创建，由main启动
+worker_cluster = None
+if WORKER_PROCESSES > 1 and not is_worker_process():
+    worker_cluster = WorkerCluster(
+        WORKER_PROCESSES,
+        max_pending=int(os.getenv("QUEUE_MAX_SIZE", "200")),
+        drain_timeout=float(os.getenv("WORKER_DRAIN_TIMEOUT", "30"))
+    )
@@ -0,0 +1,110 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class Mention:
+    """一次@机器人的消息"""
+
+    __slots__ = ("user_id", "sender_name", "text")
+
+    def __init__(self, user_id, sender_name, text):
+        self.user_id = user_id
+        self.sender_name = sender_name
+        self.text = text
+
+
+def build_combined_prompt(mentions):
+    """把同一时间窗口内的多条@消息合并成一个按发言人标注的prompt"""
+    if len(mentions) == 1:
+        return mentions[0].text
+    lines = ["以下是几位群友刚刚同时@你说的话："]
+    for mention in mentions:
+        lines.append(f"[{mention.sender_name}]: {mention.text}")
+    lines.append("请在一条回复中分别回应每个人，回应某人时用\"@昵称\"开头指明是在回复谁。")
+    return "\n".join(lines)
+
+
+class MentionCoalescer:
+    """
+    合并短时间内同一会话的多次@
+
+    窗口外的第一条@立即调用flush_func(session_id, group_id, [mention])，不增加延迟，同时打开window秒的合并窗口；
+    窗口内同一会话的@合并到一起，窗口结束时调用一次flush_func并打开下一个窗口，
+    直到某个窗口内没有新的@为止。持续被@时每个窗口最多一次大模型调用
+    """
+
+    def __init__(self, flush_func, window=1.5, max_batch=8):
+        self.flush_func = flush_func
+        self.window = window
+        self.max_batch = max_batch
+        self._lock = threading.Lock()
+        # session_id -> (group_id, [窗口内等待合并的Mention], Timer)
+        self._bursts = {}
+        self.merged = 0
+        self.flushed = 0
+
+    @property
+    def enabled(self):
+        return self.window > 0
+
+    def _open_window(self, session_id, group_id):
+        timer = threading.Timer(self.window, self._flush, args=(session_id,))
+        timer.daemon = True
+        self._bursts[session_id] = (group_id, [], timer)
+        timer.start()
+
+    def add(self, session_id, group_id, user_id, sender_name, text):
+        """加入一条@消息"""
+        mention = Mention(user_id, sender_name, text)
+        leading = False
+        flush_now = False
+        with self._lock:
+            burst = self._bursts.get(session_id)
+            if burst is None:
+                leading = True
+                self._open_window(session_id, group_id)
+            else:
+                burst[1].append(mention)
+                self.merged += 1
+                flush_now = len(burst[1]) >= self.max_batch
+        if leading:
+            self._emit(session_id, group_id, [mention])
+        elif flush_now:
+            self._flush(session_id)
+
+    def _flush(self, session_id, reopen=True):
+        """窗口结束（或攒满max_batch条）：处理窗口内的@，有@时打开下一个窗口"""
+        with self._lock:
+            burst = self._bursts.pop(session_id, None)
+            if burst is None:
+                return
+            group_id, mentions, timer = burst
+            timer.cancel()
+            if mentions and reopen:
+                self._open_window(session_id, group_id)
+        if mentions:
+            self._emit(session_id, group_id, mentions)
+
+    def _emit(self, session_id, group_id, mentions):
+        self.flushed += 1
+        if len(mentions) > 1:
+            logger.info(f"会话 {session_id} 合并了 {len(mentions)} 条@消息")
+        try:
+            self.flush_func(session_id, group_id, mentions)
+        except Exception as e:
+            logger.error(f"处理会话 {session_id} 合并的@消息时出错: {e}")
+
+    def flush_all(self):
+        """立即处理所有等待中的@消息（用于停机）"""
+        with self._lock:
+            session_ids = list(self._bursts)
+        for session_id in session_ids:
+            self._flush(session_id, reopen=False)
+
+    def get_stats(self):
+        with self._lock:
+            waiting = sum(1 for burst in self._bursts.values() if burst[1])
+        return {"window_ms": int(self.window * 1000), "waiting_sessions": waiting,
+                "merged": self.merged, "flushed": self.flushed}
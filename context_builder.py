@@ -0,0 +1,135 @@
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+try:
+    import tiktoken
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    # tiktoken是可选依赖，没有安装时使用估算
+    _encoding = None
+
+# 每条消息除内容外的固定开销（role、分隔符等）
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def count_tokens(text):
+    """
+    计算文本的token数
+
+    安装了tiktoken时精确计算，否则按中文每字1个token、其他字符每4个1个token估算
+    """
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    non_ascii = sum(1 for ch in text if ord(ch) > 127)
+    ascii_count = len(text) - non_ascii
+    return non_ascii + (ascii_count + 3) // 4
+
+
+def make_history_entry(role, content):
+    """创建一条历史记录，同时缓存其token数，之后构建上下文时不再重复计算"""
+    return {"role": role, "content": content, "tokens": count_tokens(content)}
+
+
+def make_summary_entry(content):
+    """创建一条滚动摘要记录，固定放在历史记录最前面，代替已经被总结的旧对话"""
+    entry = make_history_entry("system", content)
+    entry["summary"] = True
+    return entry
+
+
+def is_summary(entry):
+    return entry.get("summary", False)
+
+
+def entry_tokens(entry):
+    """获取历史记录的token数（兼容没有缓存token数的旧记录）"""
+    tokens = entry.get("tokens")
+    if tokens is None:
+        tokens = entry["tokens"] = count_tokens(entry["content"])
+    return tokens
+
+
+class ContextBuilder:
+    """
+    按token预算构建发送给大模型的消息列表
+
+    系统提示词、滚动摘要和当前消息必定发送，剩余预算从最新的历史记录往前填充。
+    为了让服务端的前缀缓存尽量命中，历史的起点在预算允许时保持不变（anchor），
+    超出预算时一次性裁剪到trim_ratio，之后几轮请求的前缀都保持一致
+    """
+
+    def __init__(self, token_budget=4000, trim_ratio=0.75):
+        self.token_budget = token_budget
+        self.trim_ratio = trim_ratio
+        # 系统提示词很长且数量固定，缓存其token数
+        self._prompt_tokens = {}
+
+    def _system_tokens(self, system_prompt):
+        tokens = self._prompt_tokens.get(system_prompt)
+        if tokens is None:
+            tokens = self._prompt_tokens[system_prompt] = count_tokens(system_prompt)
+        return tokens
+
+    def build(self, system_prompt, history, user_message, system_tokens=None, anchor=None):
+        """
+        构建消息列表
+
+        Args:
+            system_prompt (str): 系统提示词，可以为空
+            history (list[dict]): 历史记录，按时间从旧到新，第一条可以是滚动摘要
+            user_message (str): 当前用户消息
+            system_tokens (int, optional): 预先计算好的系统提示词token数
+            anchor (dict, optional): 上一次发送的第一条历史记录
+
+        Returns:
+            tuple: (messages, prompt_tokens, 使用的历史条数（不含摘要）)
+        """
+        fixed = MESSAGE_OVERHEAD_TOKENS + count_tokens(user_message)
+        if system_prompt:
+            if system_tokens is None:
+                system_tokens = self._system_tokens(system_prompt)
+            fixed += MESSAGE_OVERHEAD_TOKENS + system_tokens
+        summary = None
+        if history and is_summary(history[0]):
+            # 摘要只在压缩时变化，紧跟在系统提示词后面，不影响前缀缓存
+            summary = history[0]
+            history = history[1:]
+            fixed += MESSAGE_OVERHEAD_TOKENS + entry_tokens(summary)
+
+        costs = [MESSAGE_OVERHEAD_TOKENS + entry_tokens(entry) for entry in history]
+        start = None
+        if anchor is not None:
+            for index, entry in enumerate(history):
+                if entry is anchor:
+                    if fixed + sum(costs[index:]) <= self.token_budget:
+                        start = index
+                    break
+        if start is None:
+            if fixed + sum(costs) <= self.token_budget:
+                start = 0
+            else:
+                # 超出预算，裁剪到预算的trim_ratio，给之后几轮留出空间
+                limit = self.token_budget * self.trim_ratio
+                used = fixed
+                start = len(history)
+                while start > 0 and used + costs[start - 1] <= limit:
+                    start -= 1
+                    used += costs[start]
+
+        messages = []
+        if system_prompt:
+            messages.append({"role": "system", "content": system_prompt})
+        if summary is not None:
+            messages.append({"role": "system", "content": summary["content"]})
+        for entry in history[start:]:
+            messages.append({"role": entry["role"], "content": entry["content"]})
+        messages.append({"role": "user", "content": user_message})
+        return messages, fixed + sum(costs[start:]), len(history) - start
+
+
+# 创建全局实例
+context_builder = ContextBuilder(token_budget=int(os.getenv("CONTEXT_TOKEN_BUDGET", "4000")))
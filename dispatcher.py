@@ -0,0 +1,187 @@
+import os
+import time
+import logging
+import threading
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """消息队列已满，调用方应当拒绝本次请求（背压）"""
+
+
+class _Job:
+    __slots__ = ("func", "args", "kwargs", "enqueued_at")
+
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.enqueued_at = time.monotonic()
+
+
+class MessageDispatcher:
+    """
+    后台消息处理队列
+
+    - 固定数量的工作线程，webhook只负责入队后立即返回
+    - 同一个session_id同时最多只有一个任务在处理，保证会话内消息顺序
+    - 队列总长度有上限，满了之后submit抛出QueueFullError
+    """
+
+    def __init__(self, num_workers=4, max_pending=200):
+        self.num_workers = num_workers
+        self.max_pending = max_pending
+
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._idle = threading.Condition(self._lock)
+        # 每个会话的待处理任务
+        self._pending = {}
+        # 可以被调度的会话（有待处理任务且当前没有任务在执行）
+        self._ready = deque()
+        self._running_sessions = set()
+        self._pending_count = 0
+        self._workers = []
+        self._accepting = True
+
+        # 统计信息
+        self._submitted = 0
+        self._processed = 0
+        self._failed = 0
+        self._rejected = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+        self._recent_waits = deque(maxlen=256)
+
+    def start(self):
+        """启动工作线程（重复调用无副作用）"""
+        with self._lock:
+            if self._workers:
+                return
+            for i in range(self.num_workers):
+                worker = threading.Thread(target=self._worker_loop, name=f"dispatcher-{i}", daemon=True)
+                worker.start()
+                self._workers.append(worker)
+        logger.info(f"消息处理队列已启动，工作线程数: {self.num_workers}，队列上限: {self.max_pending}")
+
+    def submit(self, session_id, func, *args, **kwargs):
+        """
+        提交一个任务到指定会话
+
+        Args:
+            session_id (str): 会话ID，相同会话的任务按提交顺序串行执行
+            func (Callable): 任务函数
+
+        Raises:
+            QueueFullError: 队列已满或已停止接收新任务
+        """
+        with self._lock:
+            if not self._accepting or self._pending_count >= self.max_pending:
+                self._rejected += 1
+                raise QueueFullError(f"消息队列已满 ({self._pending_count}/{self.max_pending})")
+
+            jobs = self._pending.get(session_id)
+            if jobs is None:
+                jobs = self._pending[session_id] = deque()
+            jobs.append(_Job(func, args, kwargs))
+            self._pending_count += 1
+            self._submitted += 1
+
+            # 会话当前没有任务在执行且尚未排队时，加入可调度队列
+            if len(jobs) == 1 and session_id not in self._running_sessions:
+                self._ready.append(session_id)
+                self._not_empty.notify()
+
+    def _next_job(self):
+        with self._lock:
+            while not self._ready:
+                self._not_empty.wait()
+            session_id = self._ready.popleft()
+            jobs = self._pending[session_id]
+            job = jobs.popleft()
+            if not jobs:
+                del self._pending[session_id]
+            self._pending_count -= 1
+            self._running_sessions.add(session_id)
+
+            wait = time.monotonic() - job.enqueued_at
+            self._wait_total += wait
+            self._wait_max = max(self._wait_max, wait)
+            self._recent_waits.append(wait)
+            return session_id, job
+
+    def _finish_job(self, session_id, failed):
+        with self._lock:
+            self._running_sessions.discard(session_id)
+            if failed:
+                self._failed += 1
+            else:
+                self._processed += 1
+            # 同一会话还有任务则重新排到队尾，避免一个会话独占工作线程
+            if session_id in self._pending:
+                self._ready.append(session_id)
+                self._not_empty.notify()
+            elif not self._pending_count and not self._running_sessions:
+                self._idle.notify_all()
+
+    def _worker_loop(self):
+        while True:
+            session_id, job = self._next_job()
+            failed = False
+            try:
+                job.func(*job.args, **job.kwargs)
+            except Exception as e:
+                failed = True
+                logger.error(f"处理会话 {session_id} 的任务时出错: {e}")
+            finally:
+                self._finish_job(session_id, failed)
+
+    def stop_accepting(self):
+        """停止接收新任务，已入队的任务继续处理"""
+        with self._lock:
+            self._accepting = False
+
+    def drain(self, timeout=None):
+        """
+        等待所有已入队和正在处理的任务完成
+
+        Returns:
+            bool: 超时前是否全部完成
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            while self._pending_count or self._running_sessions:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._idle.wait(remaining)
+            return True
+
+    def get_stats(self):
+        """获取队列深度和等待时间统计"""
+        with self._lock:
+            started = self._processed + self._failed + len(self._running_sessions)
+            recent = sorted(self._recent_waits)
+            return {
+                "queue_depth": self._pending_count,
+                "max_pending": self.max_pending,
+                "in_flight": len(self._running_sessions),
+                "waiting_sessions": len(self._pending),
+                "workers": len(self._workers),
+                "submitted": self._submitted,
+                "processed": self._processed,
+                "failed": self._failed,
+                "rejected": self._rejected,
+                "avg_wait_ms": (self._wait_total / started * 1000) if started else 0.0,
+                "max_wait_ms": self._wait_max * 1000,
+                "p95_wait_ms": recent[int(len(recent) * 0.95)] * 1000 if recent else 0.0,
+            }
+
+
+# 创建全局实例
+message_dispatcher = MessageDispatcher(
+    num_workers=int(os.getenv("WORKER_THREADS", "4")),
+    max_pending=int(os.getenv("QUEUE_MAX_SIZE", "200"))
+)
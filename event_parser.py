@@ -0,0 +1,201 @@
+import re
+import json
+
+# 不需要处理的上报类型，在解析JSON之前就直接丢弃
+IGNORED_POST_TYPES = frozenset(("meta_event", "notice", "request", "message_sent"))
+
+_POST_TYPE_KEY = b'"post_type"'
+_WHITESPACE = b" \t\r\n"
+
+# CQ码：[CQ:类型,参数=值,...]
+_CQ_PATTERN = re.compile(r"\[CQ:([A-Za-z_]+)((?:,[^\]]*)?)\]")
+_CQ_UNESCAPE = (("&#44;", ","), ("&#91;", "["), ("&#93;", "]"), ("&amp;", "&"))
+
+
+class InvalidEvent(ValueError):
+    """上报数据不是有效的JSON对象"""
+
+
+class MessageEvent:
+    """解析后的消息事件，只保留处理消息需要的字段"""
+
+    __slots__ = ("message_type", "session_id", "user_id", "group_id", "self_id", "message_id",
+                 "text", "is_at_bot", "reply_to", "sender_name", "raw")
+
+    def __init__(self, message_type, session_id, user_id, group_id, self_id, message_id,
+                 text, is_at_bot, reply_to, sender_name, raw):
+        self.message_type = message_type
+        self.session_id = session_id
+        self.user_id = user_id
+        self.group_id = group_id
+        self.self_id = self_id
+        self.message_id = message_id
+        self.text = text
+        self.is_at_bot = is_at_bot
+        self.reply_to = reply_to
+        self.sender_name = sender_name
+        self.raw = raw
+
+    def __repr__(self):
+        return (f"MessageEvent({self.session_id}, user={self.user_id}, at_bot={self.is_at_bot}, "
+                f"text={self.text!r})")
+
+
+def peek_post_type(raw):
+    """
+    不解析JSON，直接在原始字节中查找post_type的值
+
+    找不到或格式不符合预期时返回None，由调用方完整解析
+    """
+    index = raw.find(_POST_TYPE_KEY)
+    if index < 0:
+        return None
+    index += len(_POST_TYPE_KEY)
+    length = len(raw)
+    while index < length and raw[index] in _WHITESPACE:
+        index += 1
+    if index >= length or raw[index] != 0x3A:  # ':'
+        return None
+    index += 1
+    while index < length and raw[index] in _WHITESPACE:
+        index += 1
+    if index >= length or raw[index] != 0x22:  # '"'
+        return None
+    end = raw.find(b'"', index + 1)
+    if end < 0 or end - index > 32:
+        return None
+    try:
+        return raw[index + 1:end].decode("ascii")
+    except UnicodeDecodeError:
+        return None
+
+
+def _unescape_cq(text):
+    if "&" in text:
+        for escaped, char in _CQ_UNESCAPE:
+            text = text.replace(escaped, char)
+    return text
+
+
+def _cq_params(params):
+    result = {}
+    for pair in params.split(","):
+        key, sep, value = pair.partition("=")
+        if sep:
+            result[key] = _unescape_cq(value)
+    return result
+
+
+def parse_segments(segments, self_id):
+    """
+    一次遍历消息段数组
+
+    Returns:
+        tuple: (文本, 是否@机器人, 回复的消息ID)
+    """
+    parts = []
+    is_at_bot = False
+    reply_to = None
+    self_id = str(self_id)
+    for segment in segments:
+        if type(segment) is not dict:
+            continue
+        seg_type = segment.get("type")
+        data = segment.get("data") or {}
+        if seg_type == "text":
+            text = data.get("text")
+            if text:
+                parts.append(text)
+        elif seg_type == "at":
+            # 只识别@机器人，@其他人不计入文本
+            if str(data.get("qq")) == self_id:
+                is_at_bot = True
+        elif seg_type == "reply":
+            reply_to = data.get("id")
+    return "".join(parts), is_at_bot, reply_to
+
+
+def parse_cq_string(message, self_id):
+    """
+    一次遍历CQ码格式的消息字符串，CQ码之外的部分作为文本
+
+    Returns:
+        tuple: (文本, 是否@机器人, 回复的消息ID)
+    """
+    if "[CQ:" not in message:
+        # 没有CQ码时兼容"@开头"的简单@判断（不够精确，建议使用数组格式）
+        return _unescape_cq(message), message.lstrip().startswith("@"), None
+    parts = []
+    is_at_bot = False
+    reply_to = None
+    self_id = str(self_id)
+    position = 0
+    for match in _CQ_PATTERN.finditer(message):
+        if match.start() > position:
+            parts.append(message[position:match.start()])
+        position = match.end()
+        cq_type = match.group(1)
+        if cq_type == "at":
+            if _cq_params(match.group(2)).get("qq") == self_id:
+                is_at_bot = True
+        elif cq_type == "reply":
+            reply_to = _cq_params(match.group(2)).get("id")
+    parts.append(message[position:])
+    return _unescape_cq("".join(parts)), is_at_bot, reply_to
+
+
+def parse_event(data):
+    """
+    把上报的事件字典解析为MessageEvent
+
+    Returns:
+        MessageEvent: 可以处理的群聊或私聊消息，其他事件返回None
+    """
+    if data.get("post_type") != "message":
+        return None
+    message_type = data.get("message_type")
+    user_id = data.get("user_id")
+    group_id = data.get("group_id")
+    if message_type == "group" and group_id:
+        session_id = f"group_{group_id}"
+    elif message_type == "private" and user_id:
+        session_id = f"private_{user_id}"
+    else:
+        return None
+
+    self_id = data.get("self_id")
+    message = data.get("message")
+    if type(message) is list:
+        text, is_at_bot, reply_to = parse_segments(message, self_id)
+    elif type(message) is str:
+        text, is_at_bot, reply_to = parse_cq_string(message, self_id)
+    else:
+        text, is_at_bot, reply_to = "", False, None
+
+    sender = data.get("sender") or {}
+    sender_name = sender.get("card") or sender.get("nickname") or str(user_id)
+    return MessageEvent(message_type, session_id, user_id, group_id, self_id, data.get("message_id"),
+                        text, is_at_bot, reply_to, sender_name, data)
+
+
+def parse_body(raw):
+    """
+    解析webhook请求体
+
+    心跳、通知等不需要处理的事件只查看post_type，不解析JSON
+
+    Returns:
+        MessageEvent: 需要处理的消息事件，其他事件返回None
+
+    Raises:
+        InvalidEvent: 请求体不是JSON对象
+    """
+    if peek_post_type(raw) in IGNORED_POST_TYPES:
+        return None
+    try:
+        data = json.loads(raw)
+    except ValueError as e:
+        raise InvalidEvent(f"无效的JSON: {e}")
+    if type(data) is not dict:
+        raise InvalidEvent("事件数据必须是JSON对象")
+    return parse_event(data)
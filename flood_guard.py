@@ -0,0 +1,148 @@
+import os
+import time
+import logging
+import threading
+from array import array
+from metrics import FLOOD_DROPS
+
+logger = logging.getLogger(__name__)
+
+
+class SlidingSketch:
+    """
+    固定内存的滑动窗口计数（环形的count-min sketch）
+
+    - 窗口分成slots个时间片，每个时间片一个depth x width的计数表，组成一个环；
+      另外维护所有时间片之和，查询只需读depth个计数
+    - 时间片过期时从总和中减去并清零，计数只覆盖最近window秒；每个时间片记录改动过的计数位置，
+      过期时只处理这些位置，空闲很久后的第一条消息也不需要扫描整个计数表
+    - 不同key可能共用计数，估计值只会偏大不会偏小；内存只取决于width、depth、slots，与key的数量无关，
+      窗口内活跃的key远少于width时误差可以忽略
+    """
+
+    def __init__(self, window=10.0, slots=10, width=4096, depth=4):
+        self.slot_seconds = window / slots
+        self.slots = slots
+        self.width = width
+        self.depth = depth
+        size = width * depth
+        zeros = array("I", bytes(4 * size))
+        self._ring = [array("I", zeros) for _ in range(slots)]
+        # 每个时间片中计数不为0的位置
+        self._touched = [set() for _ in range(slots)]
+        self._total = array("I", zeros)
+        self._slot = int(time.monotonic() / self.slot_seconds)
+        self._lock = threading.Lock()
+
+    def _indexes(self, key):
+        h = hash(key)
+        h1 = h & 0xFFFFFFFF
+        h2 = ((h >> 32) & 0xFFFFFFFF) | 1
+        width = self.width
+        return [row * width + (h1 + row * h2) % width for row in range(self.depth)]
+
+    def _advance(self, now):
+        slot = int(now / self.slot_seconds)
+        if slot <= self._slot:
+            return
+        total = self._total
+        # 最多清空一整圈
+        for expired in range(max(self._slot + 1, slot - self.slots + 1), slot + 1):
+            bucket = self._ring[expired % self.slots]
+            touched = self._touched[expired % self.slots]
+            for index in touched:
+                total[index] -= bucket[index]
+                bucket[index] = 0
+            touched.clear()
+        self._slot = slot
+
+    def add(self, key, amount=1):
+        """给key计数并返回窗口内的估计次数（包括这一次）"""
+        indexes = self._indexes(key)
+        with self._lock:
+            self._advance(time.monotonic())
+            bucket = self._ring[self._slot % self.slots]
+            touched = self._touched[self._slot % self.slots]
+            total = self._total
+            # 保守更新：只把低于新估计值的计数补到新估计值，减少与其它key共用计数带来的偏大
+            count = min(total[index] for index in indexes) + amount
+            for index in indexes:
+                if total[index] < count:
+                    bucket[index] += count - total[index]
+                    total[index] = count
+                    touched.add(index)
+            return count
+
+    def estimate(self, key):
+        indexes = self._indexes(key)
+        with self._lock:
+            self._advance(time.monotonic())
+            return min(self._total[index] for index in indexes)
+
+    @property
+    def memory_bytes(self):
+        return (self.slots + 1) * self.width * self.depth * self._total.itemsize
+
+
+class FloodGuard:
+    """
+    入站刷屏检测，在消息进入处理队列之前丢弃超出频率的消息，不产生大模型调用（被丢弃的群消息仍由调用方检查违禁词）
+
+    - 每个用户window秒内最多user_limit条消息（群聊和私聊都算）
+    - 每个群window秒内最多group_limit次@机器人（@会触发大模型，普通消息只按概率自动回复）
+    - 被丢弃的消息同样计数，持续刷屏的用户会一直被限制，直到停下来超过window秒
+    - limit设为0时不限制
+    """
+
+    def __init__(self, sketch, user_limit=8, group_limit=20):
+        self.sketch = sketch
+        self.user_limit = user_limit
+        self.group_limit = group_limit
+        self.allowed = 0
+        self.dropped_user = 0
+        self.dropped_group = 0
+
+    @property
+    def enabled(self):
+        return self.user_limit > 0 or self.group_limit > 0
+
+    def allow(self, event):
+        """返回这条消息是否放行"""
+        if not self.enabled:
+            return True
+        if self.user_limit > 0 and self.sketch.add(("user", event.user_id)) > self.user_limit:
+            self.dropped_user += 1
+            FLOOD_DROPS.inc(scope="user")
+            logger.debug("用户 %s 发送消息过于频繁，丢弃", event.user_id)
+            return False
+        if (self.group_limit > 0 and event.message_type == "group" and event.is_at_bot
+                and self.sketch.add(("group", event.group_id)) > self.group_limit):
+            self.dropped_group += 1
+            FLOOD_DROPS.inc(scope="group")
+            logger.debug("群 %s 的@过于频繁，丢弃用户 %s 的消息", event.group_id, event.user_id)
+            return False
+        self.allowed += 1
+        return True
+
+    def get_stats(self):
+        return {
+            "enabled": self.enabled,
+            "window_seconds": self.sketch.slot_seconds * self.sketch.slots,
+            "user_limit": self.user_limit,
+            "group_limit": self.group_limit,
+            "memory_bytes": self.sketch.memory_bytes,
+            "allowed": self.allowed,
+            "dropped_user": self.dropped_user,
+            "dropped_group": self.dropped_group,
+        }
+
+
+# 创建全局实例，FLOOD_USER_LIMIT和FLOOD_GROUP_LIMIT都设为0时关闭
+flood_guard = FloodGuard(
+    SlidingSketch(
+        window=float(os.getenv("FLOOD_WINDOW", "10")),
+        width=int(os.getenv("FLOOD_SKETCH_WIDTH", "4096"))
+    ),
+    user_limit=int(os.getenv("FLOOD_USER_LIMIT", "8")),
+    group_limit=int(os.getenv("FLOOD_GROUP_LIMIT", "20"))
+)
@@ -1,62 +1,178 @@
-import os
-import openai
 import logging
-from collections import deque
 import time
-from prompts import prompt_mp
+import threading
+from prompts import prompt_registry
+from llm_router import create_router, DEFAULT_MODEL
+from context_builder import context_builder, make_history_entry, count_tokens
+from session_store import session_store
+from admission import admission_controller, AdmissionRejected, HIGH, NORMAL, LOW
+from metrics import (LLM_SECONDS, LLM_FIRST_CHUNK_SECONDS, LLM_ERRORS,
+                     LLM_PROMPT_TOKENS, LLM_COMPLETION_TOKENS)
 
 logger = logging.getLogger(__name__)
-# 修改cache_history为字典，每个会话ID对应一个deque队列，最大长度30
-cache_history = {}
-cache_time = {}
+
+# 大模型请求失败时返回的回复
+ERROR_REPLY = "抱歉，我现在无法回复，请稍后再试。"
+# 请求过多、被准入控制拒绝时返回的回复
+BUSY_REPLY = "当前提问的人太多了，请稍后再试。"
+
+# 句末标点，流式输出时在这些位置切分消息
+SENTENCE_ENDINGS = "。！？!?…～~；;"
+# 紧跟在句末标点后的引号、括号等，切分时保留在前一句
+CLOSING_MARKS = "”’」』）)】》\"'"
+
+class SentenceChunker:
+    """
+    把流式输出的文本按句子或换行切分成适合单独发送的片段
+
+    片段太短时会继续累积到下一个句末，太长时强制切分
+    """
+
+    def __init__(self, min_chars=10, max_chars=300):
+        self.min_chars = min_chars
+        self.max_chars = max_chars
+        self._buffer = ""
+        self._scan_pos = 0
+
+    def feed(self, text):
+        """追加文本，返回已经完整的片段列表"""
+        self._buffer += text
+        chunks = []
+        buffer = self._buffer
+        i = self._scan_pos
+        start = 0
+        while i < len(buffer):
+            ch = buffer[i]
+            if ch == "\n" or ch in SENTENCE_ENDINGS:
+                j = i + 1
+                while j < len(buffer) and (buffer[j] in SENTENCE_ENDINGS or buffer[j] in CLOSING_MARKS):
+                    j += 1
+                if j == len(buffer) and ch != "\n":
+                    # 后面可能还有标点或引号，等待更多文本
+                    break
+                if len(buffer[start:j].strip()) >= self.min_chars:
+                    chunks.append(buffer[start:j].strip())
+                    start = j
+                i = j
+                continue
+            if i + 1 - start >= self.max_chars:
+                chunks.append(buffer[start:i + 1].strip())
+                start = i + 1
+            i += 1
+        self._buffer = buffer[start:]
+        self._scan_pos = i - start
+        return [chunk for chunk in chunks if chunk]
+
+    def flush(self):
+        """返回剩余的文本"""
+        rest = self._buffer.strip()
+        self._buffer = ""
+        self._scan_pos = 0
+        return rest
+
+def _cached_prompt_tokens(usage):
+    """从usage中取出服务端前缀缓存命中的token数，不同服务商字段不同，没有返回None"""
+    # DeepSeek
+    cached = getattr(usage, "prompt_cache_hit_tokens", None)
+    if cached is not None:
+        return cached
+    # OpenAI
+    details = getattr(usage, "prompt_tokens_details", None)
+    if isinstance(details, dict):
+        return details.get("cached_tokens")
+    return getattr(details, "cached_tokens", None)
 
 class LLMClient:
     def __init__(self):
-        """初始化LLM客户端"""
-        try:
-            self.client = openai.OpenAI(
-                api_key=os.getenv("OPENAI_API_KEY"),
-                base_url=os.getenv("BASE_URL")
-            )
-            self.model = "deepseek-v3"
-            self.max_history_length = 38  # 最大记忆窗口长度
-            self.session_timeout = 15 * 60  # 15分钟，单位：秒
-            logger.info("LLM客户端初始化成功")
-        except Exception as e:
-            logger.error(f"LLM客户端初始化失败: {e}")
-            self.client = None
+        """初始化LLM客户端，后端在init_client()或第一次使用时才创建"""
+        self.model = DEFAULT_MODEL
+        self.session_timeout = session_store.ttl  # 默认15分钟，单位：秒
+        self._client = None
+        self._client_ready = False
+        self._client_lock = threading.Lock()
+        # 设置后，历史记录增长时通知它在后台把旧对话压缩成摘要
+        self.summarizer = None
+
+    def init_client(self):
+        """创建大模型后端，只执行一次；失败时client为None"""
+        if self._client_ready:
+            return
+        with self._client_lock:
+            if self._client_ready:
+                return
+            try:
+                # 可以配置多个OpenAI兼容后端（LLM_BACKENDS），慢请求自动对冲，失败的后端自动熔断
+                self._client = create_router()
+                logger.info("LLM客户端初始化成功，后端: %s", ", ".join(b.name for b in self._client.backends))
+            except Exception as e:
+                logger.error("LLM客户端初始化失败: %s", e)
+                self._client = None
+            self._client_ready = True
+
+    @property
+    def client(self):
+        self.init_client()
+        return self._client
     
     def _check_session_timeout(self, session_id):
         """检查会话是否超时，如果超时则清空历史记录"""
         current_time = time.time()
         
-        if session_id in cache_time:
-            last_time = cache_time[session_id]
-            time_diff = current_time - last_time
+        state = session_store.get(session_id)
+        if state is not None and state.last_active is not None:
+            time_diff = current_time - state.last_active
             
-            logger.info(f"会话 {session_id} 距离上次请求间隔: {time_diff:.1f} 秒")
+            logger.debug("会话 %s 距离上次请求间隔: %.1f 秒", session_id, time_diff)
             
             if time_diff > self.session_timeout:
-                logger.info(f"会话 {session_id} 超过15分钟未活跃，清空历史记录")
+                logger.info("会话 %s 超过%d秒未活跃，清空历史记录", session_id, self.session_timeout)
                 self.clear_history(session_id)
         
         # 更新当前会话的时间戳
-        cache_time[session_id] = current_time
-        logger.info(f"更新会话 {session_id} 时间戳: {current_time}")
-    
-    def _get_or_create_history(self, session_id):
-        """获取或创建会话历史"""
-        if session_id not in cache_history:
-            cache_history[session_id] = deque(maxlen=self.max_history_length)
-        return cache_history[session_id]
+        session_store.touch(session_id, current_time)
     
     def _add_to_history(self, session_id, role, content):
         """添加消息到历史记录"""
-        history = self._get_or_create_history(session_id)
-        history.append({"role": role, "content": content})
-        logger.info(f"会话 {session_id} 历史记录长度: {len(history)}")
+        length = session_store.append(session_id, make_history_entry(role, content))
+        logger.debug("会话 %s 历史记录长度: %d", session_id, length)
+        if self.summarizer is not None:
+            self.summarizer.notify(session_id, length)
     
-    def get_response(self, user_message, system_prompt=None, session_id=None, auto_reply=False):
+    def _create_completion(self, messages, stream=False, max_tokens=1000):
+        """调用大模型接口"""
+        return self.client.create(
+            messages,
+            temperature=1.0,
+            top_p=1.0,
+            max_tokens=max_tokens,
+            stream=stream
+        )
+    
+    def _stream_completion(self, messages, on_chunk):
+        """流式请求大模型，每凑够一句就调用on_chunk发送，返回完整回复"""
+        stream = self._create_completion(messages, stream=True)
+        chunker = SentenceChunker()
+        parts = []
+        try:
+            for event in stream:
+                if not event.choices:
+                    continue
+                delta = event.choices[0].delta.content
+                if not delta:
+                    continue
+                parts.append(delta)
+                for chunk in chunker.feed(delta):
+                    on_chunk(chunk)
+        finally:
+            # on_chunk出错时也关闭连接，否则流一直占用后端连接
+            stream.close()
+        rest = chunker.flush()
+        if rest:
+            on_chunk(rest)
+        return "".join(parts)
+    
+    def get_response(self, user_message, system_prompt=None, session_id=None, auto_reply=False, on_chunk=None,
+                     style_prompt=None, priority=None):
         """
         获取大模型回复
         
@@ -64,53 +180,83 @@ class LLMClient:
             user_message (str): 用户消息
             system_prompt (str, optional): 系统提示词
             session_id (str, optional): 会话ID，用于维护对话历史
+            on_chunk (Callable, optional): 传入时使用流式输出，每生成完整的一句就调用一次
+            style_prompt (StylePrompt, optional): 注册表中的风格，传入时使用其提示词和预先计算的token数，并记录使用统计
+            priority (int, optional): 准入优先级，默认自动回复为NORMAL，其他为HIGH
         
         Returns:
-            str: 大模型回复内容
+            str: 大模型回复内容（流式输出时为完整回复）；非最高优先级的请求被准入控制拒绝时返回None
         """
         if not self.client:
+            if on_chunk:
+                on_chunk("抱歉，大模型服务未正确初始化。")
             return "抱歉，大模型服务未正确初始化。"
+        
+        style_name = style_prompt.name if style_prompt is not None else "custom"
+        mode = "stream" if on_chunk else "block"
+        if priority is None:
+            priority = NORMAL if auto_reply else HIGH
+        start = time.perf_counter()
+        sent_any = False
+        if on_chunk:
+            user_on_chunk = on_chunk
+            def on_chunk(chunk):
+                nonlocal sent_any
+                if not sent_any:
+                    LLM_FIRST_CHUNK_SECONDS.observe(time.perf_counter() - start, style=style_name)
+                sent_any = True
+                user_on_chunk(chunk)
             
         try:
             # 如果有session_id，检查会话超时
             if session_id:
                 self._check_session_timeout(session_id)
             
-            messages = []
-            
-            # 添加系统提示词
-            if system_prompt:
-                messages.append({"role": "system", "content": system_prompt})
-            
-            # 如果有session_id，添加历史对话
-            if session_id:
-                history = self._get_or_create_history(session_id)
-                # 将历史对话添加到messages中
-                messages.extend(list(history))
-                logger.info(f"会话 {session_id} 加载了 {len(history)} 条历史记录")
             if auto_reply:
                 new_user_message = "(你的回答不得超过20个字,尽可能用一句话回答,尽可能贴近人类聊天可能会打的文本样式,不携带引号和星号的标识符)" + user_message
             else:
                 new_user_message = user_message
 
-            # 添加当前用户消息
-            messages.append({
-                "role": "user", 
-                "content": new_user_message
-            })
+            system_tokens = None
+            if style_prompt is not None:
+                system_prompt, system_tokens = style_prompt.content, style_prompt.tokens
             
-            logger.info(f"发送消息给大模型: {new_user_message}")
-            
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                temperature=1.0,
-                top_p=1.0,
-                max_tokens=1000
+            # 按token预算从新到旧选取历史对话，尽量保持与上次请求相同的起点以命中前缀缓存
+            history = session_store.get_history(session_id) if session_id else []
+            state = session_store.get(session_id) if session_id else None
+            anchor = state.context_anchor if state is not None else None
+            messages, prompt_tokens, history_used = context_builder.build(
+                system_prompt, history, new_user_message, system_tokens=system_tokens, anchor=anchor
             )
+            if session_id:
+                session_store.record_context(session_id, prompt_tokens, history[-history_used] if history_used else None)
+                logger.debug("会话 %s 使用了 %d/%d 条历史记录", session_id, history_used, len(history))
+            logger.debug("发送消息给大模型: %s", new_user_message)
             
-            reply = response.choices[0].message.content
-            logger.info(f"大模型回复: {reply}")
+            cached_tokens = None
+            completion_tokens = None
+            # 流式输出时并发名额一直占用到最后一个片段
+            with admission_controller.admit(session_id, priority):
+                call_start = time.perf_counter()
+                if on_chunk:
+                    reply = self._stream_completion(messages, on_chunk)
+                else:
+                    response = self._create_completion(messages)
+                    reply = response.choices[0].message.content
+                    if response.usage:
+                        cached_tokens = _cached_prompt_tokens(response.usage)
+                        completion_tokens = response.usage.completion_tokens
+                        logger.debug("服务端统计prompt tokens: %s，缓存命中: %s", response.usage.prompt_tokens, cached_tokens)
+            LLM_SECONDS.observe(time.perf_counter() - call_start, style=style_name, mode=mode)
+            LLM_PROMPT_TOKENS.observe(prompt_tokens, style=style_name)
+            LLM_COMPLETION_TOKENS.observe(
+                completion_tokens if completion_tokens is not None else count_tokens(reply), style=style_name)
+            if style_prompt is not None:
+                prompt_registry.record_usage(style_prompt.name, prompt_tokens, cached_tokens)
+            # 每次调用只输出一条汇总日志，回复内容在DEBUG级别
+            logger.info("会话 %s 大模型调用完成，prompt约 %d tokens（预算 %d），回复 %d 字",
+                        session_id, prompt_tokens, context_builder.token_budget, len(reply or ""))
+            logger.debug("大模型回复: %s", reply)
             
             # 如果有session_id，将用户消息和AI回复都保存到历史中
             if session_id:
@@ -119,11 +265,23 @@ class LLMClient:
             
             return reply
             
+        except AdmissionRejected as e:
+            logger.warning("会话 %s %s", session_id, e)
+            if priority != HIGH:
+                # 自动回复等低优先级请求直接放弃，由调用方决定是否降级
+                return None
+            if on_chunk and not sent_any:
+                user_on_chunk(BUSY_REPLY)
+            return BUSY_REPLY
         except Exception as e:
-            logger.error(f"大模型请求失败: {e}")
-            return "抱歉，我现在无法回复，请稍后再试。"
+            logger.error("大模型请求失败: %s", e)
+            LLM_ERRORS.inc(style=style_name, mode=mode)
+            # 流式输出已经发出部分内容时不再追加道歉
+            if on_chunk and not sent_any:
+                user_on_chunk(ERROR_REPLY)
+            return ERROR_REPLY
     
-    def get_chat_response(self, user_message, session_id=None, style="嘴臭",auto_reply=False):
+    def get_chat_response(self, user_message, session_id=None, style="嘴臭",auto_reply=False, on_chunk=None):
         """
         获取聊天回复（带默认人设和对话记忆）
         
@@ -131,29 +289,74 @@ class LLMClient:
             user_message (str): 用户消息
             session_id (str, optional): 会话ID，用于维护对话历史
             style (str): 使用的风格，默认为嘴臭
+            on_chunk (Callable, optional): 传入时使用流式输出，按句调用
             
         Returns:
-            str: 大模型回复
+            str: 大模型回复，自动回复被准入控制拒绝时返回None
         """
-        # 根据风格选择对应的prompt
-        system_prompt = prompt_mp.get(style, prompt_mp["嘴臭"])  # 如果风格不存在，使用默认嘴臭风格
-        logger.info(f"使用风格: {style}")
-        return self.get_response(user_message, system_prompt, session_id, auto_reply)
+        # 根据风格选择对应的prompt，如果风格不存在，使用默认嘴臭风格
+        style_prompt = prompt_registry.get_style(style)
+        logger.debug("使用风格: %s", style_prompt.name)
+        return self.get_response(user_message, session_id=session_id, auto_reply=auto_reply, on_chunk=on_chunk,
+                                 style_prompt=style_prompt)
+    
+    def record_exchange(self, session_id, user_message, reply):
+        """把没有经过大模型的一问一答（例如缓存命中的回复）记入会话历史"""
+        self._check_session_timeout(session_id)
+        self._add_to_history(session_id, "user", user_message)
+        self._add_to_history(session_id, "assistant", reply)
+    
+    def generate(self, user_message, style="嘴臭"):
+        """
+        不带对话记忆的单次生成，用于后台预生成等场景
+
+        与get_chat_response不同，失败时直接抛出异常而不是返回道歉文本；
+        以最低优先级申请准入，系统繁忙时抛出AdmissionRejected
+        """
+        if not self.client:
+            raise RuntimeError("大模型服务未正确初始化")
+        style_prompt = prompt_registry.get_style(style)
+        messages, prompt_tokens, _ = context_builder.build(style_prompt.content, [], user_message,
+                                                          system_tokens=style_prompt.tokens)
+        return self._background_completion(messages, prompt_tokens, style_prompt.name, "pool")
+
+    def summarize(self, messages, max_tokens=400):
+        """
+        生成对话摘要，用于后台压缩历史记录
+
+        与generate一样以最低优先级申请准入，失败时抛出异常
+        """
+        if not self.client:
+            raise RuntimeError("大模型服务未正确初始化")
+        prompt_tokens = sum(count_tokens(message["content"]) for message in messages)
+        return self._background_completion(messages, prompt_tokens, "summary", "summary", max_tokens)
+
+    def _background_completion(self, messages, prompt_tokens, style_name, mode, max_tokens=1000):
+        with admission_controller.admit(None, LOW):
+            start = time.perf_counter()
+            try:
+                response = self._create_completion(messages, max_tokens=max_tokens)
+            except Exception:
+                LLM_ERRORS.inc(style=style_name, mode=mode)
+                raise
+        LLM_SECONDS.observe(time.perf_counter() - start, style=style_name, mode=mode)
+        LLM_PROMPT_TOKENS.observe(prompt_tokens, style=style_name)
+        reply = response.choices[0].message.content
+        if not reply:
+            raise RuntimeError("大模型返回了空回复")
+        return reply
     
     def clear_history(self, session_id):
         """清空指定会话的历史记录"""
-        if session_id in cache_history:
-            cache_history[session_id].clear()
-            logger.info(f"已清空会话 {session_id} 的历史记录")
-        # 同时清空时间戳记录
-        if session_id in cache_time:
-            del cache_time[session_id]
-            logger.info(f"已清空会话 {session_id} 的时间戳记录")
+        # 历史记录和时间戳一起删除
+        if session_store.clear(session_id):
+            logger.info("已清空会话 %s 的历史记录", session_id)
     
     def get_history_length(self, session_id):
         """获取指定会话的历史记录长度"""
-        if session_id in cache_history:
-            return len(cache_history[session_id])
+        state = session_store.get(session_id)
+        if state is not None:
+            return len(state.history)
         return 0
     
     def get_session_info(self, session_id):
@@ -162,14 +365,17 @@ class LLMClient:
             "session_id": session_id,
             "history_length": self.get_history_length(session_id),
             "last_active_time": None,
-            "time_since_last_active": None
+            "time_since_last_active": None,
+            "last_prompt_tokens": None
         }
         
-        if session_id in cache_time:
-            last_time = cache_time[session_id]
+        state = session_store.get(session_id)
+        if state is not None and state.last_active is not None:
+            last_time = state.last_active
             current_time = time.time()
             info["last_active_time"] = last_time
             info["time_since_last_active"] = current_time - last_time
+            info["last_prompt_tokens"] = state.prompt_tokens
         
         return info
 
@@ -177,5 +383,5 @@ class LLMClient:
 try:
     llm_client = LLMClient()
 except Exception as e:
-    logger.error(f"创建LLM客户端实例失败: {e}")
+    logger.error("创建LLM客户端实例失败: %s", e)
     llm_client = None 
\ No newline at end of file
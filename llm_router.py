@@ -0,0 +1,386 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+from collections import deque
+import openai
+from admission import admission_controller, LOW
+from metrics import LLM_HEDGES, LLM_BACKEND_FAILURES
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL = os.getenv("LLM_MODEL", "deepseek-v3")
+
+
+class NoBackendAvailable(Exception):
+    """所有后端都处于熔断状态"""
+
+
+class LatencyTracker:
+    """记录最近若干次请求的耗时，用于计算分位数"""
+
+    def __init__(self, window=200):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, p, min_samples=10):
+        """样本数不足min_samples时返回None"""
+        with self._lock:
+            if len(self._samples) < min_samples:
+                return None
+            samples = sorted(self._samples)
+        return samples[min(len(samples) - 1, int(len(samples) * p / 100))]
+
+    def __len__(self):
+        return len(self._samples)
+
+
+class CircuitBreaker:
+    """
+    熔断器
+
+    连续失败failure_threshold次后打开，reset_timeout秒内跳过该后端；
+    之后进入半开状态放行一个试探请求，成功则恢复，失败则重新打开
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        # 半开状态下正在进行的试探请求的凭证
+        self._probe = None
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state(time.monotonic())
+
+    def _state(self, now):
+        if self._opened_at is None:
+            return self.CLOSED
+        if now - self._opened_at < self.reset_timeout:
+            return self.OPEN
+        return self.HALF_OPEN
+
+    def allow(self):
+        """
+        是否可以向该后端发送请求；半开状态只放行一个试探请求
+
+        Returns:
+            放行时返回凭证（真值），请求结束时传给record_success、record_failure或release；不放行返回None
+        """
+        with self._lock:
+            state = self._state(time.monotonic())
+            if state == self.CLOSED:
+                return True
+            if state == self.HALF_OPEN and self._probe is None:
+                self._probe = object()
+                return self._probe
+            return None
+
+    def _is_probe(self, ticket):
+        return self._probe is not None and ticket is self._probe
+
+    def record_success(self, ticket):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._probe = None
+
+    def record_failure(self, ticket):
+        with self._lock:
+            self._failures += 1
+            if self._is_probe(ticket):
+                self._opened_at = time.monotonic()
+                self._probe = None
+            elif self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+    def release(self, ticket):
+        """请求被取消或没有发出（既没有成功也没有失败）；只有试探请求才归还试探名额"""
+        with self._lock:
+            if self._is_probe(ticket):
+                self._probe = None
+
+
+class Backend:
+    """一个OpenAI兼容的后端"""
+
+    def __init__(self, name, base_url=None, api_key=None, model=DEFAULT_MODEL, timeout=60.0, max_retries=0,
+                 failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.model = model
+        self.client = openai.AsyncOpenAI(api_key=api_key, base_url=base_url, timeout=timeout,
+                                         max_retries=max_retries)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        # 非流式请求记录完整耗时，流式请求记录首个片段的耗时
+        self.latency = {False: LatencyTracker(), True: LatencyTracker()}
+        self.requests = 0
+        self.failures = 0
+        self.hedges_won = 0
+
+    def hedge_delay(self, stream, default):
+        """超过该后端的p95耗时仍未返回时发出对冲请求"""
+        p95 = self.latency[stream].percentile(95)
+        return default if p95 is None else p95
+
+    def get_stats(self):
+        stats = {"model": self.model, "state": self.breaker.state, "requests": self.requests,
+                 "failures": self.failures, "hedges_won": self.hedges_won}
+        for stream, label in ((False, "block"), (True, "stream_first_chunk")):
+            tracker = self.latency[stream]
+            p50, p95 = tracker.percentile(50, 1), tracker.percentile(95, 1)
+            stats[label] = {"samples": len(tracker),
+                            "p50_ms": round(p50 * 1000, 1) if p50 is not None else None,
+                            "p95_ms": round(p95 * 1000, 1) if p95 is not None else None}
+        return stats
+
+
+class _SyncStream:
+    """把后台事件循环中的异步流包装成同步迭代器"""
+
+    def __init__(self, router, stream, first_chunk):
+        self._router = router
+        self._stream = stream
+        self._pending = [first_chunk] if first_chunk is not None else []
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._pending:
+            return self._pending.pop()
+        if self._stream is None:
+            raise StopIteration
+        try:
+            return self._router._run(self._stream.__anext__())
+        except StopAsyncIteration:
+            self._stream = None
+            raise StopIteration
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        if self._stream is not None:
+            stream, self._stream = self._stream, None
+            self._router._run(stream.response.aclose())
+
+
+class LLMRouter:
+    """
+    多个OpenAI兼容后端之间的路由
+
+    - 每次请求优先发往可用后端中耗时最短的一个
+    - 请求超过该后端的p95耗时（流式请求为首个片段的p95）仍未返回时，向另一个后端发出对冲请求，
+      先返回的结果生效，另一个请求被取消；只有一个后端时不对冲
+    - 对冲请求按最低优先级额外占用准入控制的一个并发名额，容量不足时不发出
+    - 主请求失败时立即转发到下一个后端；连续失败的后端被熔断跳过
+    - 所有请求在一个后台事件循环线程中发出，调用方保持同步接口
+    """
+
+    def __init__(self, backends, hedge=True, default_hedge_delay=3.0, min_hedge_delay=0.2, admission=None):
+        if not backends:
+            raise ValueError("至少需要配置一个大模型后端")
+        self.backends = list(backends)
+        # 对同一个后端再发一次只会加重它的负担，只有一个后端时不对冲
+        self.hedge = hedge and len(self.backends) > 1
+        self.admission = admission
+        self.default_hedge_delay = default_hedge_delay
+        self.min_hedge_delay = min_hedge_delay
+        self._loop = None
+        self._loop_lock = threading.Lock()
+
+    def _ensure_loop(self):
+        if self._loop is None:
+            with self._loop_lock:
+                if self._loop is None:
+                    loop = asyncio.new_event_loop()
+                    threading.Thread(target=loop.run_forever, name="llm-router", daemon=True).start()
+                    self._loop = loop
+        return self._loop
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop()).result()
+
+    def _candidates(self, stream):
+        """按熔断状态和p50耗时排序的候选后端，没有耗时数据的后端排在前面以便获得样本"""
+        def sort_key(backend):
+            p50 = backend.latency[stream].percentile(50, 1)
+            return 0.0 if p50 is None else p50
+        return sorted(self.backends, key=sort_key)
+
+    def _next_backend(self, candidates, tried):
+        """
+        Returns:
+            tuple: (后端, 熔断器凭证)，没有可用的后端时返回(None, None)
+        """
+        for backend in candidates:
+            if backend not in tried:
+                ticket = backend.breaker.allow()
+                if ticket:
+                    return backend, ticket
+        return None, None
+
+    async def _attempt(self, backend, ticket, messages, stream, params):
+        """向一个后端发出请求；流式请求等到首个片段返回才算完成"""
+        backend.requests += 1
+        start = time.perf_counter()
+        response = None
+        try:
+            response = await backend.client.chat.completions.create(
+                model=backend.model, messages=messages, stream=stream, **params
+            )
+            if stream:
+                try:
+                    first_chunk = await response.__anext__()
+                except StopAsyncIteration:
+                    first_chunk = None
+                result = (response, first_chunk)
+            else:
+                result = response
+        except asyncio.CancelledError:
+            # 被取消的请求（对冲中落败的一方）至少耗时这么久，也计入样本，否则慢请求总被取消会让p95偏低
+            backend.latency[stream].record(time.perf_counter() - start)
+            if stream and response is not None:
+                await response.response.aclose()
+            backend.breaker.release(ticket)
+            raise
+        except Exception:
+            backend.failures += 1
+            backend.breaker.record_failure(ticket)
+            LLM_BACKEND_FAILURES.inc(backend=backend.name)
+            if stream and response is not None:
+                await response.response.aclose()
+            raise
+        backend.latency[stream].record(time.perf_counter() - start)
+        backend.breaker.record_success(ticket)
+        return result
+
+    async def _hedged(self, messages, stream, params):
+        candidates = self._candidates(stream)
+        primary, ticket = self._next_backend(candidates, ())
+        if primary is None:
+            raise NoBackendAvailable("所有大模型后端都处于熔断状态")
+        tried = [primary]
+        # task -> (后端, 是否为对冲请求)
+        tasks = {asyncio.ensure_future(self._attempt(primary, ticket, messages, stream, params)): (primary, False)}
+        hedge_delay = max(self.min_hedge_delay, primary.hedge_delay(stream, self.default_hedge_delay))
+        deadline = time.perf_counter() + hedge_delay if self.hedge else None
+        hedged = False
+        last_error = None
+
+        while tasks:
+            timeout = None if deadline is None else max(0.0, deadline - time.perf_counter())
+            done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+            if not done:
+                # 超过p95仍未返回，向另一个后端发出对冲请求
+                deadline = None
+                backend, ticket = self._next_backend(candidates, tried)
+                if backend is None:
+                    continue
+                if self.admission is not None and not self.admission.try_acquire(LOW):
+                    # 对冲请求是额外的并发，系统繁忙时不发，把容量留给新请求
+                    backend.breaker.release(ticket)
+                    LLM_HEDGES.inc(result="skipped")
+                    continue
+                hedged = True
+                tried.append(backend)
+                LLM_HEDGES.inc(result="sent")
+                task = asyncio.ensure_future(self._attempt(backend, ticket, messages, stream, params))
+                if self.admission is not None:
+                    task.add_done_callback(lambda _: self.admission.release())
+                tasks[task] = (backend, True)
+                continue
+
+            for task in done:
+                backend, is_hedge = tasks.pop(task)
+                if task.exception() is None:
+                    # 取消另一个请求，流式请求的连接在_attempt中关闭
+                    for pending in tasks:
+                        pending.cancel()
+                    if tasks:
+                        await asyncio.wait(tasks)
+                    if hedged:
+                        LLM_HEDGES.inc(result="hedge_won" if is_hedge else "primary_won")
+                        if is_hedge:
+                            backend.hedges_won += 1
+                    return task.result()
+                last_error = task.exception()
+                logger.warning(f"大模型后端 {backend.name} 请求失败: {last_error}")
+
+            if not tasks:
+                # 所有进行中的请求都失败了，立即转发到下一个可用后端
+                deadline = None
+                backend, ticket = self._next_backend(candidates, tried)
+                if backend is not None:
+                    tried.append(backend)
+                    tasks[asyncio.ensure_future(self._attempt(backend, ticket, messages, stream, params))] = (backend, False)
+        raise last_error
+
+    def create(self, messages, stream=False, **params):
+        """
+        发送chat completions请求
+
+        Returns:
+            非流式请求返回ChatCompletion；流式请求返回同步迭代的片段流
+        """
+        result = self._run(self._hedged(messages, stream, params))
+        if not stream:
+            return result
+        response, first_chunk = result
+        return _SyncStream(self, response, first_chunk)
+
+    def get_stats(self):
+        return {"hedge": self.hedge, "backends": {backend.name: backend.get_stats() for backend in self.backends}}
+
+
+def load_backends():
+    """
+    从环境变量读取后端配置
+
+    LLM_BACKENDS为JSON数组，例如：
+    [{"name": "deepseek", "base_url": "https://api.deepseek.com", "api_key_env": "DEEPSEEK_KEY", "model": "deepseek-chat"}]
+    没有配置时使用OPENAI_API_KEY、BASE_URL和LLM_MODEL组成单个后端
+    """
+    timeout = float(os.getenv("LLM_TIMEOUT", "60"))
+    config = os.getenv("LLM_BACKENDS")
+    if not config:
+        return [Backend("default", base_url=os.getenv("BASE_URL"), api_key=os.getenv("OPENAI_API_KEY"),
+                        model=DEFAULT_MODEL, timeout=timeout, max_retries=1)]
+    backends = []
+    for index, item in enumerate(json.loads(config)):
+        api_key = item.get("api_key") or os.getenv(item.get("api_key_env", "OPENAI_API_KEY"))
+        backends.append(Backend(
+            item.get("name") or f"backend{index}",
+            base_url=item.get("base_url"),
+            api_key=api_key,
+            model=item.get("model", DEFAULT_MODEL),
+            timeout=float(item.get("timeout", timeout)),
+            failure_threshold=int(item.get("failure_threshold", 5)),
+            reset_timeout=float(item.get("reset_timeout", 30)),
+        ))
+    return backends
+
+
+def create_router():
+    return LLMRouter(
+        load_backends(),
+        hedge=os.getenv("LLM_HEDGE", "1") == "1",
+        default_hedge_delay=float(os.getenv("LLM_HEDGE_DEFAULT_DELAY", "3")),
+        min_hedge_delay=float(os.getenv("LLM_HEDGE_MIN_DELAY", "0.2")),
+        admission=admission_controller
+    )
@@ -1,221 +1,428 @@
-import json
-import requests
+import os
+import time
 import random
+import threading
 from flask import Flask, request, jsonify
 import logging
-import colorlog
-from llm_client import llm_client
+from llm_client import llm_client, ERROR_REPLY
 from utils import (
     get_session_style, 
     parse_system_command, 
     handle_system_command,
-    ban_list,
-    handle_banned_user,
     probabilitys
 )
-from src.utils.logger import CustomColoredFormatter
+from src.utils.logger import setup_logging, LazyJson
 from api import api_bp
+from dispatcher import message_dispatcher, QueueFullError
+from cluster import worker_cluster
+from napcat_client import napcat_client, napcat_ws, NAPCAT_URL
+from ban_filter import ban_filter
+from moderation import moderation_queue
+from flood_guard import flood_guard
+from session_store import session_store
+from persistence import state_db
+from coalescer import MentionCoalescer, build_combined_prompt
+from reply_pool import diss_pool
+from reply_cache import reply_cache
+from prompts import prompt_registry
+from event_parser import parse_body, InvalidEvent
+from regular_dialog import ban, ban_fail
+from metrics import WEBHOOK_SECONDS, PROCESS_SECONDS, REPLY_TRIGGERS, ACTIVE_SESSIONS, QUEUE_DEPTH
+from readiness import readiness
+from serve import serve
 
-# 配置日志
-handler = colorlog.StreamHandler()
-handler.setFormatter(CustomColoredFormatter(
-    '%(message)s',  
-    datefmt='%Y-%m-%d %H:%M:%S,%f'[:-3]
-))
+logger = logging.getLogger(__name__)
 
-logger = colorlog.getLogger(__name__)
-logger.addHandler(handler)
-logger.setLevel(logging.INFO)
-
-app = Flask(__name__)
-
-# 注册API蓝图
-app.register_blueprint(api_bp)
-
-# napcat配置
-NAPCAT_HOST = "127.0.0.1"
-NAPCAT_PORT = 3000
-NAPCAT_URL = f"http://{NAPCAT_HOST}:{NAPCAT_PORT}"
+# 是否按句流式发送大模型回复
+STREAM_REPLY = os.getenv("STREAM_REPLY", "1") == "1"
+# 启动时最多等待预热（预生成禁言diss回复）的秒数，大模型不可用时超时后照常就绪
+WARMUP_TIMEOUT = float(os.getenv("WARMUP_TIMEOUT", "15"))
+# 停机时等待已接收的消息处理完的最长秒数
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "30"))
 
 def send_message(user_id=None, group_id=None, message=""):
     """发送消息到QQ"""
     try:
         if group_id:
             # 发送群消息
-            url = f"{NAPCAT_URL}/send_group_msg"
-            data = {
-                "group_id": group_id,
-                "message": message
-            }
+            response = napcat_client.send_group_msg(group_id, message)
         elif user_id:
             # 发送私聊消息
-            url = f"{NAPCAT_URL}/send_private_msg"
-            data = {
-                "user_id": user_id,
-                "message": message
-            }
+            response = napcat_client.send_private_msg(user_id, message)
         else:
             logger.error("必须指定user_id或group_id")
             return False
         
-        response = requests.post(url, json=data, timeout=10)
-        if response.status_code == 200:
-            logger.info(f"消息发送成功: {message}")
+        if response is not None and response.get("status") != "failed":
+            logger.info("消息发送成功: %s", message)
             return True
         else:
-            logger.error(f"消息发送失败: {response.status_code}")
+            logger.error("消息发送失败: %s", response)
             return False
     except Exception as e:
-        logger.error(f"发送消息时出错: {e}")
+        logger.error("发送消息时出错: %s", e)
         return False
 
-@app.route('/', methods=['POST'])
+def reply_with_llm(message_text, session_id, user_id=None, group_id=None, auto_reply=False,
+                   fallback=ERROR_REPLY, prefix=""):
+    """
+    使用大模型生成回复并发送
+
+    开启流式回复时（自动回复除外），每生成完整的一句就立即发送；
+    prefix会加在发出的第一条消息前面（例如@提问的群友）
+    """
+    pending_prefix = prefix
+
+    def send(text):
+        nonlocal pending_prefix
+        message, pending_prefix = pending_prefix + text, ""
+        send_message(user_id=user_id, group_id=group_id, message=message)
+
+    try:
+        if not llm_client:
+            send("抱歉，AI服务暂时不可用。")
+            return
+        # 获取当前会话的风格
+        current_style = get_session_style(session_id)
+        if STREAM_REPLY and not auto_reply:
+            llm_client.get_chat_response(message_text, session_id, current_style, on_chunk=send)
+        elif auto_reply:
+            # 常见的短消息优先使用缓存的回复
+            cached_reply = reply_cache.get(current_style, message_text, group_id)
+            if cached_reply:
+                llm_client.record_exchange(session_id, message_text, cached_reply)
+                send(cached_reply)
+                return
+            ai_reply = llm_client.get_chat_response(message_text, session_id, current_style, auto_reply=True)
+            if ai_reply is None:
+                # 系统繁忙，自动回复直接放弃
+                logger.info("系统繁忙，跳过会话 %s 的自动回复", session_id)
+                return
+            if ai_reply != ERROR_REPLY:
+                reply_cache.put(current_style, message_text, ai_reply, group_id)
+            send(ai_reply)
+        else:
+            ai_reply = llm_client.get_chat_response(message_text, session_id, current_style)
+            send(ai_reply)
+    except Exception as e:
+        logger.error("大模型调用失败: %s", e)
+        # 降级到默认回复
+        send(fallback)
+
+def reply_to_mentions(session_id, group_id, mentions):
+    """用一次大模型调用回复合并后的多条@消息"""
+    prompt = build_combined_prompt(mentions)
+    prefix = ""
+    if len(mentions) > 1:
+        user_ids = list(dict.fromkeys(mention.user_id for mention in mentions))
+        prefix = "".join(f"[CQ:at,qq={uid}]" for uid in user_ids) + " "
+    reply_with_llm(prompt, session_id, group_id=group_id, prefix=prefix)
+
+def flush_mentions(session_id, group_id, mentions):
+    """把（合并后的）@回复任务放回该会话的队列，保证会话内顺序"""
+    try:
+        message_dispatcher.submit(session_id, reply_to_mentions, session_id, group_id, mentions)
+    except QueueFullError as e:
+        logger.warning("消息队列已满，丢弃会话 %s 合并的 %d 条@消息: %s", session_id, len(mentions), e)
+
+# 同一群短时间内的多次@合并为一次回复，MENTION_COALESCE_MS设为0关闭
+mention_coalescer = MentionCoalescer(flush_mentions, window=int(os.getenv("MENTION_COALESCE_MS", "1500")) / 1000)
+
 def handle_message():
-    """处理从napcat接收到的消息"""
+    """接收napcat上报的事件，校验后放入后台队列并立即返回"""
+    start = time.perf_counter()
+    response = _handle_message()
+    status_code = response[1] if isinstance(response, tuple) else 200
+    result = {200: "ok", 400: "invalid", 503: "busy"}.get(status_code, "error")
+    WEBHOOK_SECONDS.observe(time.perf_counter() - start, result=result)
+    return response
+
+def ingest_event(raw):
+    """
+    解析一条上报事件并放入后台队列，HTTP上报和WebSocket上报共用
+
+    Raises:
+        InvalidEvent: 事件数据无效
+        QueueFullError: 队列已满
+    """
+    # 心跳、通知等非消息事件在解析JSON之前就直接返回，不记录日志
+    event = parse_body(raw)
+    if event is None:
+        return
+    # 刷屏的消息在进入队列之前丢弃，不产生大模型调用；丢弃前仍然检查违禁词，刷屏不能躲过禁言
+    if not flood_guard.allow(event):
+        moderate(event)
+        return
+    # 原始事件只在DEBUG级别按采样输出，序列化在日志线程中进行
+    logger.debug("收到消息: %s", LazyJson(event.raw), extra={"sample_key": "webhook"})
     try:
-        data = request.get_json()
-        logger.info(f"收到消息: {json.dumps(data, ensure_ascii=False, indent=2)}")
+        if worker_cluster is not None:
+            # 多进程模式：原始数据交给负责该会话的工作进程，由它重新解析并处理
+            worker_cluster.submit(event.session_id, "event", raw)
+        else:
+            message_dispatcher.submit(event.session_id, process_message, event)
+    except QueueFullError as e:
+        logger.warning("消息队列已满，拒绝会话 %s 的消息: %s", event.session_id, e)
+        raise
+
+def dispatch_event(raw):
+    """
+    工作进程中处理主进程转发过来的事件：只重新解析并放入本进程的处理队列
+
+    刷屏检测和被丢弃消息的违禁词检查已经在主进程完成，这里不再重复计数
+
+    Raises:
+        QueueFullError: 队列已满
+    """
+    event = parse_body(raw)
+    if event is not None:
+        message_dispatcher.submit(event.session_id, process_message, event)
+
+def moderate(event):
+    """
+    检查群消息中的违禁词，命中时记录违规，禁言和通知在后台进行，不影响这条消息接下来的处理
+
+    Returns:
+        bool: 是否命中违禁词
+    """
+    if event.message_type != 'group':
+        return False
+    banned_word = ban_filter.match(event.text)
+    if banned_word:
+        logger.info("用户 %s 触发违禁词: %s", event.user_id, banned_word)
+        moderation_queue.report(event.group_id, event.user_id, send_message)
+    return bool(banned_word)
+
+def _handle_message():
+    try:
+        ingest_event(request.get_data(cache=False))
+        return jsonify({"status": "ok"})
+    except InvalidEvent as e:
+        return jsonify({"status": "error", "message": f"无效的事件数据: {e}"}), 400
+    except QueueFullError as e:
+        return jsonify({"status": "busy", "message": str(e)}), 503
+    except Exception as e:
+        logger.error("处理消息时出错: %s", e)
+        return jsonify({"status": "error", "message": str(e)}), 500
+
+def process_message(event):
+    """在后台工作线程中处理一条消息事件"""
+    with PROCESS_SECONDS.time(message_type=event.message_type):
+        _process_message(event)
+
+def _process_message(event):
+    try:
+        user_id = event.user_id
+        session_id = event.session_id
+        message_text = event.text.strip()
+        logger.debug("机器人QQ号: %s，解析后的消息文本: %s，是否@机器人: %s", event.self_id, message_text, event.is_at_bot)
         
-        # 检查是否是消息事件
-        if data.get('post_type') == 'message':
-            message_type = data.get('message_type')
-            message = data.get('message', [])
-            user_id = data.get('user_id')
-            
-            # 获取机器人自己的QQ号
-            self_id = data.get('self_id')
-            
-            # 处理消息数组格式
-            message_text = ""
-            is_at_bot = False
-            
-            if isinstance(message, list):
-                # 消息是数组格式，需要解析
-                for msg_seg in message:
-                    if isinstance(msg_seg, dict):
-                        if msg_seg.get('type') == 'text':
-                            message_text += msg_seg.get('data', {}).get('text', '')
-                        elif msg_seg.get('type') == 'at':
-                            # 检查@的目标是否是机器人自己
-                            at_qq = msg_seg.get('data', {}).get('qq')
-                            if str(at_qq) == str(self_id):
-                                is_at_bot = True
-                                logger.info(f"检测到@机器人: {at_qq} == {self_id}")
-            elif isinstance(message, str):
-                # 消息是字符串格式
-                message_text = message
-                # 对于字符串格式，检查是否包含@机器人的CQ码
-                if self_id and f'[CQ:at,qq={self_id}]' in message:
-                    is_at_bot = True
-                elif message.strip().startswith('@'):
-                    # 简单的@检测（不够精确，建议使用数组格式）
-                    is_at_bot = True
+        if event.message_type == 'group':
+            # 群消息处理
+            group_id = event.group_id
+            # 检查用户发言是否包含违禁词
+            moderate(event)
             
-            logger.info(f"机器人QQ号: {self_id}")
-            logger.info(f"解析后的消息文本: {message_text}")
-            logger.info(f"是否@机器人: {is_at_bot}")
-            
-            if message_type == 'group':
-                # 群消息处理
-                group_id = data.get('group_id')
-                session_id = f"group_{group_id}"
-                # 检查用户发言是否包含ban_list中的关键字
-                message_lower = message_text.lower().replace(" ", "")
-                is_banned = any(banned_word in message_lower for banned_word in ban_list if banned_word.strip())
+            # 只有@机器人时才回复
+            if event.is_at_bot and message_text:
+                logger.info("机器人被@了，群号: %s, 用户: %s", group_id, user_id)
                 
-                if is_banned:
-                    handle_banned_user(NAPCAT_URL, group_id, user_id, send_message)
+                # 检查是否是系统命令
+                is_command, command, params = parse_system_command(message_text)
                 
-                # 只有@机器人时才回复
-                if is_at_bot and message_text.strip():
-                    logger.info(f"机器人被@了，群号: {group_id}, 用户: {user_id}")
-                    
-                    # 检查是否是系统命令
-                    is_command, command, params = parse_system_command(message_text.strip())
-                    
-                    
-                    if is_command:
-                        # 处理系统命令
-                        logger.info(f"检测到系统命令: {command} {params}")
-                        reply = handle_system_command(command, params, session_id)
-                        send_message(group_id=group_id, message=reply)
-                    else:
-                        # 使用大模型生成回复
-                        try:
-                            if llm_client:
-                                # 获取当前会话的风格
-                                current_style = get_session_style(session_id)
-                                ai_reply = llm_client.get_chat_response(message_text.strip(), session_id, current_style)
-                            else:
-                                ai_reply = "抱歉，AI服务暂时不可用。"
-                            send_message(group_id=group_id, message=ai_reply)
-                        except Exception as e:
-                            logger.error(f"大模型调用失败: {e}")
-                            # 降级到默认回复
-                            send_message(group_id=group_id, message="抱歉，我现在无法回复，请稍后再试。")
+                if is_command:
+                    # 处理系统命令
+                    logger.info("检测到系统命令: %s %s", command, params)
+                    REPLY_TRIGGERS.inc(trigger="command")
+                    reply = handle_system_command(command, params, session_id)
+                    send_message(group_id=group_id, message=reply)
+                elif mention_coalescer.enabled:
+                    REPLY_TRIGGERS.inc(trigger="mention")
+                    # 短时间内的多次@合并成一次大模型调用
+                    mention_coalescer.add(session_id, group_id, user_id, event.sender_name, message_text)
                 else:
-                    # 没有@机器人，但有5%概率自动回复
-                    if message_text.strip() and random.random() < probabilitys.get(session_id, 0.1):
-                        logger.info(f"触发5%概率自动回复，群号: {group_id}, 用户: {user_id}")
-                        session_id = f"group_{group_id}"
-                        
-                        # 使用大模型生成回复
-                        try:
-                            if llm_client:
-                                # 获取当前会话的风格
-                                current_style = get_session_style(session_id)
-                                ai_reply = llm_client.get_chat_response(message_text.strip(), session_id, current_style, auto_reply=True)
-                            else:
-                                ai_reply = "抱歉，AI服务暂时不可用。"
-                            send_message(group_id=group_id, message=ai_reply)
-                        except Exception as e:
-                            logger.error(f"大模型调用失败: {e}")
-                            # 降级到默认回复
-                            send_message(group_id=group_id, message="emmm...")
-                    else:
-                        logger.info(f"群消息但未@机器人或消息为空，忽略")
-                    
-            elif message_type == 'private':
-                # 私聊消息处理
-                logger.info(f"收到私聊消息，用户: {user_id}")
+                    REPLY_TRIGGERS.inc(trigger="mention")
+                    # 使用大模型生成回复
+                    reply_with_llm(message_text, session_id, group_id=group_id)
+            elif message_text and random.random() < probabilitys.get(session_id, 0.1):
+                # 没有@机器人，但按概率自动回复
+                logger.info("触发概率自动回复，群号: %s, 用户: %s", group_id, user_id)
+                REPLY_TRIGGERS.inc(trigger="auto")
+                reply_with_llm(message_text, session_id, group_id=group_id,
+                               auto_reply=True, fallback="emmm...")
+            else:
+                logger.debug("群消息但未@机器人或消息为空，忽略")
                 
-                if message_text.strip():
-                    # 检查是否是系统命令
-                    is_command, command, params = parse_system_command(message_text.strip())
-                    session_id = f"private_{user_id}"
-                    
-                    if is_command:
-                        # 处理系统命令
-                        logger.info(f"检测到系统命令: {command} {params}")
-                        reply = handle_system_command(command, params, session_id)
-                        send_message(user_id=user_id, message=reply)
-                    else:
-                        # 使用大模型生成回复
-                        try:
-                            if llm_client:
-                                # 获取当前会话的风格
-                                current_style = get_session_style(session_id)
-                                ai_reply = llm_client.get_chat_response(message_text.strip(), session_id, current_style)
-                            else:
-                                ai_reply = "抱歉，AI服务暂时不可用。"
-                            send_message(user_id=user_id, message=ai_reply)
-                        except Exception as e:
-                            logger.error(f"大模型调用失败: {e}")
-                            # 降级到默认回复
-                            send_message(user_id=user_id, message="抱歉，我现在无法回复，请稍后再试。")
-        
-        return jsonify({"status": "ok"})
+        elif event.message_type == 'private':
+            # 私聊消息处理
+            logger.info("收到私聊消息，用户: %s", user_id)
+            
+            if message_text:
+                # 检查是否是系统命令
+                is_command, command, params = parse_system_command(message_text)
+                
+                if is_command:
+                    # 处理系统命令
+                    logger.info("检测到系统命令: %s %s", command, params)
+                    REPLY_TRIGGERS.inc(trigger="command")
+                    reply = handle_system_command(command, params, session_id)
+                    send_message(user_id=user_id, message=reply)
+                else:
+                    REPLY_TRIGGERS.inc(trigger="private")
+                    # 使用大模型生成回复
+                    reply_with_llm(message_text, session_id, user_id=user_id)
         
     except Exception as e:
-        logger.error(f"处理消息时出错: {e}")
-        return jsonify({"status": "error", "message": str(e)}), 500
+        logger.error("处理消息时出错: %s", e)
+
+def clear_session(session_id):
+    """在负责该会话的工作进程中清空历史记录（多进程模式下由API转发过来）"""
+    message_dispatcher.submit(session_id, llm_client.clear_history, session_id)
+
+def import_session(payload):
+    """在负责该会话的工作进程中写入导入的会话（多进程模式下由导入接口转发过来）"""
+    session_id, history, last_active = payload
+    message_dispatcher.submit(session_id, session_store.import_session, session_id, history, last_active)
+
+def start_services():
+    """打开状态存储、创建大模型客户端，启动后台消息处理线程、违禁词和风格文件监控、超时会话清理和状态刷盘"""
+    if state_db:
+        state_db.start()
+    if llm_client:
+        llm_client.init_client()
+    message_dispatcher.start()
+    ban_filter.start_watching()
+    session_store.start_sweeper()
+    prompt_registry.start_watching()
+
+def warm_up(timeout=WARMUP_TIMEOUT):
+    """
+    预生成默认风格的禁言diss回复，等到各有一条回复、补充失败或超时为止
+
+    Returns:
+        bool: 是否预热成功
+    """
+    if os.getenv("DISS_POOL_PREWARM", "1") != "1":
+        return True
+    deadline = time.monotonic() + timeout
+    diss_pool.warm(ban, "嘴臭")
+    diss_pool.warm(ban_fail, "嘴臭")
+    warmed = all(diss_pool.wait_stocked(prompt, "嘴臭", max(0.0, deadline - time.monotonic()))
+                 for prompt in (ban, ban_fail))
+    if not warmed:
+        logger.warning("禁言diss回复预热未完成，回复池为空时使用默认回复")
+    return warmed
+
+def drain_services(timeout):
+    """
+    处理完已经接收的消息：先发出等待合并的@，再等待消息处理队列和禁言队列清空
+
+    Returns:
+        bool: 是否在timeout秒内全部处理完
+    """
+    deadline = time.monotonic() + timeout
+    mention_coalescer.flush_all()
+    message_dispatcher.stop_accepting()
+    drained = message_dispatcher.drain(timeout)
+    return moderation_queue.drain(max(0.0, deadline - time.monotonic())) and drained
+
+def start_worker():
+    """工作进程的初始化：只处理主进程分配过来的消息，不连接napcat的WebSocket；预热完成后才开始处理"""
+    setup_logging()
+    napcat_client.websocket = None
+    # 本进程的会话数和队列深度，随其他指标一起上报给主进程相加
+    ACTIVE_SESSIONS.set_function(lambda: len(session_store))
+    QUEUE_DEPTH.set_function(lambda: message_dispatcher.get_stats()["queue_depth"])
+    start_services()
+    warm_up()
+
+_app = None
+
+def create_app():
+    """
+    创建Flask应用并启动所有后台服务（日志、消息处理、工作进程、napcat WebSocket）
+
+    只在真正提供服务的进程中调用一次，重复调用返回同一个应用；
+    导入main模块本身不启动任何线程或进程，也不读取违禁词和风格文件、不打开状态存储、不创建大模型客户端
+
+    Returns:
+        Flask: WSGI应用
+    """
+    global _app
+    if _app is not None:
+        return _app
+    # 配置日志：后台线程输出，LOG_FORMAT=json时输出单行JSON
+    setup_logging()
+
+    app = Flask(__name__)
+    app.add_url_rule('/', view_func=handle_message, methods=['POST'])
+    # 注册API蓝图
+    app.register_blueprint(api_bp)
+
+    # 会话数和队列深度在抓取指标时读取（多进程模式下加上各工作进程上报的值）
+    ACTIVE_SESSIONS.set_function(lambda: len(session_store))
+    QUEUE_DEPTH.set_function(lambda: worker_cluster.queue_depth() if worker_cluster is not None
+                             else message_dispatcher.get_stats()["queue_depth"])
+
+    if worker_cluster is not None:
+        # 多进程模式：主进程只负责接收事件和API，消息由工作进程处理，工作进程各自预热
+        worker_cluster.start(start_worker, {"event": dispatch_event, "clear_history": clear_session,
+                                              "import_session": import_session}, teardown=drain_services)
+        readiness.add_check("workers", worker_cluster.ready)
+        # 主进程也检查被刷屏限制丢弃的消息中的违禁词
+        ban_filter.start_watching()
+        prompt_registry.start_watching()
+        if state_db:
+            state_db.start()
+    else:
+        start_services()
+        # 预热在后台进行，期间/ready返回503
+        warmed_up = threading.Event()
+
+        def run_warm_up():
+            try:
+                warm_up()
+            finally:
+                warmed_up.set()
+        threading.Thread(target=run_warm_up, name="warm-up", daemon=True).start()
+        readiness.add_check("warm_up", warmed_up.is_set)
+    # NAPCAT_TRANSPORT=ws时通过WebSocket长连接接收事件、发送动作
+    if napcat_ws is not None:
+        napcat_ws.on_event = ingest_event
+        napcat_ws.start()
+    _app = app
+    return app
+
+def shutdown(timeout=SHUTDOWN_TIMEOUT):
+    """
+    优雅停机：标记为未就绪，不再接收新消息，处理完已经接收的消息（包括正在生成的回复）后停止后台服务
+
+    Returns:
+        bool: 是否在timeout秒内全部处理完
+    """
+    readiness.set_draining()
+    if worker_cluster is not None:
+        deadline = time.monotonic() + timeout
+        drained = worker_cluster.stop(timeout)
+        # 主进程中只有被刷屏限制丢弃的消息触发的禁言
+        drained = moderation_queue.drain(max(0.0, deadline - time.monotonic())) and drained
+    else:
+        drained = drain_services(timeout)
+    # 处理消息时可能还要通过WebSocket发送回复，处理完再断开
+    if napcat_ws is not None:
+        napcat_ws.stop()
+    if state_db:
+        state_db.flush()
+    if drained:
+        logger.info("已处理完所有已接收的消息")
+    else:
+        logger.warning("停机超时（%s秒），仍有未处理完的消息", timeout)
+    return drained
 
 if __name__ == '__main__':
+    app = create_app()
     logger.info("启动QQ机器人...")
     logger.info("请确保napcat已启动并配置正确")
     logger.info("请设置环境变量 OPENAI_API_KEY 和 BASE_URL")
-    logger.info(f"Bot服务器启动在: http://0.0.0.0:5000")
-    logger.info(f"napcat地址: {NAPCAT_URL}")
-    
-    # 启动Flask应用
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    logger.info("napcat地址: %s", NAPCAT_URL)
+    serve(app, shutdown)
@@ -0,0 +1,270 @@
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+# 默认的耗时分桶（秒），覆盖从毫秒级的webhook处理到几十秒的大模型调用
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# token数分桶
+TOKEN_BUCKETS = (16, 32, 64, 128, 256, 512, 1000, 2000, 4000, 8000)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    type_name = ""
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"指标 {self.name} 需要标签 {self.labelnames}，实际为 {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _local_values(self):
+        with self._lock:
+            return {key: self._copy(value) for key, value in self._values.items()}
+
+    @staticmethod
+    def _copy(value):
+        return value
+
+    @staticmethod
+    def _add(total, value):
+        return total + value
+
+    def snapshot(self):
+        """本进程的当前值 {标签值: 值}，用于上报给主进程"""
+        return self._local_values()
+
+    def _merged_values(self, remote):
+        """本进程的值加上其他进程上报的值（同样的标签值相加）"""
+        values = self._local_values()
+        for snapshot in remote:
+            for key, value in snapshot.items():
+                values[key] = self._add(values[key], value) if key in values else self._copy(value)
+        return values
+
+    def _samples(self, values):
+        """返回 [(后缀, 标签值, 额外标签, 值)]"""
+        raise NotImplementedError
+
+    def render(self, remote=()):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.type_name}"]
+        for suffix, values, extra, value in self._samples(self._merged_values(remote)):
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, values, extra)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+
+    type_name = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self, values):
+        items = sorted(values.items())
+        if not items and not self.labelnames:
+            items = [((), 0)]
+        return [("_total" if not self.name.endswith("_total") else "", key, None, value) for key, value in items]
+
+
+class Gauge(_Metric):
+    """当前值，可以直接设置，也可以在抓取时通过回调读取"""
+
+    type_name = "gauge"
+
+    def __init__(self, name, help_text, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self._func = None
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, func):
+        """抓取时调用func()获取当前值（只用于没有标签的指标）"""
+        self._func = func
+
+    def _local_values(self):
+        if self._func is not None:
+            return {(): self._func()}
+        return super()._local_values()
+
+    def _samples(self, values):
+        return [("", key, None, value) for key, value in sorted(values.items())]
+
+
+class Histogram(_Metric):
+    """按分桶统计的分布，同时记录总和与次数"""
+
+    type_name = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [每个分桶的计数..., +Inf分桶的计数, 总和]
+                state = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            state[index] += 1
+            state[-1] += value
+
+    @staticmethod
+    def _copy(value):
+        return list(value)
+
+    @staticmethod
+    def _add(total, value):
+        return [a + b for a, b in zip(total, value)]
+
+    @contextmanager
+    def time(self, **labels):
+        """统计with块的耗时"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _samples(self, values):
+        items = sorted(values.items())
+        samples = []
+        for key, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), state[:-1]):
+                cumulative += count
+                samples.append(("_bucket", key, f'le="{_format_value(float(bound))}"', cumulative))
+            samples.append(("_sum", key, None, state[-1]))
+            samples.append(("_count", key, None, cumulative))
+        return samples
+
+
+class MetricsRegistry:
+    """
+    指标注册表，输出Prometheus文本格式
+
+    多进程模式下工作进程定期把snapshot()发给主进程，主进程用update_remote()保存，
+    输出时同名同标签的值相加：计数器和直方图是累计值，工作进程重启前的最后一份快照保留下来继续累加；
+    仪表盘（当前值）只累加仍在运行的进程
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._remote_lock = threading.Lock()
+        # 来源 -> (进程号, {指标名: 快照})
+        self._remote = {}
+        # 已经重启的工作进程最后一份快照的累加值（不含仪表盘）: {指标名: {标签值: 值}}
+        self._retired = {}
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help_text, labelnames=()):
+        return self.register(Counter(name, help_text, labelnames))
+
+    def gauge(self, name, help_text, labelnames=()):
+        return self.register(Gauge(name, help_text, labelnames))
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help_text, labelnames, buckets))
+
+    def snapshot(self):
+        return {metric.name: metric.snapshot() for metric in self._metrics}
+
+    def update_remote(self, source, pid, snapshot):
+        """保存其他进程上报的快照，同一来源换了进程号（工作进程重启过）时保留旧进程的累计值"""
+        with self._remote_lock:
+            previous = self._remote.get(source)
+            if previous is not None and previous[0] != pid:
+                for metric in self._metrics:
+                    if isinstance(metric, Gauge):
+                        continue
+                    retired = self._retired.setdefault(metric.name, {})
+                    for key, value in previous[1].get(metric.name, {}).items():
+                        retired[key] = metric._add(retired[key], value) if key in retired else metric._copy(value)
+            self._remote[source] = (pid, snapshot)
+
+    def render(self):
+        with self._remote_lock:
+            retired = {name: dict(values) for name, values in self._retired.items()}
+            remotes = [snapshot for _, snapshot in self._remote.values()] + [retired]
+        return "\n".join(metric.render([snapshot.get(metric.name, {}) for snapshot in remotes])
+                         for metric in self._metrics) + "\n"
+
+
+# 创建全局实例
+registry = MetricsRegistry()
+
+# 机器人各环节的指标
+WEBHOOK_SECONDS = registry.histogram(
+    "qqbot_webhook_seconds", "webhook请求从接收到返回的耗时", ["result"])
+PROCESS_SECONDS = registry.histogram(
+    "qqbot_message_process_seconds", "后台线程处理一条消息的总耗时", ["message_type"])
+REPLY_TRIGGERS = registry.counter(
+    "qqbot_reply_triggers_total", "触发回复的次数，按触发方式区分（mention/auto/private/command）", ["trigger"])
+LLM_SECONDS = registry.histogram(
+    "qqbot_llm_request_seconds", "大模型调用耗时", ["style", "mode"])
+LLM_FIRST_CHUNK_SECONDS = registry.histogram(
+    "qqbot_llm_first_chunk_seconds", "流式调用发出第一句的耗时", ["style"])
+LLM_ERRORS = registry.counter(
+    "qqbot_llm_errors_total", "大模型调用失败次数", ["style", "mode"])
+LLM_PROMPT_TOKENS = registry.histogram(
+    "qqbot_llm_prompt_tokens", "每次调用发送的prompt token数", ["style"], buckets=TOKEN_BUCKETS)
+LLM_COMPLETION_TOKENS = registry.histogram(
+    "qqbot_llm_completion_tokens", "每次调用生成的token数", ["style"], buckets=TOKEN_BUCKETS)
+LLM_HEDGES = registry.counter(
+    "qqbot_llm_hedges_total", "对冲请求次数（sent）、因并发不足未发出的次数（skipped）及最终由哪个请求胜出（primary_won/hedge_won）", ["result"])
+LLM_BACKEND_FAILURES = registry.counter(
+    "qqbot_llm_backend_failures_total", "各大模型后端的请求失败次数", ["backend"])
+LLM_ADMISSION_REJECTED = registry.counter(
+    "qqbot_llm_admission_rejected_total", "被准入控制拒绝的大模型调用次数", ["priority", "reason"])
+HISTORY_SUMMARIES = registry.counter(
+    "qqbot_history_summaries_total", "旧对话压缩为摘要的次数，按结果区分（ok/failed/skipped/stale）", ["result"])
+NAPCAT_SECONDS = registry.histogram(
+    "qqbot_napcat_request_seconds", "napcat动作调用耗时（包含重试）", ["action"])
+NAPCAT_FAILURES = registry.counter(
+    "qqbot_napcat_failures_total", "napcat动作最终失败的次数", ["action"])
+BAN_ACTIONS = registry.counter(
+    "qqbot_ban_actions_total", "违禁词禁言次数，按结果区分", ["result"])
+FLOOD_DROPS = registry.counter(
+    "qqbot_flood_drops_total", "因刷屏在入站时丢弃的消息数，按限制范围区分（user/group）", ["scope"])
+MODERATION_OFFENSES = registry.counter(
+    "qqbot_moderation_offenses_total", "触发违禁词的次数，按处理方式区分（queued/collapsed/dropped）", ["result"])
+ACTIVE_SESSIONS = registry.gauge(
+    "qqbot_active_sessions", "内存中的活跃会话数")
+QUEUE_DEPTH = registry.gauge(
+    "qqbot_queue_depth", "消息处理队列中等待的任务数")
@@ -0,0 +1,282 @@
+import os
+import math
+import time
+import random
+import logging
+import threading
+from collections import deque
+from typing import Callable
+from napcat_client import napcat_client
+from reply_pool import diss_pool
+from regular_dialog import ban, ban_fail
+from utils import get_session_style, user_ban_times
+from metrics import BAN_ACTIONS, MODERATION_OFFENSES
+
+logger = logging.getLogger(__name__)
+
+BAN_REPLY = "你已被禁言，请不要发送违禁词。"
+BAN_FAIL_REPLY = "你已被警告，请不要发送违禁词。"
+
+
+class OffenseTable:
+    """
+    按用户记录的违规分数，保存在状态存储中：重启后保留、随会话设置一起导出导入，多进程时各进程共用
+
+    - 每个用户保存为 [分数, 更新时间]（墙上时间），每次违规在存储中原子地衰减后加1分
+    - 分数按半衰期half_life秒指数衰减，读取时按距上次更新的时间计算，长时间不再违规的用户分数逐渐归零
+    - 定期清理：删除衰减到min_score以下的用户，超过max_users个用户时删除最久没有违规的用户
+    """
+
+    def __init__(self, scores, half_life=86400.0, max_users=10000, min_score=0.01, prune_interval=60.0):
+        self.scores = scores
+        self.half_life = half_life
+        self.max_users = max_users
+        self.min_score = min_score
+        self.prune_interval = prune_interval
+        self._last_prune = 0.0
+        self._prune_lock = threading.Lock()
+        self.evicted = 0
+
+    def _decayed(self, entry, now):
+        if not isinstance(entry, list):
+            # 旧版本保存的违规次数，从现在开始衰减
+            return float(entry)
+        score, updated = entry
+        if self.half_life <= 0:
+            return score
+        return score * 0.5 ** (max(0.0, now - updated) / self.half_life)
+
+    def add(self, user_id, amount=1.0):
+        """记录一次违规，返回衰减后加上amount的新分数"""
+        now = time.time()
+        entry = self.scores.update(
+            str(user_id), lambda entry: [(self._decayed(entry, now) if entry is not None else 0.0) + amount, now])
+        return entry[0]
+
+    def score(self, user_id):
+        entry = self.scores.get(str(user_id))
+        return self._decayed(entry, time.time()) if entry is not None else 0.0
+
+    def maybe_prune(self):
+        """距上次清理超过prune_interval秒时清理一次（在禁言线程中调用，不占用消息处理）"""
+        if time.monotonic() - self._last_prune < self.prune_interval or not self._prune_lock.acquire(False):
+            return
+        try:
+            self._last_prune = time.monotonic()
+            self.prune()
+        except Exception as e:
+            logger.error(f"清理违规分数时出错: {e}")
+        finally:
+            self._prune_lock.release()
+
+    def prune(self):
+        """删除分数已经衰减到可以忽略的用户，以及超出max_users的最久没有违规的用户，返回删除数量"""
+        now = time.time()
+        entries = []
+        for key, entry in self.scores.copy().items():
+            legacy = not isinstance(entry, list)
+            entries.append((now if legacy else entry[1], str(key), self._decayed(entry, now), legacy))
+        entries.sort()
+        overflow = len(entries) - self.max_users
+        removed = 0
+        for index, (updated, key, score, legacy) in enumerate(entries):
+            drop = index < overflow or score < self.min_score
+            if not drop and not legacy:
+                continue
+
+            def expire(entry, updated=updated, drop=drop):
+                if entry is None:
+                    return None
+                if not isinstance(entry, list):
+                    # 旧版本保存的违规次数，改成带时间的分数，从现在开始衰减
+                    return None if drop else [float(entry), now]
+                # 读取之后又有新的违规时保留
+                return None if drop and entry[1] <= updated else entry
+
+            if self.scores.update(key, expire) is None:
+                removed += 1
+        self.evicted += removed
+        if removed:
+            logger.info(f"清理了 {removed} 个用户的违规分数")
+        return removed
+
+    def __len__(self):
+        return len(self.scores)
+
+
+class _BanAction:
+    __slots__ = ("group_id", "user_id", "send_message_func", "collapsed")
+
+    def __init__(self, group_id, user_id, send_message_func):
+        self.group_id = group_id
+        self.user_id = user_id
+        self.send_message_func = send_message_func
+        # 合并到这次禁言的重复违规次数
+        self.collapsed = 0
+
+
+class ModerationQueue:
+    """
+    违禁词处理队列
+
+    - 处理消息时只把违规放入队列，计分（读写状态存储）、禁言、取diss回复和发送通知都在后台线程中进行，不阻塞回复
+    - 同一个用户在同一个群里raid_window秒内的重复违规合并为一次禁言和一条通知，只计一次违规分数
+    - 禁言时长 = base_duration * 违规分数（随时间衰减），取1到该值之间的随机秒数，不超过max_duration
+    - 队列最多积压max_pending个禁言，满了之后新的违规只计分不处理
+    """
+
+    def __init__(self, offenses, base_duration=30, max_duration=30 * 86400, raid_window=60.0, max_pending=1000):
+        self.offenses = offenses
+        self.base_duration = base_duration
+        self.max_duration = max_duration
+        self.raid_window = raid_window
+        self.max_pending = max_pending
+
+        self._lock = threading.Lock()
+        self._queue = deque()
+        # user_id -> 还没写入状态存储的违规分数，后台线程在禁言之前写入
+        self._scores = {}
+        # (group_id, user_id) -> (禁言动作, 合并窗口结束时间)
+        self._recent = {}
+        self._wakeup = threading.Event()
+        self._worker = None
+        # 正在执行的禁言数，drain时一起等待
+        self._running = 0
+
+        self.reported = 0
+        self.collapsed = 0
+        self.dropped = 0
+        self.banned = 0
+        self.failures = 0
+
+    def report(self, group_id, user_id, send_message_func: Callable):
+        """
+        记录一次违禁词，只放入队列，立即返回
+
+        Returns:
+            bool: 是否安排了新的禁言（被合并或队列已满时返回False）
+        """
+        key = (group_id, user_id)
+        now = time.monotonic()
+        with self._lock:
+            self.reported += 1
+            recent = self._recent.get(key)
+            if recent is not None and recent[1] > now:
+                recent[0].collapsed += 1
+                self.collapsed += 1
+                MODERATION_OFFENSES.inc(result="collapsed")
+                return False
+            # 队列满时也计分，之后的违规禁言更久；后台线程卡住时最多积压10000个用户的分数
+            if user_id in self._scores or len(self._scores) < 10000:
+                self._scores[user_id] = self._scores.get(user_id, 0.0) + 1.0
+            if len(self._queue) >= self.max_pending:
+                self.dropped += 1
+                drop = True
+            else:
+                drop = False
+                action = _BanAction(group_id, user_id, send_message_func)
+                if len(self._recent) > 10000:
+                    self._recent = {k: v for k, v in self._recent.items() if v[1] > now}
+                self._recent[key] = (action, now + self.raid_window)
+                self._queue.append(action)
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="moderation", daemon=True)
+                self._worker.start()
+        self._wakeup.set()
+        if drop:
+            MODERATION_OFFENSES.inc(result="dropped")
+            logger.warning(f"违禁词处理队列已满，未禁言群 {group_id} 的用户 {user_id}")
+            return False
+        MODERATION_OFFENSES.inc(result="queued")
+        return True
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            while True:
+                with self._lock:
+                    # 禁言动作入队时分数已经记在_scores中，先写入分数再禁言，禁言时长才包含这次违规
+                    scores, self._scores = self._scores, {}
+                    if not scores and not self._queue:
+                        self._wakeup.clear()
+                        break
+                    action = self._queue.popleft() if self._queue else None
+                    self._running += 1
+                try:
+                    self._record_offenses(scores)
+                    if action is not None:
+                        try:
+                            self._execute(action)
+                        except Exception as e:
+                            self.failures += 1
+                            logger.error(f"处理群 {action.group_id} 用户 {action.user_id} 的违禁词时出错: {e}")
+                finally:
+                    with self._lock:
+                        self._running -= 1
+            self.offenses.maybe_prune()
+
+    def _record_offenses(self, scores):
+        for user_id, amount in scores.items():
+            try:
+                self.offenses.add(user_id, amount)
+            except Exception as e:
+                self.failures += 1
+                logger.error(f"记录用户 {user_id} 的违规分数时出错: {e}")
+
+    def ban_duration(self, user_id):
+        limit = min(self.max_duration, max(1, math.ceil(self.base_duration * self.offenses.score(user_id))))
+        return random.randint(1, limit)
+
+    def _execute(self, action):
+        group_id, user_id = action.group_id, action.user_id
+        response = napcat_client.set_group_ban(group_id, user_id, self.ban_duration(user_id))
+        status = "failed" if response is None else response.get("status", "failed")
+        BAN_ACTIONS.inc(result="ok" if status == "ok" else "failed")
+
+        style = get_session_style(f"group_{group_id}")
+        if status == "ok":
+            self.banned += 1
+            logger.info(f"用户 {user_id} 已被禁言（合并了 {action.collapsed} 次重复违规）")
+            # diss回复从预生成的回复池中随机取出，不等待大模型；回复池为空时降级到默认回复
+            reply = diss_pool.get(ban, style) or BAN_REPLY
+        else:
+            self.failures += 1
+            logger.error(f"禁言失败: {status}")
+            reply = diss_pool.get(ban_fail, style) or BAN_FAIL_REPLY
+        action.send_message_func(group_id=group_id, message=reply)
+
+    def pending(self):
+        with self._lock:
+            return len(self._queue) + len(self._scores) + self._running
+
+    def drain(self, timeout):
+        """等待队列中的禁言处理完，返回是否在timeout秒内处理完"""
+        deadline = time.monotonic() + timeout
+        while self.pending():
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def get_stats(self):
+        return {
+            "pending": self.pending(),
+            "evicted_users": self.offenses.evicted,
+            "reported": self.reported,
+            "collapsed": self.collapsed,
+            "dropped": self.dropped,
+            "banned": self.banned,
+            "failures": self.failures,
+        }
+
+
+# 创建全局实例
+moderation_queue = ModerationQueue(
+    OffenseTable(
+        user_ban_times,
+        half_life=float(os.getenv("OFFENSE_HALF_LIFE", "86400")),
+        max_users=int(os.getenv("OFFENSE_MAX_USERS", "10000"))
+    ),
+    base_duration=int(os.getenv("BAN_BASE_DURATION", "30")),
+    raid_window=float(os.getenv("BAN_RAID_WINDOW", "60"))
+)
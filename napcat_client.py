@@ -0,0 +1,194 @@
+import os
+import time
+import random
+import asyncio
+import logging
+import requests
+import httpx
+from requests.adapters import HTTPAdapter
+from metrics import NAPCAT_SECONDS, NAPCAT_FAILURES
+from napcat_ws import NapCatWebSocket, NAPCAT_WS_URL
+
+logger = logging.getLogger(__name__)
+
+# napcat配置
+NAPCAT_URL = os.getenv("NAPCAT_URL", "http://127.0.0.1:3000")
+# 上报事件和发送动作的方式：http（默认）或ws（正向WebSocket长连接）
+NAPCAT_TRANSPORT = os.getenv("NAPCAT_TRANSPORT", "http")
+
+
+def _backoff_delay(attempt, base, cap):
+    """指数退避 + 全抖动"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+class NapCatClient:
+    """
+    napcat HTTP动作客户端
+
+    使用持久的连接池（keep-alive），对5xx和连接错误做带抖动的重试；
+    设置了WebSocket连接时动作优先通过长连接发送
+    """
+
+    def __init__(self, base_url=NAPCAT_URL, connect_timeout=3.0, read_timeout=10.0,
+                 max_retries=2, backoff_base=0.2, backoff_cap=2.0, pool_size=16, token=None):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if token:
+            self.session.headers["Authorization"] = f"Bearer {token}"
+        # 设置后动作优先通过WebSocket长连接发送，未连接时使用HTTP
+        self.websocket = None
+
+    def call_action(self, action, params):
+        """
+        调用napcat动作接口
+
+        Args:
+            action (str): 动作名，例如 send_group_msg
+            params (dict): 动作参数
+
+        Returns:
+            dict: napcat返回的JSON，失败时返回None
+        """
+        start = time.perf_counter()
+        result = None
+        sent = False
+        if self.websocket is not None and self.websocket.connected:
+            try:
+                result = self.websocket.call_action(action, params)
+                sent = True
+            except ConnectionError as e:
+                # 动作没有发出，改用HTTP发送
+                logger.warning(f"{e}，改用HTTP发送")
+        if not sent:
+            result = self._post_with_retries(action, params)
+        NAPCAT_SECONDS.observe(time.perf_counter() - start, action=action)
+        if result is None or result.get("status") == "failed":
+            NAPCAT_FAILURES.inc(action=action)
+        return result
+
+    def _post_with_retries(self, action, params):
+        url = f"{self.base_url}/{action}"
+        for attempt in range(self.max_retries + 1):
+            retryable = False
+            try:
+                response = self.session.post(url, json=params, timeout=self.timeout)
+                if response.status_code == 200:
+                    return response.json()
+                retryable = response.status_code >= 500
+                logger.error(f"napcat动作 {action} 失败: HTTP {response.status_code}")
+            except requests.ConnectionError as e:
+                # 包含连接超时；读超时时消息可能已经发出，不重试以免重复发送
+                retryable = True
+                logger.error(f"napcat动作 {action} 连接失败: {e}")
+            except requests.Timeout as e:
+                logger.error(f"napcat动作 {action} 超时: {e}")
+            except ValueError as e:
+                logger.error(f"napcat动作 {action} 返回了无效的JSON: {e}")
+
+            if not retryable or attempt >= self.max_retries:
+                break
+            time.sleep(_backoff_delay(attempt, self.backoff_base, self.backoff_cap))
+        return None
+
+    def attach_websocket(self, websocket):
+        """动作改为优先通过napcat的WebSocket长连接发送"""
+        self.websocket = websocket
+
+    def send_group_msg(self, group_id, message):
+        return self.call_action("send_group_msg", {"group_id": group_id, "message": message})
+
+    def send_private_msg(self, user_id, message):
+        return self.call_action("send_private_msg", {"user_id": user_id, "message": message})
+
+    def set_group_ban(self, group_id, user_id, duration):
+        return self.call_action("set_group_ban", {"group_id": group_id, "user_id": user_id, "duration": duration})
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncNapCatClient:
+    """napcat HTTP动作客户端的异步版本，接口与NapCatClient一致"""
+
+    def __init__(self, base_url=NAPCAT_URL, connect_timeout=3.0, read_timeout=10.0,
+                 max_retries=2, backoff_base=0.2, backoff_cap=2.0, pool_size=16, token=None):
+        self.base_url = base_url.rstrip("/")
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_cap = backoff_cap
+
+        headers = {"Authorization": f"Bearer {token}"} if token else None
+        self.client = httpx.AsyncClient(
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+            headers=headers
+        )
+
+    async def call_action(self, action, params):
+        start = time.perf_counter()
+        result = await self._post_with_retries(action, params)
+        NAPCAT_SECONDS.observe(time.perf_counter() - start, action=action)
+        if result is None or result.get("status") == "failed":
+            NAPCAT_FAILURES.inc(action=action)
+        return result
+
+    async def _post_with_retries(self, action, params):
+        url = f"{self.base_url}/{action}"
+        for attempt in range(self.max_retries + 1):
+            retryable = False
+            try:
+                response = await self.client.post(url, json=params)
+                if response.status_code == 200:
+                    return response.json()
+                retryable = response.status_code >= 500
+                logger.error(f"napcat动作 {action} 失败: HTTP {response.status_code}")
+            except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+                retryable = True
+                logger.error(f"napcat动作 {action} 连接失败: {e}")
+            except httpx.TransportError as e:
+                logger.error(f"napcat动作 {action} 请求失败: {e}")
+            except ValueError as e:
+                logger.error(f"napcat动作 {action} 返回了无效的JSON: {e}")
+
+            if not retryable or attempt >= self.max_retries:
+                break
+            await asyncio.sleep(_backoff_delay(attempt, self.backoff_base, self.backoff_cap))
+        return None
+
+    async def send_group_msg(self, group_id, message):
+        return await self.call_action("send_group_msg", {"group_id": group_id, "message": message})
+
+    async def send_private_msg(self, user_id, message):
+        return await self.call_action("send_private_msg", {"user_id": user_id, "message": message})
+
+    async def set_group_ban(self, group_id, user_id, duration):
+        return await self.call_action("set_group_ban", {"group_id": group_id, "user_id": user_id, "duration": duration})
+
+    async def aclose(self):
+        await self.client.aclose()
+
+
+# 创建全局实例
+napcat_client = NapCatClient(
+    NAPCAT_URL,
+    connect_timeout=float(os.getenv("NAPCAT_CONNECT_TIMEOUT", "3")),
+    read_timeout=float(os.getenv("NAPCAT_READ_TIMEOUT", "10")),
+    max_retries=int(os.getenv("NAPCAT_MAX_RETRIES", "2")),
+    token=os.getenv("NAPCAT_TOKEN") or None
+)
+
+# NAPCAT_TRANSPORT=ws时使用的WebSocket长连接，由main设置事件处理函数后启动
+napcat_ws = None
+if NAPCAT_TRANSPORT == "ws":
+    napcat_ws = NapCatWebSocket(NAPCAT_WS_URL, token=os.getenv("NAPCAT_TOKEN") or None,
+                                action_timeout=float(os.getenv("NAPCAT_READ_TIMEOUT", "10")))
+    napcat_client.attach_websocket(napcat_ws)
@@ -0,0 +1,195 @@
+import os
+import json
+import random
+import logging
+import threading
+import itertools
+
+try:
+    import websocket
+except ImportError:
+    # websocket-client是可选依赖，只有NAPCAT_TRANSPORT=ws时需要
+    websocket = None
+
+logger = logging.getLogger(__name__)
+
+NAPCAT_WS_URL = os.getenv("NAPCAT_WS_URL", "ws://127.0.0.1:3001")
+
+
+class _PendingAction:
+    __slots__ = ("event", "response")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.response = None
+
+
+class NapCatWebSocket:
+    """
+    与napcat之间的长连接（正向WebSocket）
+
+    - 同一个连接既接收上报事件，也发送动作；动作通过echo字段与响应对应
+    - 连接断开后按带抖动的指数退避自动重连，断开期间等待中的动作立即返回None
+    - 收到的事件原样（bytes）交给on_event，与HTTP上报走同一个处理入口
+    """
+
+    def __init__(self, url=NAPCAT_WS_URL, token=None, on_event=None, action_timeout=10.0,
+                 reconnect_base=0.5, reconnect_cap=30.0):
+        self.url = url
+        self.token = token
+        self.on_event = on_event
+        self.action_timeout = action_timeout
+        self.reconnect_base = reconnect_base
+        self.reconnect_cap = reconnect_cap
+
+        self._ws = None
+        self._send_lock = threading.Lock()
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._echo = itertools.count(1)
+        self._connected = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        self.events_received = 0
+        self.actions_sent = 0
+        self.action_timeouts = 0
+        self.reconnects = 0
+
+    @property
+    def connected(self):
+        return self._connected.is_set()
+
+    def start(self):
+        """启动后台连接线程，websocket-client未安装时返回False"""
+        if websocket is None:
+            logger.error("未安装websocket-client，无法使用WebSocket连接napcat，继续使用HTTP")
+            return False
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="napcat-ws", daemon=True)
+            self._thread.start()
+        return True
+
+    def stop(self):
+        self._stopped.set()
+        ws = self._ws
+        if ws is not None:
+            try:
+                ws.close()
+            except Exception:
+                pass
+
+    def wait_connected(self, timeout=None):
+        return self._connected.wait(timeout)
+
+    def _run(self):
+        attempt = 0
+        while not self._stopped.is_set():
+            try:
+                header = [f"Authorization: Bearer {self.token}"] if self.token else None
+                self._ws = websocket.create_connection(self.url, header=header, enable_multithread=True)
+                logger.info(f"已通过WebSocket连接napcat: {self.url}")
+                attempt = 0
+                self._connected.set()
+                self._receive_loop(self._ws)
+            except Exception as e:
+                if not self._stopped.is_set():
+                    # 重连失败只在第一次输出警告，避免napcat重启期间刷屏
+                    if attempt == 0:
+                        logger.warning(f"napcat WebSocket连接断开: {e}")
+                    else:
+                        logger.debug(f"napcat WebSocket重连失败: {e}")
+            finally:
+                self._connected.clear()
+                self._fail_pending()
+                if self._ws is not None:
+                    try:
+                        self._ws.close()
+                    except Exception:
+                        pass
+                    self._ws = None
+            if self._stopped.is_set():
+                break
+            self.reconnects += 1
+            delay = random.uniform(0, min(self.reconnect_cap, self.reconnect_base * (2 ** attempt)))
+            attempt += 1
+            self._stopped.wait(delay)
+
+    def _receive_loop(self, ws):
+        while not self._stopped.is_set():
+            raw = ws.recv()
+            if not raw:
+                raise ConnectionError("连接已关闭")
+            if isinstance(raw, str):
+                raw = raw.encode("utf-8")
+            # 动作响应带有echo，其余都是上报事件
+            if b'"echo"' in raw and self._resolve(raw):
+                continue
+            self.events_received += 1
+            if self.on_event is not None:
+                try:
+                    self.on_event(raw)
+                except Exception as e:
+                    logger.error(f"处理WebSocket事件失败: {e}")
+
+    def _resolve(self, raw):
+        try:
+            data = json.loads(raw)
+        except ValueError:
+            return False
+        if not isinstance(data, dict) or "post_type" in data:
+            return False
+        with self._pending_lock:
+            pending = self._pending.pop(str(data.get("echo")), None)
+        if pending is None:
+            return True
+        pending.response = data
+        pending.event.set()
+        return True
+
+    def _fail_pending(self):
+        with self._pending_lock:
+            pending, self._pending = self._pending, {}
+        for action in pending.values():
+            action.event.set()
+
+    def call_action(self, action, params, timeout=None):
+        """
+        通过WebSocket调用napcat动作
+
+        Returns:
+            dict: napcat返回的响应，等待超时返回None（动作可能已经执行，不应重试）
+
+        Raises:
+            ConnectionError: 未连接或发送失败，动作没有发出，可以改用HTTP发送
+        """
+        ws = self._ws
+        if ws is None or not self.connected:
+            raise ConnectionError("napcat WebSocket未连接")
+        echo = str(next(self._echo))
+        pending = _PendingAction()
+        with self._pending_lock:
+            self._pending[echo] = pending
+        payload = json.dumps({"action": action, "params": params, "echo": echo}, ensure_ascii=False)
+        try:
+            with self._send_lock:
+                ws.send(payload)
+            self.actions_sent += 1
+        except Exception as e:
+            with self._pending_lock:
+                self._pending.pop(echo, None)
+            raise ConnectionError(f"通过WebSocket发送napcat动作 {action} 失败: {e}")
+        if not pending.event.wait(self.action_timeout if timeout is None else timeout):
+            with self._pending_lock:
+                self._pending.pop(echo, None)
+            self.action_timeouts += 1
+            logger.error(f"napcat动作 {action} 等待响应超时")
+            return None
+        return pending.response
+
+    def get_stats(self):
+        with self._pending_lock:
+            pending = len(self._pending)
+        return {"url": self.url, "connected": self.connected, "pending_actions": pending,
+                "events_received": self.events_received, "actions_sent": self.actions_sent,
+                "action_timeouts": self.action_timeouts, "reconnects": self.reconnects}
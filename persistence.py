@@ -0,0 +1,790 @@
+import os
+import json
+import time
+import atexit
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+try:
+    import redis
+except ImportError:
+    # redis是可选依赖，只有STATE_BACKEND=redis时需要
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "bot_state.db"))
+# 状态存储：sqlite（默认）、redis 或 memory（不持久化）
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite")
+REDIS_URL = os.getenv("REDIS_URL", "redis://127.0.0.1:6379/0")
+# 每个设置命名空间在内存中最多缓存的条目数
+SETTINGS_CACHE_SIZE = int(os.getenv("SETTINGS_CACHE_SIZE", "10000"))
+
+# 待写入队列中的标记：会话有变化，刷盘时再从会话存储取最新内容
+_DIRTY = object()
+_MISSING = object()
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    history TEXT NOT NULL,
+    last_active REAL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS settings (
+    namespace TEXT NOT NULL,
+    key TEXT NOT NULL,
+    value TEXT NOT NULL,
+    PRIMARY KEY (namespace, key)
+);
+CREATE INDEX IF NOT EXISTS sessions_last_active ON sessions (last_active);
+"""
+
+
+def _session_row(session_id, history, last_active):
+    """(session_id, 历史条数, 最后活跃时间, 最后一条对话内容)，与SessionStore.iter_sessions一致"""
+    last = history[-1] if history else None
+    last_message = last["content"] if last is not None and not last.get("summary") else None
+    return session_id, len(history), last_active, last_message
+
+
+class StateBackend:
+    """
+    状态持久化的公共部分：写入先进入内存队列，由后台线程批量刷盘，不阻塞消息处理
+
+    - 同一个key在两次刷盘之间的多次修改只写最后一次
+    - 会话在第一次访问时才从存储中加载
+    - shared为True时（多个进程共用同一个存储），设置直接写入存储，不经过待写入队列，
+      PersistentDict也不在本进程缓存设置，保证各进程读到的一致
+
+    - 创建时不访问磁盘或网络，open()（第一次读写时自动调用）才建立连接
+
+    子类实现 _open、_read_session、_read_setting、_read_settings、_write_batch、_incr、_update、_expire_sessions、
+    _close 和 iter_session_data
+    """
+
+    name = ""
+
+    def __init__(self, flush_interval=1.0, batch_size=500, shared=False):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.shared = shared
+        # 刷盘时获取会话最新内容的回调: session_id -> (history, last_active) 或 None
+        self.session_source = None
+
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        # ("session", session_id) 或 ("setting", namespace, key) -> 待写入的值，None表示删除
+        self._pending = {}
+        # 正在写入存储的批次，写入完成前存储中还是旧内容，读取时也要先查这里
+        self._flushing = {}
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._flusher = None
+        self._opened = False
+        self._open_lock = threading.Lock()
+
+        self.flushes = 0
+        self.rows_written = 0
+
+    def open(self):
+        """打开存储，重复调用没有影响"""
+        if self._opened:
+            return
+        with self._open_lock:
+            if not self._opened:
+                self._open()
+                self._opened = True
+
+    def start(self):
+        """打开存储并启动后台刷盘线程"""
+        self.open()
+        if self._flusher is not None:
+            return
+        self._flusher = threading.Thread(target=self._flush_loop, name="state-db-flusher", daemon=True)
+        self._flusher.start()
+        logger.info(f"状态存储已启动: {self.describe()}")
+
+    def describe(self):
+        return self.name
+
+    def _pending_value(self, key):
+        """待写入队列或正在写入的批次中的值，都没有返回_MISSING"""
+        with self._lock:
+            value = self._pending.get(key, _MISSING)
+            if value is _MISSING:
+                value = self._flushing.get(key, _MISSING)
+        return value
+
+    def _enqueue(self, key, value):
+        with self._lock:
+            self._pending[key] = value
+            if len(self._pending) >= self.batch_size:
+                self._wakeup.set()
+
+    # ---- 会话 ----
+
+    def mark_session_dirty(self, session_id):
+        """会话有变化，刷盘时通过session_source获取最新内容"""
+        self._enqueue(("session", session_id), _DIRTY)
+
+    def save_session(self, session_id, history, last_active):
+        """直接保存会话内容（用于会话即将从内存中淘汰的情况）"""
+        self._enqueue(("session", session_id), (list(history), last_active))
+
+    def delete_session(self, session_id):
+        self._enqueue(("session", session_id), None)
+
+    def load_session(self, session_id):
+        """
+        加载会话
+
+        Returns:
+            tuple: (history, last_active)，不存在返回None
+        """
+        pending = self._pending_value(("session", session_id))
+        if pending is None:
+            return None
+        if pending is not _MISSING and pending is not _DIRTY:
+            return pending
+        return self._read_session(session_id)
+
+    def expire_sessions(self, before):
+        """
+        删除存储中最后活跃时间早于before的会话（包括已经从内存中淘汰、不会再被内存清理扫到的会话）
+
+        Returns:
+            int: 删除的会话数
+        """
+        with self._write_lock:
+            expired = self._expire_sessions(before)
+        self.rows_written += expired
+        return expired
+
+    # ---- 设置（风格、概率、计数等） ----
+
+    def set_setting(self, namespace, key, value):
+        if self.shared:
+            self._write_through([(namespace, str(key), json.dumps(value, ensure_ascii=False))], [])
+        else:
+            self._enqueue(("setting", namespace, str(key)), value)
+
+    def delete_setting(self, namespace, key):
+        if self.shared:
+            self._write_through([], [(namespace, str(key))])
+        else:
+            self._enqueue(("setting", namespace, str(key)), None)
+
+    def incr_setting(self, namespace, key, amount=1):
+        """原子地给数值设置加上amount（不存在时从0开始），返回加之后的值"""
+        with self._write_lock:
+            return self._incr(namespace, str(key), amount)
+
+    def update_setting(self, namespace, key, func):
+        """
+        原子地读改写一个设置（用于多进程共享的存储）：新值 = func(旧值)，不存在时旧值为None，
+        func返回None时删除该设置
+
+        Returns:
+            新值
+        """
+        with self._write_lock:
+            return self._update(namespace, str(key), func)
+
+    def load_setting(self, namespace, key):
+        """加载单个设置，不存在返回_MISSING"""
+        pending = self._pending_value(("setting", namespace, str(key)))
+        if pending is None:
+            return _MISSING
+        if pending is not _MISSING:
+            return pending
+        return self._read_setting(namespace, str(key))
+
+    def load_settings(self, namespace):
+        """加载某个命名空间下的所有设置"""
+        result = self._read_settings(namespace)
+        with self._lock:
+            # 先合并正在写入的批次，再合并更新的待写入队列
+            items = list(self._flushing.items()) + list(self._pending.items())
+            for pending_key, value in items:
+                if pending_key[0] == "setting" and pending_key[1] == namespace:
+                    if value is None:
+                        result.pop(pending_key[2], None)
+                    else:
+                        result[pending_key[2]] = value
+        return result
+
+    def iter_sessions(self, after=None, prefix=None, batch=256):
+        """
+        按session_id顺序遍历已写入存储的会话，参数与iter_session_data相同
+
+        Yields:
+            tuple: (session_id, 历史条数, 最后活跃时间, 最后一条对话内容)，与SessionStore.iter_sessions一致
+        """
+        for session_id, history, last_active in self.iter_session_data(after, prefix, batch):
+            yield _session_row(session_id, history, last_active)
+
+    def _write_through(self, setting_rows, setting_deletes):
+        with self._write_lock:
+            self._write_batch([], [], setting_rows, setting_deletes)
+        self.rows_written += len(setting_rows) + len(setting_deletes)
+
+    # ---- 刷盘 ----
+
+    def flush(self):
+        """把待写入队列中的修改批量写入存储，返回写入行数"""
+        # 整个刷盘过程持有写锁，保证先取出的批次先写入
+        with self._write_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                self._flushing = pending
+            if not pending:
+                return 0
+
+            session_rows, session_deletes = [], []
+            setting_rows, setting_deletes = [], []
+            now = time.time()
+            for key, value in pending.items():
+                if key[0] == "session":
+                    session_id = key[1]
+                    if value is _DIRTY:
+                        value = self.session_source(session_id) if self.session_source else None
+                        if value is None:
+                            # 刷盘前会话已经不在内存中（淘汰时会单独保存），跳过
+                            continue
+                    if value is None:
+                        session_deletes.append(session_id)
+                    else:
+                        history, last_active = value
+                        session_rows.append((session_id, json.dumps(history, ensure_ascii=False), last_active, now))
+                else:
+                    _, namespace, setting_key = key
+                    if value is None:
+                        setting_deletes.append((namespace, setting_key))
+                    else:
+                        setting_rows.append((namespace, setting_key, json.dumps(value, ensure_ascii=False)))
+
+            try:
+                self._write_batch(session_rows, session_deletes, setting_rows, setting_deletes)
+            except Exception:
+                # 写入失败时放回队列，下次重试（不覆盖期间的新修改）
+                with self._lock:
+                    for key, value in pending.items():
+                        self._pending.setdefault(key, value)
+                raise
+            finally:
+                with self._lock:
+                    self._flushing = {}
+
+        written = len(session_rows) + len(session_deletes) + len(setting_rows) + len(setting_deletes)
+        self.flushes += 1
+        self.rows_written += written
+        return written
+
+    def _flush_loop(self):
+        while not self._stop.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"状态存储刷盘失败: {e}")
+
+    def close(self):
+        """停止后台线程并把剩余修改写入存储"""
+        self._stop.set()
+        self._wakeup.set()
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error(f"关闭状态存储时刷盘失败: {e}")
+        if self._opened:
+            self._close()
+
+    def get_stats(self):
+        with self._lock:
+            pending = len(self._pending)
+        return {"backend": self.name, "location": self.describe(), "shared": self.shared,
+                "pending_writes": pending, "flushes": self.flushes, "rows_written": self.rows_written}
+
+
+class StateDB(StateBackend):
+    """基于SQLite（WAL模式）的状态存储，同一台机器上的多个进程可以共用一个数据库文件"""
+
+    name = "sqlite"
+
+    def __init__(self, path=STATE_DB_PATH, flush_interval=1.0, batch_size=500, shared=False):
+        super().__init__(flush_interval, batch_size, shared)
+        self.path = path
+        self._write_db = None
+        self._read_db = None
+        self._read_lock = threading.Lock()
+
+    def _open(self):
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._write_db = self._connect(self.path)
+            self._write_db.executescript(_SCHEMA)
+            self._read_db = self._connect(self.path)
+        except Exception as e:
+            logger.error(f"打开状态数据库 {self.path} 失败，状态将只保存在内存中: {e}")
+            # 内存数据库只能通过同一个连接访问，读写共用
+            self.path = ":memory:"
+            self._write_db = self._read_db = self._connect(self.path)
+            self._write_db.executescript(_SCHEMA)
+
+    @staticmethod
+    def _connect(path):
+        conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    @property
+    def _write_conn(self):
+        self.open()
+        return self._write_db
+
+    @property
+    def _read_conn(self):
+        self.open()
+        return self._read_db
+
+    def describe(self):
+        return self.path
+
+    def _read_session(self, session_id):
+        with self._read_lock:
+            row = self._read_conn.execute(
+                "SELECT history, last_active FROM sessions WHERE session_id = ?", (session_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        return json.loads(row[0]), row[1]
+
+    def iter_session_data(self, after=None, prefix=None, batch=256):
+        """
+        按session_id顺序遍历已写入数据库的会话（尚未刷盘的修改不包含在内），每次只读取batch个
+
+        Yields:
+            tuple: (session_id, 历史记录, 最后活跃时间)
+        """
+        cursor = after if after is not None else ""
+        lower = prefix or ""
+        # 以prefix开头的字符串都小于prefix后面接最大的字符
+        upper = (prefix or "") + "\U0010ffff"
+        while True:
+            with self._read_lock:
+                rows = self._read_conn.execute(
+                    "SELECT session_id, history, last_active FROM sessions "
+                    "WHERE session_id > ? AND session_id >= ? AND session_id < ? ORDER BY session_id LIMIT ?",
+                    (cursor, lower, upper, batch)
+                ).fetchall()
+            for session_id, history, last_active in rows:
+                yield session_id, json.loads(history), last_active
+            if len(rows) < batch:
+                return
+            cursor = rows[-1][0]
+
+    def _read_setting(self, namespace, key):
+        with self._read_lock:
+            row = self._read_conn.execute(
+                "SELECT value FROM settings WHERE namespace = ? AND key = ?", (namespace, key)
+            ).fetchone()
+        return json.loads(row[0]) if row is not None else _MISSING
+
+    def _read_settings(self, namespace):
+        with self._read_lock:
+            rows = self._read_conn.execute(
+                "SELECT key, value FROM settings WHERE namespace = ?", (namespace,)
+            ).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def _write_batch(self, session_rows, session_deletes, setting_rows, setting_deletes):
+        conn = self._write_conn
+        conn.execute("BEGIN")
+        try:
+            if session_rows:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO sessions (session_id, history, last_active, updated_at) VALUES (?, ?, ?, ?)",
+                    session_rows
+                )
+            if session_deletes:
+                conn.executemany("DELETE FROM sessions WHERE session_id = ?", [(s,) for s in session_deletes])
+            if setting_rows:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO settings (namespace, key, value) VALUES (?, ?, ?)", setting_rows
+                )
+            if setting_deletes:
+                conn.executemany("DELETE FROM settings WHERE namespace = ? AND key = ?", setting_deletes)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _incr(self, namespace, key, amount):
+        conn = self._write_conn
+        # IMMEDIATE事务在读之前就拿到写锁，其他进程的自增会等待
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT value FROM settings WHERE namespace = ? AND key = ?", (namespace, key)
+            ).fetchone()
+            value = (json.loads(row[0]) if row is not None else 0) + amount
+            conn.execute(
+                "INSERT OR REPLACE INTO settings (namespace, key, value) VALUES (?, ?, ?)",
+                (namespace, key, json.dumps(value))
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return value
+
+    def _update(self, namespace, key, func):
+        conn = self._write_conn
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                "SELECT value FROM settings WHERE namespace = ? AND key = ?", (namespace, key)
+            ).fetchone()
+            value = func(json.loads(row[0]) if row is not None else None)
+            if value is None:
+                conn.execute("DELETE FROM settings WHERE namespace = ? AND key = ?", (namespace, key))
+            else:
+                conn.execute(
+                    "INSERT OR REPLACE INTO settings (namespace, key, value) VALUES (?, ?, ?)",
+                    (namespace, key, json.dumps(value, ensure_ascii=False))
+                )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return value
+
+    def _expire_sessions(self, before):
+        return self._write_conn.execute("DELETE FROM sessions WHERE last_active < ?", (before,)).rowcount
+
+    def _close(self):
+        self._write_db.close()
+        self._read_db.close()
+
+
+class RedisStateDB(StateBackend):
+    """
+    基于Redis的状态存储，可以跨机器共享（需要安装redis）
+
+    会话保存为 {prefix}:session:{session_id} 哈希（history、last_active），
+    设置保存为 {prefix}:settings:{namespace} 哈希，值均为JSON
+    """
+
+    name = "redis"
+
+    def __init__(self, url=REDIS_URL, prefix="qqbot", flush_interval=1.0, batch_size=500):
+        if redis is None:
+            raise RuntimeError("未安装redis，无法使用Redis状态存储")
+        # Redis本身就是多进程共享的
+        super().__init__(flush_interval, batch_size, shared=True)
+        self.url = url
+        self.prefix = prefix
+        self._redis = None
+        # 所有会话ID的有序集合（分数都为0，按字典序排列），用于分页遍历
+        self._index_key = f"{prefix}:sessions"
+        # 按最后活跃时间排序的会话ID，用于清理超时会话
+        self._active_key = f"{prefix}:sessions:active"
+
+    def _open(self):
+        client = redis.Redis.from_url(self.url)
+        client.ping()
+        self._redis = client
+
+    @property
+    def _client(self):
+        self.open()
+        return self._redis
+
+    def describe(self):
+        return self.url
+
+    def _session_key(self, session_id):
+        return f"{self.prefix}:session:{session_id}"
+
+    def _settings_key(self, namespace):
+        return f"{self.prefix}:settings:{namespace}"
+
+    def _read_session(self, session_id):
+        history, last_active = self._client.hmget(self._session_key(session_id), "history", "last_active")
+        if history is None:
+            return None
+        return json.loads(history), float(last_active) if last_active else None
+
+    def iter_session_data(self, after=None, prefix=None, batch=256):
+        """按session_id顺序遍历已写入Redis的会话，参数和返回值与StateDB.iter_session_data相同"""
+        lower = "-"
+        if prefix:
+            lower = f"[{prefix}"
+        if after is not None and (not prefix or after >= prefix):
+            lower = f"({after}"
+        upper = f"[{prefix}\U0010ffff" if prefix else "+"
+        while True:
+            ids = [session_id.decode("utf-8") for session_id in
+                   self._client.zrangebylex(self._index_key, lower, upper, start=0, num=batch)]
+            if not ids:
+                return
+            pipe = self._client.pipeline(transaction=False)
+            for session_id in ids:
+                pipe.hmget(self._session_key(session_id), "history", "last_active")
+            for session_id, (history, last_active) in zip(ids, pipe.execute()):
+                if history is not None:
+                    yield session_id, json.loads(history), float(last_active) if last_active else None
+            if len(ids) < batch:
+                return
+            lower = f"({ids[-1]}"
+
+    def _read_setting(self, namespace, key):
+        value = self._client.hget(self._settings_key(namespace), key)
+        return json.loads(value) if value is not None else _MISSING
+
+    def _read_settings(self, namespace):
+        return {key.decode("utf-8"): json.loads(value)
+                for key, value in self._client.hgetall(self._settings_key(namespace)).items()}
+
+    def _write_batch(self, session_rows, session_deletes, setting_rows, setting_deletes):
+        pipe = self._client.pipeline(transaction=False)
+        for session_id, history, last_active, updated_at in session_rows:
+            pipe.hset(self._session_key(session_id), mapping={
+                "history": history, "last_active": "" if last_active is None else last_active,
+                "updated_at": updated_at
+            })
+            pipe.zadd(self._index_key, {session_id: 0})
+            if last_active is not None:
+                pipe.zadd(self._active_key, {session_id: last_active})
+        for session_id in session_deletes:
+            pipe.delete(self._session_key(session_id))
+            pipe.zrem(self._index_key, session_id)
+            pipe.zrem(self._active_key, session_id)
+        for namespace, key, value in setting_rows:
+            pipe.hset(self._settings_key(namespace), key, value)
+        for namespace, key in setting_deletes:
+            pipe.hdel(self._settings_key(namespace), key)
+        pipe.execute()
+
+    def _incr(self, namespace, key, amount):
+        return self._client.hincrby(self._settings_key(namespace), key, amount)
+
+    def _update(self, namespace, key, func):
+        name = self._settings_key(namespace)
+        with self._client.pipeline() as pipe:
+            while True:
+                try:
+                    # 乐观锁：读取之后哈希被其他进程修改时execute抛出WatchError，重新读改写
+                    pipe.watch(name)
+                    raw = pipe.hget(name, key)
+                    value = func(json.loads(raw) if raw is not None else None)
+                    pipe.multi()
+                    if value is None:
+                        pipe.hdel(name, key)
+                    else:
+                        pipe.hset(name, key, json.dumps(value, ensure_ascii=False))
+                    pipe.execute()
+                    return value
+                except redis.WatchError:
+                    continue
+
+    def _expire_sessions(self, before, batch=500):
+        expired = 0
+        while True:
+            ids = self._client.zrangebyscore(self._active_key, "-inf", f"({before}", start=0, num=batch)
+            if not ids:
+                return expired
+            pipe = self._client.pipeline(transaction=False)
+            for session_id in ids:
+                pipe.delete(self._session_key(session_id.decode("utf-8")))
+            pipe.zrem(self._index_key, *ids)
+            pipe.zrem(self._active_key, *ids)
+            pipe.execute()
+            expired += len(ids)
+
+    def _close(self):
+        self._redis.close()
+
+
+class PersistentDict(MutableMapping):
+    """
+    带持久化的字典，用于会话风格、自动回复概率等
+
+    读取时按需从数据库加载，最多缓存max_cached个最近用过的条目（不缓存不存在的key），写入异步刷盘；
+    backend为None时就是普通的内存字典。指定default时，读取不存在的key返回default（类似Counter）。
+    backend为多进程共享的存储时不在本进程缓存，每次读写都直接访问存储
+    """
+
+    def __init__(self, backend, namespace, default=_MISSING, max_cached=SETTINGS_CACHE_SIZE):
+        self.backend = backend
+        self.namespace = namespace
+        self.default = default
+        self.max_cached = max_cached
+        # 有backend时是LRU缓存，淘汰的条目之后从存储（包括待写入队列）重新读取；没有backend时保存全部条目
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def _shared(self):
+        return self.backend is not None and self.backend.shared
+
+    def _remember(self, key, value):
+        """写入缓存，调用方持有self._lock"""
+        self._cache[key] = value
+        self._cache.move_to_end(key)
+        if self.backend and len(self._cache) > self.max_cached:
+            self._cache.popitem(last=False)
+
+    def _load(self, key):
+        """读取缓存，没有时从存储加载，调用方持有self._lock"""
+        value = self._cache.get(key, _MISSING)
+        if value is not _MISSING:
+            self._cache.move_to_end(key)
+        elif self.backend:
+            value = self.backend.load_setting(self.namespace, key)
+        return value
+
+    def _lookup(self, key):
+        if self._shared:
+            return self.backend.load_setting(self.namespace, key)
+        with self._lock:
+            value = self._cache.get(key, _MISSING)
+            if value is not _MISSING:
+                self._cache.move_to_end(key)
+                return value
+        if not self.backend:
+            return _MISSING
+        # 在锁外读取存储；不存在的key不缓存，否则每个出现过的会话都会一直留在内存中
+        value = self.backend.load_setting(self.namespace, key)
+        if value is not _MISSING:
+            with self._lock:
+                if key not in self._cache:
+                    self._remember(key, value)
+        return value
+
+    def __getitem__(self, key):
+        value = self._lookup(key)
+        if value is _MISSING:
+            if self.default is not _MISSING:
+                return self.default
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        value = self._lookup(key)
+        return default if value is _MISSING else value
+
+    def __contains__(self, key):
+        return self._lookup(key) is not _MISSING
+
+    def __setitem__(self, key, value):
+        if not self._shared:
+            with self._lock:
+                self._remember(key, value)
+        if self.backend:
+            self.backend.set_setting(self.namespace, key, value)
+
+    def __delitem__(self, key):
+        if self._lookup(key) is _MISSING:
+            raise KeyError(key)
+        if not self._shared:
+            # 删除操作在存储的待写入队列中，之后读取时不会读到旧值
+            with self._lock:
+                self._cache.pop(key, None)
+        if self.backend:
+            self.backend.delete_setting(self.namespace, key)
+
+    def incr(self, key, amount=1):
+        """给数值加上amount并返回新值；共享存储时在存储中原子地完成，多个进程同时自增不会丢失"""
+        if self._shared:
+            return self.backend.incr_setting(self.namespace, key, amount)
+        # 在锁内读改写，同一进程中同时自增不会丢失
+        with self._lock:
+            value = self._load(key)
+            if value is _MISSING:
+                value = self.default if self.default is not _MISSING else 0
+            value += amount
+            self._remember(key, value)
+        if self.backend:
+            self.backend.set_setting(self.namespace, key, value)
+        return value
+
+    def update(self, key, func):
+        """
+        读改写一个条目：新值 = func(旧值)，不存在时旧值为None，func返回None时删除该条目；
+        共享存储时在存储中原子地完成，多个进程同时修改不会丢失
+
+        Returns:
+            新值
+        """
+        if self._shared:
+            return self.backend.update_setting(self.namespace, key, func)
+        with self._lock:
+            value = self._load(key)
+            value = func(None if value is _MISSING else value)
+            if value is None:
+                # 删除操作在存储的待写入队列中，之后读取时不会读到旧值，不需要在缓存中保留
+                self._cache.pop(key, None)
+                if self.backend:
+                    self.backend.delete_setting(self.namespace, key)
+            else:
+                self._remember(key, value)
+                if self.backend:
+                    self.backend.set_setting(self.namespace, key, value)
+        return value
+
+    def copy(self):
+        """返回包含数据库中所有条目的普通字典"""
+        result = self.backend.load_settings(self.namespace) if self.backend else {}
+        if self._shared:
+            return result
+        with self._lock:
+            cached = list(self._cache.items())
+        for key, value in cached:
+            result.pop(str(key), None)
+            result[key] = value
+        return result
+
+    def __iter__(self):
+        return iter(self.copy())
+
+    def __len__(self):
+        return len(self.copy())
+
+
+def create_state_backend():
+    """
+    按STATE_BACKEND创建状态存储，memory（或STATE_DB_PATH为空）时返回None，状态只保存在内存中
+
+    WORKER_PROCESSES大于1时多个工作进程共用同一个存储，SQLite存储会切换到共享模式
+    """
+    flush_interval = float(os.getenv("STATE_FLUSH_INTERVAL", "1"))
+    shared = int(os.getenv("WORKER_PROCESSES", "1")) > 1
+    if STATE_BACKEND == "redis":
+        return RedisStateDB(REDIS_URL, prefix=os.getenv("REDIS_PREFIX", "qqbot"), flush_interval=flush_interval)
+    if STATE_BACKEND == "memory" or not STATE_DB_PATH:
+        if shared:
+            logger.warning("多进程模式下使用内存状态存储，各工作进程之间的风格、概率等设置不会同步")
+        return None
+    return StateDB(STATE_DB_PATH, flush_interval=flush_interval, shared=shared)
+
+
+# 创建全局实例，STATE_BACKEND=memory或STATE_DB_PATH设为空字符串时不做持久化；
+# 创建时不打开数据库，由main.create_app()（或第一次读写时）打开
+state_db = None
+try:
+    state_db = create_state_backend()
+    if state_db is not None:
+        atexit.register(state_db.close)
+except Exception as e:
+    logger.error(f"创建状态存储失败，状态将只保存在内存中: {e}")
+    state_db = None
@@ -0,0 +1,55 @@
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class Readiness:
+    """
+    服务是否可以接收流量
+
+    - 启动过程中各部分登记检查项（例如预热完成、工作进程已初始化），全部通过才算就绪
+    - 还没有登记任何检查项时（应用尚未创建）不算就绪
+    - 开始停机后一直返回未就绪，让负载均衡和部署脚本不再转发新请求
+    """
+
+    def __init__(self):
+        self._checks = {}
+        self._lock = threading.Lock()
+        self._draining = threading.Event()
+
+    def add_check(self, name, func):
+        """登记检查项，func返回True表示这一项已经就绪"""
+        with self._lock:
+            self._checks[name] = func
+
+    def set_draining(self):
+        if not self._draining.is_set():
+            self._draining.set()
+            logger.info("开始停机，服务标记为未就绪")
+
+    @property
+    def draining(self):
+        return self._draining.is_set()
+
+    def status(self):
+        """
+        Returns:
+            tuple: (是否就绪, 每个检查项的结果)
+        """
+        with self._lock:
+            checks = dict(self._checks)
+        results = {}
+        for name, func in checks.items():
+            try:
+                results[name] = bool(func())
+            except Exception as e:
+                logger.warning(f"就绪检查 {name} 出错: {e}")
+                results[name] = False
+        results["draining"] = self.draining
+        ready = bool(checks) and not self.draining and all(results[name] for name in checks)
+        return ready, results
+
+
+# 创建全局实例
+readiness = Readiness()
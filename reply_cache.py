@@ -0,0 +1,133 @@
+import os
+import re
+import time
+import random
+import logging
+import threading
+from collections import OrderedDict
+from ban_filter import normalize_text
+
+logger = logging.getLogger(__name__)
+
+# 连续重复3次以上的字符压缩为2个，"哈哈哈哈"和"哈哈哈"视为同一条消息
+_REPEAT_PATTERN = re.compile(r"(.)\1{2,}")
+
+
+def normalize_message(text):
+    """归一化短消息作为缓存key：全角转半角、小写、去标点空白、压缩重复字符"""
+    return _REPEAT_PATTERN.sub(r"\1\1", normalize_text(text))
+
+
+class _CacheEntry:
+    __slots__ = ("replies", "created", "uses")
+
+    def __init__(self, created):
+        self.replies = []
+        self.created = created
+        # (group_id, 回复下标) -> 使用次数
+        self.uses = {}
+
+
+class ReplyCache:
+    """
+    自动回复的缓存
+
+    以(风格, 归一化后的消息)为key，每个key最多保存max_variants条不同的回复；
+    同一条缓存回复在同一个群里最多使用max_reuse次，用完后重新请求大模型，保证回复有变化
+    """
+
+    def __init__(self, enabled=False, max_entries=2000, ttl=3600, max_chars=12, max_variants=3, max_reuse=2):
+        self.enabled = enabled
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_chars = max_chars
+        self.max_variants = max_variants
+        self.max_reuse = max_reuse
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        # 风格 -> {"hits": n, "misses": n}
+        self._stats = {}
+
+    def _key(self, style, text):
+        normalized = normalize_message(text)
+        if not normalized or len(normalized) > self.max_chars:
+            return None
+        return (style, normalized)
+
+    def _count(self, style, field):
+        stats = self._stats.setdefault(style, {"hits": 0, "misses": 0})
+        stats[field] += 1
+
+    def get(self, style, text, group_id):
+        """
+        查找缓存的回复
+
+        Returns:
+            str: 可以使用的缓存回复，没有返回None
+        """
+        if not self.enabled:
+            return None
+        key = self._key(style, text)
+        if key is None:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry.created > self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self._count(style, "misses")
+                return None
+            self._entries.move_to_end(key)
+            candidates = [i for i in range(len(entry.replies))
+                          if entry.uses.get((group_id, i), 0) < self.max_reuse]
+            if not candidates:
+                self._count(style, "misses")
+                return None
+            index = random.choice(candidates)
+            entry.uses[(group_id, index)] = entry.uses.get((group_id, index), 0) + 1
+            self._count(style, "hits")
+            return entry.replies[index]
+
+    def put(self, style, text, reply, group_id=None):
+        """缓存一条大模型生成的回复，group_id为已经在该群使用过的群号"""
+        if not self.enabled or not reply:
+            return
+        key = self._key(style, text)
+        if key is None:
+            return
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _CacheEntry(time.time())
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+            else:
+                self._entries.move_to_end(key)
+            if reply in entry.replies:
+                return
+            if len(entry.replies) >= self.max_variants:
+                # 替换最早的回复，使用计数一并清空
+                entry.replies.pop(0)
+                entry.uses = {}
+            entry.replies.append(reply)
+            if group_id is not None:
+                entry.uses[(group_id, len(entry.replies) - 1)] = 1
+
+    def get_stats(self):
+        with self._lock:
+            styles = {}
+            for style, stats in self._stats.items():
+                total = stats["hits"] + stats["misses"]
+                styles[style] = {**stats, "hit_rate": stats["hits"] / total if total else 0.0}
+            return {"enabled": self.enabled, "entries": len(self._entries), "styles": styles}
+
+
+# 创建全局实例，AUTO_REPLY_CACHE=1时启用
+reply_cache = ReplyCache(
+    enabled=os.getenv("AUTO_REPLY_CACHE", "0") == "1",
+    max_entries=int(os.getenv("AUTO_REPLY_CACHE_SIZE", "2000")),
+    ttl=int(os.getenv("AUTO_REPLY_CACHE_TTL", "3600")),
+    max_reuse=int(os.getenv("AUTO_REPLY_CACHE_MAX_REUSE", "2"))
+)
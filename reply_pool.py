@@ -0,0 +1,160 @@
+import os
+import time
+import random
+import logging
+import threading
+from collections import deque
+from llm_client import llm_client
+from admission import AdmissionRejected
+
+logger = logging.getLogger(__name__)
+
+
+class ReplyPool:
+    """
+    固定prompt的预生成回复池
+
+    按(风格, prompt)分别维护若干条预先生成的回复，取用时随机取出一条立即返回；
+    剩余数量低于low_water时在后台线程补充，取用方永远不等待大模型
+    """
+
+    def __init__(self, generate_func, size=5, low_water=2, recent_size=10):
+        self.generate_func = generate_func
+        self.size = size
+        self.low_water = low_water
+        self._lock = threading.Lock()
+        # (style, prompt) -> [回复]
+        self._pools = {}
+        # 最近发出过的回复，池子空了时从这里随机复用
+        self._recent = {}
+        self.recent_size = recent_size
+        self._refill_queue = deque()
+        self._queued = set()
+        self._wakeup = threading.Event()
+        self._worker = None
+
+        self.hits = 0
+        self.reused = 0
+        self.misses = 0
+        self.generated = 0
+        self.failures = 0
+        self.skipped = 0
+
+    def get(self, prompt, style):
+        """
+        随机取出一条回复
+
+        Returns:
+            str: 回复内容，池子和最近回复都为空时返回None
+        """
+        key = (style, prompt)
+        with self._lock:
+            pool = self._pools.setdefault(key, [])
+            recent = self._recent.setdefault(key, deque(maxlen=self.recent_size))
+            reply = None
+            if pool:
+                reply = pool.pop(random.randrange(len(pool)))
+                recent.append(reply)
+                self.hits += 1
+            elif recent:
+                reply = random.choice(recent)
+                self.reused += 1
+            else:
+                self.misses += 1
+            need_refill = len(pool) <= self.low_water
+        if need_refill:
+            self._schedule_refill(key)
+        return reply
+
+    def warm(self, prompt, style):
+        """后台预先填满指定的回复池"""
+        self._schedule_refill((style, prompt))
+
+    def _schedule_refill(self, key):
+        with self._lock:
+            if key in self._queued:
+                return
+            self._queued.add(key)
+            self._refill_queue.append(key)
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._refill_loop, name="reply-pool-refill", daemon=True)
+                self._worker.start()
+        self._wakeup.set()
+
+    def _refill_loop(self):
+        while True:
+            self._wakeup.wait()
+            while True:
+                with self._lock:
+                    if not self._refill_queue:
+                        self._wakeup.clear()
+                        break
+                    key = self._refill_queue.popleft()
+                more = self._refill_one(key)
+                with self._lock:
+                    if more:
+                        # 轮流补充各个池子，每个池子都能尽快有第一条回复
+                        self._refill_queue.append(key)
+                    else:
+                        self._queued.discard(key)
+
+    def _refill_one(self, key):
+        """生成一条回复放入池子，返回是否还需要继续补充"""
+        style, prompt = key
+        with self._lock:
+            if len(self._pools.setdefault(key, [])) >= self.size:
+                return False
+        try:
+            reply = self.generate_func(prompt, style)
+        except AdmissionRejected as e:
+            # 系统繁忙时让出大模型容量，下次取用时再补充
+            self.skipped += 1
+            logger.info(f"系统繁忙，暂停补充回复池（风格: {style}）: {e}")
+            return False
+        except Exception as e:
+            self.failures += 1
+            logger.error(f"预生成回复失败（风格: {style}）: {e}")
+            return False
+        with self._lock:
+            self._pools[key].append(reply)
+            self.generated += 1
+            return len(self._pools[key]) < self.size
+
+    def wait_stocked(self, prompt, style, timeout):
+        """
+        等待指定的回复池至少有一条回复
+
+        Returns:
+            bool: 是否已有回复；补充失败（例如大模型不可用）或超时返回False
+        """
+        key = (style, prompt)
+        deadline = time.monotonic() + timeout
+        while True:
+            with self._lock:
+                if self._pools.get(key):
+                    return True
+                if key not in self._queued:
+                    return False
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.05)
+
+    def get_stats(self):
+        with self._lock:
+            pools = {f"{style}:{prompt[:16]}": len(pool) for (style, prompt), pool in self._pools.items()}
+            return {"pools": pools, "hits": self.hits, "reused": self.reused, "misses": self.misses,
+                    "generated": self.generated, "failures": self.failures, "skipped": self.skipped}
+
+
+def _generate(prompt, style):
+    if not llm_client:
+        raise RuntimeError("AI服务不可用")
+    return llm_client.generate(prompt, style)
+
+
+# 创建全局实例，用于违禁词处理时的diss回复
+diss_pool = ReplyPool(
+    _generate,
+    size=int(os.getenv("DISS_POOL_SIZE", "5")),
+    low_water=int(os.getenv("DISS_POOL_LOW_WATER", "2"))
+)
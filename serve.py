@@ -0,0 +1,76 @@
+import os
+import signal
+import logging
+import threading
+
+try:
+    import waitress
+except ImportError:
+    # waitress未安装时退回Flask自带的服务器（不开启调试和自动重载）
+    waitress = None
+
+logger = logging.getLogger(__name__)
+
+SERVER_HOST = os.getenv("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.getenv("SERVER_PORT", "5000"))
+# 处理HTTP请求的线程数；消息处理在后台队列和工作进程中进行，请求本身很快返回
+SERVER_THREADS = int(os.getenv("SERVER_THREADS", "8"))
+
+
+def serve(app, shutdown, host=SERVER_HOST, port=SERVER_PORT, threads=SERVER_THREADS):
+    """
+    用生产环境的WSGI服务器运行应用，直到收到SIGTERM或SIGINT
+
+    收到信号后继续响应请求（/ready返回503），同时在后台调用shutdown()处理完已经接收的消息，
+    完成后关闭服务器；停机完成前再次收到信号时立即退出
+
+    Args:
+        app: create_app()返回的Flask应用
+        shutdown (Callable): 优雅停机函数
+    """
+    if waitress is None:
+        logger.warning("未安装waitress，使用Flask自带的服务器，生产环境请安装waitress")
+        _serve_flask(app, shutdown, host, port)
+        return
+
+    server = waitress.create_server(app, host=host, port=port, threads=threads)
+    stopping = threading.Event()
+    drained = threading.Event()
+
+    def drain():
+        try:
+            shutdown()
+        finally:
+            drained.set()
+            # 服务器只能在主线程中关闭：再发一次信号，由主线程的信号处理退出server.run()
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    def on_signal(signum, frame):
+        if drained.is_set():
+            raise SystemExit(0)
+        if stopping.is_set():
+            logger.warning("再次收到停止信号，立即退出")
+            raise SystemExit(1)
+        stopping.set()
+        logger.info(f"收到信号 {signal.Signals(signum).name}，开始优雅停机")
+        threading.Thread(target=drain, name="shutdown", daemon=True).start()
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    logger.info(f"Bot服务器启动在: http://{host}:{port}（waitress，{threads} 个线程）")
+    server.run()
+    logger.info("服务器已停止")
+
+
+def _serve_flask(app, shutdown, host, port):
+    def on_signal(signum, frame):
+        # Flask自带的服务器不能从其他线程停止，在信号处理中直接完成停机
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        shutdown()
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+    logger.info(f"Bot服务器启动在: http://{host}:{port}")
+    app.run(host=host, port=port, threaded=True, debug=False, use_reloader=False)
@@ -0,0 +1,259 @@
+import json
+import time
+import zlib
+import logging
+from llm_client import llm_client
+from session_store import session_store
+from persistence import state_db
+from cluster import worker_cluster
+from utils import session_styles, probabilitys, user_ban_times, get_available_styles
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMAT_VERSION = 1
+# 一次批量操作最多涉及的会话数
+BATCH_MAX_SESSIONS = 10000
+# 导入时单行的最大字节数，防止异常数据占满内存
+MAX_LINE_BYTES = 16 * 1024 * 1024
+# 多进程模式下导入的会话转发给工作进程时，队列满最多等待的秒数
+IMPORT_SUBMIT_TIMEOUT = 30.0
+
+
+class InvalidImportData(ValueError):
+    """导入数据格式错误"""
+
+
+class UnsupportedVersion(InvalidImportData):
+    """导出文件的格式版本不受支持"""
+
+
+def _valid_style(value):
+    if not isinstance(value, str) or value not in get_available_styles():
+        raise InvalidImportData(f"风格 '{value}' 不存在")
+    return value
+
+
+def _valid_probability(value):
+    # 与[修改概率]命令和apply_batch一致，以0到1之间的小数保存
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not 0 <= value <= 1:
+        raise InvalidImportData(f"概率必须是0到1之间的数: {value!r}")
+    return float(value)
+
+
+def _valid_offense(value):
+    # [违规分数, 更新时间]；旧版本导出的是违规次数，导入后从现在开始衰减
+    if isinstance(value, bool):
+        raise InvalidImportData(f"违规分数格式错误: {value!r}")
+    if isinstance(value, (int, float)):
+        value = [value, time.time()]
+    if (not isinstance(value, list) or len(value) != 2
+            or any(isinstance(item, bool) or not isinstance(item, (int, float)) for item in value)
+            or not 0 <= value[0] < float("inf") or not 0 <= value[1] < float("inf")):
+        raise InvalidImportData(f"违规分数格式错误: {value!r}")
+    return [float(value[0]), float(value[1])]
+
+
+# 导出和导入的设置：命名空间 -> (PersistentDict, 校验并返回导入值的函数)；
+# 风格和概率的key是session_id，违规分数的key是用户QQ号
+SETTINGS = {
+    "style": (session_styles, _valid_style),
+    "probability": (probabilitys, _valid_probability),
+    "ban_count": (user_ban_times, _valid_offense),
+}
+
+
+def _clear(session_id):
+    if llm_client:
+        llm_client.clear_history(session_id)
+    else:
+        session_store.clear(session_id)
+    if worker_cluster is not None:
+        # 会话在负责它的工作进程内存中，也要在那里清空
+        worker_cluster.submit(session_id, "clear_history", session_id, timeout=IMPORT_SUBMIT_TIMEOUT)
+
+
+def apply_batch(session_ids, style=None, probability=None, clear_history=False):
+    """
+    对多个会话执行同样的操作
+
+    Args:
+        session_ids (list[str]): 会话ID列表
+        style (str, optional): 切换到的风格
+        probability (float, optional): 自动回复概率（百分比，0-100）
+        clear_history (bool): 是否清空历史记录
+
+    Returns:
+        dict: 每种操作处理的会话数
+
+    Raises:
+        ValueError: 参数无效
+    """
+    if len(session_ids) > BATCH_MAX_SESSIONS:
+        raise ValueError(f"一次最多操作 {BATCH_MAX_SESSIONS} 个会话")
+    if style is None and probability is None and not clear_history:
+        raise ValueError("至少需要指定 style、probability、clear_history 中的一项")
+    if style is not None and style not in get_available_styles():
+        raise ValueError(f"风格 '{style}' 不存在。可用风格：{', '.join(get_available_styles())}")
+    if probability is not None:
+        probability = float(probability)
+        if not 0 <= probability <= 100:
+            raise ValueError("probability 必须在0到100之间")
+
+    result = {"sessions": len(session_ids), "styled": 0, "probability_set": 0, "cleared": 0}
+    for session_id in session_ids:
+        if style is not None:
+            session_styles[session_id] = style
+            result["styled"] += 1
+        if probability is not None:
+            # 与[修改概率]命令一致，以小数保存
+            probabilitys[session_id] = probability * 0.01
+            result["probability_set"] += 1
+        if clear_history:
+            _clear(session_id)
+            result["cleared"] += 1
+    logger.info(f"批量操作 {len(session_ids)} 个会话: {result}")
+    return result
+
+
+def _iter_records():
+    yield {"type": "header", "version": EXPORT_FORMAT_VERSION, "exported_at": time.time()}
+    if state_db:
+        # 先把本进程的修改写入存储，之后从存储中分批读取，包括已经从内存淘汰的会话
+        state_db.flush()
+        source = state_db
+    else:
+        source = session_store
+    for session_id, history, last_active in source.iter_session_data():
+        yield {"type": "session", "session_id": session_id, "history": history, "last_active": last_active}
+    for namespace, (settings, _) in SETTINGS.items():
+        for key, value in settings.copy().items():
+            yield {"type": "setting", "namespace": namespace, "key": key, "value": value}
+
+
+def export_state(compress=True, chunk_size=64 * 1024):
+    """
+    导出所有会话的历史记录和设置，逐块产出（gzip压缩的）NDJSON
+
+    会话分批读取，内存中同时只有一批会话和一个输出块
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    buffer = []
+    size = 0
+    for record in _iter_records():
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        buffer.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            data = b"".join(buffer)
+            buffer, size = [], 0
+            data = compressor.compress(data) if compressor else data
+            if data:
+                yield data
+    data = b"".join(buffer)
+    if compressor:
+        data = compressor.compress(data) + compressor.flush()
+    if data:
+        yield data
+
+
+def _iter_lines(stream, read_size=64 * 1024):
+    """从请求体中逐行读取NDJSON，以gzip头开头时边读边解压"""
+    chunk = stream.read(read_size)
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16) if chunk[:2] == b"\x1f\x8b" else None
+    pending = b""
+    try:
+        while chunk:
+            pending += decompressor.decompress(chunk) if decompressor else chunk
+            *lines, pending = pending.split(b"\n")
+            yield from lines
+            if len(pending) > MAX_LINE_BYTES:
+                raise InvalidImportData(f"单行超过 {MAX_LINE_BYTES} 字节")
+            chunk = stream.read(read_size)
+        if decompressor:
+            pending += decompressor.flush()
+    except zlib.error as e:
+        raise InvalidImportData(f"gzip数据损坏: {e}")
+    yield from pending.split(b"\n")
+
+
+def _valid_history(history):
+    return isinstance(history, list) and all(
+        isinstance(entry, dict) and entry.get("role") in ("user", "assistant", "system")
+        and isinstance(entry.get("content"), str)
+        for entry in history
+    )
+
+
+def _import_session(record):
+    session_id = record.get("session_id")
+    history = record.get("history")
+    last_active = record.get("last_active")
+    if not isinstance(session_id, str) or not session_id or not _valid_history(history):
+        raise InvalidImportData("会话记录缺少session_id或history格式错误")
+    if last_active is not None and not isinstance(last_active, (int, float)):
+        raise InvalidImportData("last_active必须是时间戳")
+    if worker_cluster is not None:
+        worker_cluster.submit(session_id, "import_session", (session_id, history, last_active),
+                              timeout=IMPORT_SUBMIT_TIMEOUT)
+    else:
+        session_store.import_session(session_id, history, last_active)
+
+
+def _import_setting(record):
+    namespace = record.get("namespace")
+    if namespace not in SETTINGS:
+        raise InvalidImportData(f"未知的设置命名空间: {namespace}")
+    key = record.get("key")
+    if not isinstance(key, str) or not key:
+        raise InvalidImportData("设置记录的key无效")
+    value = record.get("value")
+    if value is None:
+        raise InvalidImportData("设置记录缺少value")
+    settings, validate = SETTINGS[namespace]
+    # 值不合法的设置不导入，否则之后读取时才出错（例如概率不是数字时自动回复判断会抛异常）
+    settings[key] = validate(value)
+
+
+def import_state(stream, max_errors=20):
+    """
+    从（gzip压缩的）NDJSON导入会话和设置，逐行处理，不把整个文件读入内存
+
+    同一个会话已经存在时用导入的内容替换；格式错误的行跳过并记录前max_errors个错误
+
+    Returns:
+        dict: 导入的会话数、设置数、跳过的行数和错误信息
+
+    Raises:
+        InvalidImportData: 压缩数据损坏、单行过长或导出格式版本不受支持，此前的行已经导入
+    """
+    result = {"sessions": 0, "settings": 0, "skipped": 0, "errors": []}
+    for line_number, line in enumerate(_iter_lines(stream), 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            if not isinstance(record, dict):
+                raise InvalidImportData("每行必须是JSON对象")
+            record_type = record.get("type")
+            if record_type == "header":
+                version = record.get("version")
+                if version != EXPORT_FORMAT_VERSION:
+                    # 格式版本不对时整个文件都不可信，直接中止
+                    raise UnsupportedVersion(f"不支持的导出格式版本: {version}")
+            elif record_type == "session":
+                _import_session(record)
+                result["sessions"] += 1
+            elif record_type == "setting":
+                _import_setting(record)
+                result["settings"] += 1
+            else:
+                raise InvalidImportData(f"未知的记录类型: {record_type}")
+        except UnsupportedVersion:
+            raise
+        except ValueError as e:
+            # json.JSONDecodeError和InvalidImportData都是ValueError
+            result["skipped"] += 1
+            if len(result["errors"]) < max_errors:
+                result["errors"].append(f"第{line_number}行: {e}")
+    logger.info(f"导入完成: 会话 {result['sessions']} 个，设置 {result['settings']} 条，跳过 {result['skipped']} 行")
+    return result
@@ -0,0 +1,406 @@
+import os
+import time
+import bisect
+import logging
+import threading
+from collections import OrderedDict, deque
+from persistence import state_db
+from context_builder import is_summary
+
+logger = logging.getLogger(__name__)
+
+# 每条历史记录除内容外的大致内存开销（dict、key等），用于估算会话占用
+ENTRY_OVERHEAD_BYTES = 200
+
+
+def _entry_bytes(entry):
+    return len(entry["content"].encode("utf-8")) + ENTRY_OVERHEAD_BYTES
+
+
+class SessionState:
+    """单个会话的对话历史和活跃时间"""
+
+    __slots__ = ("history", "last_active", "prompt_tokens", "context_anchor", "size_bytes")
+
+    def __init__(self, history_maxlen):
+        self.history = deque(maxlen=history_maxlen)
+        self.last_active = None
+        self.prompt_tokens = None
+        # 上一次请求发送的第一条历史记录，用于保持请求前缀稳定
+        self.context_anchor = None
+        self.size_bytes = 0
+
+
+class SessionStore:
+    """
+    会话存储
+
+    - 后台线程定期清理超过TTL未活跃的会话
+    - 会话总数和估算内存超过上限时按LRU淘汰
+    - 配置了backend时，修改异步写入数据库，不在内存中的会话第一次访问时从数据库加载
+    """
+
+    def __init__(self, ttl=15 * 60, max_sessions=10000, max_bytes=64 * 1024 * 1024,
+                 history_maxlen=200, sweep_interval=60, backend=None):
+        self.backend = backend
+        if backend is not None:
+            backend.session_source = self.export_session
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.history_maxlen = history_maxlen
+        self.sweep_interval = sweep_interval
+
+        self._lock = threading.RLock()
+        # 按最近访问顺序排列，最久未访问的在最前面
+        self._sessions = OrderedDict()
+        # 按session_id排序的索引，用于分页遍历
+        self._sorted_ids = []
+        self._total_bytes = 0
+        self._sweeper = None
+        self._stop = threading.Event()
+
+        self.evicted_ttl = 0
+        # 只在数据库中、因超时被删除的会话数（其中可能包括内存中已经删除、尚未刷盘的会话）
+        self.evicted_ttl_stored = 0
+        self.evicted_lru_count = 0
+        self.evicted_lru_bytes = 0
+
+    def _load(self, session_id, cache=True):
+        """
+        从数据库加载不在内存中的会话，不存在返回None
+
+        cache为False时只读取，不放入内存：多进程模式下主进程只读访问其他进程负责的会话，
+        放入内存会一直读到旧内容
+        """
+        if self.backend is None:
+            return None
+        try:
+            stored = self.backend.load_session(session_id)
+        except Exception as e:
+            logger.error(f"从数据库加载会话 {session_id} 失败: {e}")
+            return None
+        if stored is None:
+            return None
+        history, last_active = stored
+        state = SessionState(self.history_maxlen)
+        state.history.extend(history)
+        state.last_active = last_active
+        state.size_bytes = sum(_entry_bytes(entry) for entry in state.history)
+        if cache:
+            self._add(session_id, state)
+            self._total_bytes += state.size_bytes
+            self._enforce_limits(keep=session_id)
+        return state
+
+    def _lookup(self, session_id, cache=True):
+        state = self._sessions.get(session_id)
+        if state is None:
+            state = self._load(session_id, cache)
+        return state
+
+    def _get_or_create(self, session_id):
+        state = self._lookup(session_id)
+        if state is None:
+            state = self._add(session_id, SessionState(self.history_maxlen))
+            self._enforce_limits(keep=session_id)
+        else:
+            self._sessions.move_to_end(session_id)
+        return state
+
+    def _add(self, session_id, state):
+        self._sessions[session_id] = state
+        bisect.insort(self._sorted_ids, session_id)
+        return state
+
+    def _remove(self, session_id):
+        state = self._sessions.pop(session_id, None)
+        if state is not None:
+            self._total_bytes -= state.size_bytes
+            index = bisect.bisect_left(self._sorted_ids, session_id)
+            del self._sorted_ids[index]
+        return state
+
+    def _evict(self, session_id):
+        """从内存中淘汰会话，数据库中的内容保留"""
+        state = self._remove(session_id)
+        if state is not None and self.backend is not None:
+            self.backend.save_session(session_id, state.history, state.last_active)
+
+    def _mark_dirty(self, session_id):
+        if self.backend is not None:
+            self.backend.mark_session_dirty(session_id)
+
+    def export_session(self, session_id):
+        """返回 (历史记录副本, 最后活跃时间)，会话不在内存中返回None"""
+        with self._lock:
+            state = self._sessions.get(session_id)
+            if state is None:
+                return None
+            return list(state.history), state.last_active
+
+    def _enforce_limits(self, keep=None):
+        """按LRU淘汰会话直到满足数量和内存上限，keep为当前正在使用的会话"""
+        while len(self._sessions) > self.max_sessions:
+            session_id = next(iter(self._sessions))
+            if session_id == keep:
+                break
+            self._evict(session_id)
+            self.evicted_lru_count += 1
+        while self._total_bytes > self.max_bytes and len(self._sessions) > 1:
+            session_id = next(iter(self._sessions))
+            if session_id == keep:
+                break
+            self._evict(session_id)
+            self.evicted_lru_bytes += 1
+
+    def touch(self, session_id, now=None):
+        """
+        更新会话的活跃时间
+
+        Returns:
+            float: 距离上次活跃的秒数，新会话返回None
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            state = self._get_or_create(session_id)
+            idle = None if state.last_active is None else now - state.last_active
+            state.last_active = now
+            self._mark_dirty(session_id)
+            return idle
+
+    def append(self, session_id, entry):
+        """添加一条历史记录，返回添加后的历史长度"""
+        with self._lock:
+            state = self._get_or_create(session_id)
+            history = state.history
+            if len(history) == history.maxlen:
+                # 历史已满时丢弃最旧的一条对话，滚动摘要始终保留在最前面
+                index = 1 if is_summary(history[0]) else 0
+                dropped = _entry_bytes(history[index])
+                del history[index]
+                state.size_bytes -= dropped
+                self._total_bytes -= dropped
+            history.append(entry)
+            added = _entry_bytes(entry)
+            state.size_bytes += added
+            self._total_bytes += added
+            self._enforce_limits(keep=session_id)
+            self._mark_dirty(session_id)
+            return len(history)
+
+    def get_history(self, session_id):
+        """获取会话历史记录的副本，不存在时返回空列表"""
+        with self._lock:
+            state = self._lookup(session_id, cache=False)
+            return list(state.history) if state is not None else []
+
+    def get(self, session_id):
+        """获取会话状态（不影响LRU顺序，也不把数据库中的会话放入内存），不存在返回None"""
+        with self._lock:
+            return self._lookup(session_id, cache=False)
+
+    def record_context(self, session_id, prompt_tokens, anchor):
+        """记录最近一次请求发送的prompt token数和第一条历史记录"""
+        with self._lock:
+            state = self._sessions.get(session_id)
+            if state is not None:
+                state.prompt_tokens = prompt_tokens
+                state.context_anchor = anchor
+
+    def compact(self, session_id, consumed, summary_entry):
+        """
+        用一条摘要代替历史记录最前面的若干条
+
+        Args:
+            consumed (list[dict]): 被总结的记录（从最前面开始，可以包含旧的摘要）
+            summary_entry (dict): 新的摘要记录
+
+        Returns:
+            bool: 是否替换成功；总结期间会话被清空或最前面的记录已经变化时不替换
+        """
+        with self._lock:
+            state = self._sessions.get(session_id)
+            if state is None or len(state.history) < len(consumed):
+                return False
+            history = state.history
+            if any(history[i] is not entry for i, entry in enumerate(consumed)):
+                return False
+            removed = 0
+            for _ in consumed:
+                removed += _entry_bytes(history.popleft())
+            history.appendleft(summary_entry)
+            delta = _entry_bytes(summary_entry) - removed
+            state.size_bytes += delta
+            self._total_bytes += delta
+            if any(state.context_anchor is entry for entry in consumed):
+                state.context_anchor = None
+            self._mark_dirty(session_id)
+            return True
+
+    def clear(self, session_id):
+        """删除会话（包括数据库中的记录），返回会话是否存在"""
+        with self._lock:
+            existed = self._lookup(session_id, cache=False) is not None
+            self._remove(session_id)
+            if existed and self.backend is not None:
+                self.backend.delete_session(session_id)
+            return existed
+
+    def snapshot(self):
+        """返回 [(session_id, 历史记录副本, 最后活跃时间)] 列表"""
+        with self._lock:
+            return [(session_id, list(state.history), state.last_active)
+                    for session_id, state in self._sessions.items()]
+
+    def iter_sessions(self, after=None, prefix=None, batch=256):
+        """
+        按session_id顺序遍历内存中的会话，每批只短暂持有锁，不复制历史记录
+
+        Args:
+            after (str, optional): 从这个session_id之后开始（分页游标）
+            prefix (str, optional): 只遍历以此开头的会话，例如 group_
+
+        Yields:
+            tuple: (session_id, 历史条数, 最后活跃时间, 最后一条对话内容)
+        """
+        cursor = after
+        while True:
+            rows = []
+            with self._lock:
+                ids = self._sorted_ids
+                index = bisect.bisect_right(ids, cursor) if cursor is not None else 0
+                if prefix:
+                    index = max(index, bisect.bisect_left(ids, prefix))
+                finished = False
+                for session_id in ids[index:index + batch]:
+                    if prefix and not session_id.startswith(prefix):
+                        finished = True
+                        break
+                    history = self._sessions[session_id].history
+                    last = history[-1] if history else None
+                    last_message = last["content"] if last is not None and not is_summary(last) else None
+                    rows.append((session_id, len(history), self._sessions[session_id].last_active, last_message))
+            yield from rows
+            if finished or len(rows) < batch:
+                return
+            cursor = rows[-1][0]
+
+    def iter_session_data(self, after=None, prefix=None, batch=256):
+        """
+        按session_id顺序遍历内存中的会话，每批复制batch个会话的历史记录后释放锁，参数与iter_sessions相同
+
+        Yields:
+            tuple: (session_id, 历史记录副本, 最后活跃时间)
+        """
+        cursor = after
+        while True:
+            rows = []
+            with self._lock:
+                ids = self._sorted_ids
+                index = bisect.bisect_right(ids, cursor) if cursor is not None else 0
+                if prefix:
+                    index = max(index, bisect.bisect_left(ids, prefix))
+                finished = False
+                for session_id in ids[index:index + batch]:
+                    if prefix and not session_id.startswith(prefix):
+                        finished = True
+                        break
+                    state = self._sessions[session_id]
+                    rows.append((session_id, list(state.history), state.last_active))
+            yield from rows
+            if finished or len(rows) < batch:
+                return
+            cursor = rows[-1][0]
+
+    def import_session(self, session_id, history, last_active):
+        """用导入的内容替换会话（不存在时创建），超出history_maxlen时只保留最新的记录和摘要"""
+        with self._lock:
+            self._remove(session_id)
+            state = SessionState(self.history_maxlen)
+            if len(history) > self.history_maxlen and history and is_summary(history[0]):
+                history = history[:1] + history[len(history) - self.history_maxlen + 1:]
+            state.history.extend(history)
+            state.last_active = last_active
+            state.size_bytes = sum(_entry_bytes(entry) for entry in state.history)
+            self._add(session_id, state)
+            self._total_bytes += state.size_bytes
+            self._enforce_limits(keep=session_id)
+            self._mark_dirty(session_id)
+
+    def evict_expired(self, now=None):
+        """
+        清理超过TTL未活跃的会话，返回清理数量
+
+        内存中的会话直接删除；已经从内存淘汰、只在数据库中的会话由数据库按最后活跃时间删除。
+        内存中仍然活跃的会话在数据库中的活跃时间可能还是旧的，被删除后下次刷盘会重新写入
+        """
+        now = time.time() if now is None else now
+        expired = 0
+        with self._lock:
+            for session_id, state in list(self._sessions.items()):
+                if state.last_active is not None and now - state.last_active > self.ttl:
+                    self._remove(session_id)
+                    if self.backend is not None:
+                        self.backend.delete_session(session_id)
+                    expired += 1
+            self.evicted_ttl += expired
+        if expired:
+            logger.info(f"清理了 {expired} 个超时会话")
+        if self.backend is not None:
+            stored = self.backend.expire_sessions(now - self.ttl)
+            if stored:
+                self.evicted_ttl_stored += stored
+                logger.info(f"从数据库中清理了 {stored} 个超时会话")
+            expired += stored
+        return expired
+
+    def start_sweeper(self):
+        """启动后台清理线程"""
+        if self._sweeper is not None:
+            return
+        self._sweeper = threading.Thread(target=self._sweep_loop, name="session-sweeper", daemon=True)
+        self._sweeper.start()
+
+    def _sweep_loop(self):
+        while not self._stop.wait(self.sweep_interval):
+            try:
+                self.evict_expired()
+            except Exception as e:
+                logger.error(f"清理超时会话时出错: {e}")
+
+    def stop(self):
+        self._stop.set()
+
+    def get_stats(self):
+        with self._lock:
+            return {
+                "sessions": len(self._sessions),
+                "approx_bytes": self._total_bytes,
+                "max_sessions": self.max_sessions,
+                "max_bytes": self.max_bytes,
+                "ttl_seconds": self.ttl,
+                "evicted_ttl": self.evicted_ttl,
+                "evicted_ttl_stored": self.evicted_ttl_stored,
+                "evicted_lru_count": self.evicted_lru_count,
+                "evicted_lru_bytes": self.evicted_lru_bytes,
+            }
+
+    def __contains__(self, session_id):
+        with self._lock:
+            return session_id in self._sessions
+
+    def __len__(self):
+        with self._lock:
+            return len(self._sessions)
+
+
+# 创建全局实例
+session_store = SessionStore(
+    ttl=int(os.getenv("SESSION_TIMEOUT", str(15 * 60))),
+    max_sessions=int(os.getenv("MAX_SESSIONS", "10000")),
+    max_bytes=int(os.getenv("MAX_SESSION_BYTES", str(64 * 1024 * 1024))),
+    history_maxlen=int(os.getenv("MAX_HISTORY_MESSAGES", "200")),
+    sweep_interval=int(os.getenv("SESSION_SWEEP_INTERVAL", "60")),
+    backend=state_db
+)
@@ -0,0 +1,64 @@
+import os
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+def _path_signature(path):
+    """文件返回(修改时间, 大小)，目录返回其中所有文件的签名，不存在返回None"""
+    try:
+        if os.path.isdir(path):
+            entries = []
+            for entry in os.scandir(path):
+                if entry.is_file():
+                    stat = entry.stat()
+                    entries.append((entry.name, stat.st_mtime_ns, stat.st_size))
+            return tuple(sorted(entries))
+        stat = os.stat(path)
+        return (stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+        return None
+
+
+class FileWatcher:
+    """
+    轮询文件或目录的变化，变化时在后台线程中调用回调
+
+    不依赖inotify等平台相关机制，Windows/Linux/Mac行为一致
+    """
+
+    def __init__(self, path, on_change, interval=5.0):
+        self.path = path
+        self.on_change = on_change
+        self.interval = interval
+        # start()时记录，之后的变化才触发回调
+        self._signature = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._signature = _path_signature(self.path)
+        self._thread = threading.Thread(target=self._run, name=f"watcher-{os.path.basename(self.path)}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def check(self):
+        """检查一次是否变化，变化则调用回调；返回是否发生了变化"""
+        signature = _path_signature(self.path)
+        if signature == self._signature:
+            return False
+        self._signature = signature
+        try:
+            self.on_change()
+        except Exception as e:
+            logger.error(f"处理文件变化 {self.path} 时出错: {e}")
+        return True
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.check()
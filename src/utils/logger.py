@@ -1,41 +1,185 @@
+import os
+import sys
+import json
+import queue
+import atexit
+import logging
+import itertools
+import threading
+import logging.handlers
 import colorlog
 
+# 使用ANSI颜色代码
+GREEN = '\033[32m'
+BLUE = '\033[34m'
+RED = '\033[31m'
+YELLOW = '\033[33m'
+CYAN = '\033[36m'
+WHITE = '\033[37m'
+RESET = '\033[0m'
+
+LEVEL_COLORS = {
+    'INFO': GREEN,
+    'ERROR': RED,
+    'WARNING': YELLOW,
+    'DEBUG': CYAN,
+}
+
+
+def _truncate(text, max_length):
+    if max_length and len(text) > max_length:
+        return f'{text[:max_length]}...(共{len(text)}字符)'
+    return text
+
+
+class LazyJson:
+    """延迟序列化的JSON，只有日志真正输出时才调用json.dumps"""
+
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        try:
+            return json.dumps(self.data, ensure_ascii=False, separators=(',', ':'))
+        except (TypeError, ValueError):
+            return repr(self.data)
+
+
 class CustomColoredFormatter(colorlog.ColoredFormatter):
+    """彩色控制台格式，超过max_length的消息会被截断"""
+
+    def __init__(self, *args, max_length=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.max_length = max_length
+
     def format(self, record):
-        # 保存原始消息
-        original_msg = record.msg
-        
-        # 使用ANSI颜色代码
-        GREEN = '\033[32m'
-        BLUE = '\033[34m'
-        RED = '\033[31m'
-        YELLOW = '\033[33m'
-        CYAN = '\033[36m'
-        WHITE = '\033[37m'
-        RESET = '\033[0m'
-        
         # 格式化时间戳
         time_str = self.formatTime(record, self.datefmt)
         colored_time = f'{GREEN}{time_str}{RESET}'
-        
+
         # 设置logger名称为蓝色
         colored_name = f'{BLUE}{record.name}{RESET}'
-        
+
         # 根据日志级别设置颜色
-        if record.levelname == 'INFO':
-            colored_level = f'{GREEN}{record.levelname}{RESET}'
-        elif record.levelname == 'ERROR':
-            colored_level = f'{RED}{record.levelname}{RESET}'
-        elif record.levelname == 'WARNING':
-            colored_level = f'{YELLOW}{record.levelname}{RESET}'
-        elif record.levelname == 'DEBUG':
-            colored_level = f'{CYAN}{record.levelname}{RESET}'
-        else:
-            colored_level = record.levelname
-            
-        # 消息内容保持白色
-        colored_msg = f'{WHITE}{original_msg}{RESET}'
-        
-        # 组合最终的日志消息
-        record.msg = f'[{colored_time}][{colored_name}][{colored_level}] - {colored_msg}'
-        return record.msg 
\ No newline at end of file
+        color = LEVEL_COLORS.get(record.levelname)
+        colored_level = f'{color}{record.levelname}{RESET}' if color else record.levelname
+
+        # 消息内容保持白色，%参数在这里才真正格式化
+        message = _truncate(record.getMessage(), self.max_length)
+        if record.exc_info:
+            message = f'{message}\n{self.formatException(record.exc_info)}'
+        colored_msg = f'{WHITE}{message}{RESET}'
+
+        # 组合最终的日志消息（不修改record本身）
+        return f'[{colored_time}][{colored_name}][{colored_level}] - {colored_msg}'
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """生产环境使用的单行JSON格式"""
+
+    def __init__(self, max_length=None):
+        super().__init__()
+        self.max_length = max_length
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': _truncate(record.getMessage(), self.max_length),
+        }
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, separators=(',', ':'))
+
+
+class SamplingFilter(logging.Filter):
+    """
+    日志采样
+
+    带有 extra={'sample_key': ...} 的日志，同一个key每sample_every条只保留1条；
+    其他日志不受影响
+    """
+
+    def __init__(self, sample_every=50):
+        super().__init__()
+        self.sample_every = sample_every
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = getattr(record, 'sample_key', None)
+        if key is None or self.sample_every <= 1:
+            return True
+        counter = self._counters.get(key)
+        if counter is None:
+            with self._lock:
+                counter = self._counters.setdefault(key, itertools.count())
+        return next(counter) % self.sample_every == 0
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    不在调用线程中格式化日志的QueueHandler
+
+    标准QueueHandler会在入队前格式化消息；这里直接把record交给后台线程，
+    格式化、序列化和写控制台都不占用请求线程
+    """
+
+    def prepare(self, record):
+        return record
+
+
+_listener = None
+
+
+def setup_logging(level=None, log_format=None, max_length=None, sample_every=None):
+    """
+    配置全局日志
+
+    所有日志先进入内存队列，由后台线程格式化并输出到控制台
+
+    Args:
+        level (str): 日志级别，默认读取LOG_LEVEL，默认为INFO
+        log_format (str): color（彩色控制台）或json（单行JSON），默认读取LOG_FORMAT
+        max_length (int): 单条消息最大长度，超过截断，默认读取LOG_MAX_LENGTH
+        sample_every (int): 带sample_key的日志每多少条保留1条，默认读取LOG_SAMPLE_EVERY
+    """
+    global _listener
+    level = level or os.getenv('LOG_LEVEL', 'INFO')
+    log_format = log_format or os.getenv('LOG_FORMAT', 'color')
+    max_length = max_length if max_length is not None else int(os.getenv('LOG_MAX_LENGTH', '500'))
+    sample_every = sample_every if sample_every is not None else int(os.getenv('LOG_SAMPLE_EVERY', '50'))
+
+    if log_format == 'json':
+        formatter = JsonLinesFormatter(max_length=max_length)
+        console = logging.StreamHandler(sys.stdout)
+    else:
+        formatter = CustomColoredFormatter('%(message)s', datefmt='%Y-%m-%d %H:%M:%S', max_length=max_length)
+        console = colorlog.StreamHandler()
+    console.setFormatter(formatter)
+
+    queue_handler = _DeferredQueueHandler(queue.SimpleQueue())
+    queue_handler.addFilter(SamplingFilter(sample_every))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level)
+
+    if _listener is not None:
+        _listener.stop()
+    _listener = logging.handlers.QueueListener(queue_handler.queue, console, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """输出队列中剩余的日志并停止后台线程"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,179 @@
+import os
+import time
+import logging
+import threading
+from collections import deque
+from llm_client import llm_client
+from admission import AdmissionRejected
+from session_store import session_store
+from context_builder import make_summary_entry, is_summary, entry_tokens
+from metrics import HISTORY_SUMMARIES
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = (
+    "你负责整理QQ聊天机器人的对话记忆。请把下面的已有摘要和较早的对话合并成一段新的摘要，"
+    "保留参与者、讨论过的话题、对方提到的个人信息和偏好、机器人说过或答应过的重要内容，"
+    "省略寒暄和重复的内容。只输出摘要本身，不超过{max_chars}字。"
+)
+# 发送给大模型时摘要前面加上的说明
+SUMMARY_PREFIX = "以下是之前对话的摘要，供继续对话时参考：\n"
+
+ROLE_NAMES = {"user": "用户", "assistant": "机器人"}
+
+
+class HistorySummarizer:
+    """
+    后台滚动摘要
+
+    - 会话的历史记录达到trigger条时，把除最近keep条以外的旧对话连同已有摘要总结成一条新摘要，
+      替换掉这些旧对话；之后每次请求只发送摘要和最近的对话，prompt大小保持平稳
+    - 总结在后台线程中进行，不阻塞回复；以最低优先级申请大模型，繁忙或失败时等待retry_interval秒后再试
+    - 总结期间会话的新消息不受影响；会话被清空或旧对话已经变化时丢弃本次结果
+    """
+
+    def __init__(self, summarize_func, store, trigger=30, keep=10, max_chars=300, retry_interval=60.0):
+        self.summarize_func = summarize_func
+        self.store = store
+        self.trigger = trigger
+        self.keep = keep
+        self.max_chars = max_chars
+        self.retry_interval = retry_interval
+
+        self._lock = threading.Lock()
+        self._queue = deque()
+        self._queued = set()
+        # 总结失败的会话在这个时间之前不再重试
+        self._retry_at = {}
+        self._wakeup = threading.Event()
+        self._worker = None
+
+        self.compacted = 0
+        self.messages_compacted = 0
+        self.failures = 0
+        self.skipped = 0
+        self.stale = 0
+
+    @property
+    def enabled(self):
+        return self.summarize_func is not None and self.trigger > 0
+
+    def notify(self, session_id, length):
+        """历史记录增长后调用，长度达到阈值时安排后台总结"""
+        if not self.enabled or length < self.trigger:
+            return
+        with self._lock:
+            if session_id in self._queued or self._retry_at.get(session_id, 0) > time.monotonic():
+                return
+            self._queued.add(session_id)
+            self._queue.append(session_id)
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="history-summarizer", daemon=True)
+                self._worker.start()
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            while True:
+                with self._lock:
+                    if not self._queue:
+                        self._wakeup.clear()
+                        break
+                    session_id = self._queue.popleft()
+                try:
+                    self.compact(session_id)
+                except Exception as e:
+                    logger.error(f"压缩会话 {session_id} 的历史记录时出错: {e}")
+                finally:
+                    with self._lock:
+                        self._queued.discard(session_id)
+
+    def _build_messages(self, consumed):
+        previous = None
+        lines = []
+        for entry in consumed:
+            if is_summary(entry):
+                previous = entry["content"].removeprefix(SUMMARY_PREFIX)
+            else:
+                lines.append(f"{ROLE_NAMES.get(entry['role'], entry['role'])}: {entry['content']}")
+        content = "较早的对话：\n" + "\n".join(lines)
+        if previous:
+            content = f"已有摘要：\n{previous}\n\n{content}"
+        return [
+            {"role": "system", "content": SUMMARY_PROMPT.format(max_chars=self.max_chars)},
+            {"role": "user", "content": content},
+        ]
+
+    def _retry_later(self, session_id):
+        now = time.monotonic()
+        with self._lock:
+            if len(self._retry_at) > 10000:
+                self._retry_at = {key: at for key, at in self._retry_at.items() if at > now}
+            self._retry_at[session_id] = now + self.retry_interval
+
+    def compact(self, session_id):
+        """
+        立即总结一个会话的旧对话
+
+        Returns:
+            bool: 是否压缩成功
+        """
+        history = self.store.get_history(session_id)
+        if len(history) < self.trigger or len(history) <= self.keep + 1:
+            return False
+        consumed = history[:len(history) - self.keep]
+        try:
+            summary = self.summarize_func(self._build_messages(consumed))
+        except AdmissionRejected:
+            self.skipped += 1
+            HISTORY_SUMMARIES.inc(result="skipped")
+            self._retry_later(session_id)
+            return False
+        except Exception as e:
+            self.failures += 1
+            HISTORY_SUMMARIES.inc(result="failed")
+            logger.warning(f"总结会话 {session_id} 的历史记录失败: {e}")
+            self._retry_later(session_id)
+            return False
+
+        entry = make_summary_entry(SUMMARY_PREFIX + summary.strip())
+        if not self.store.compact(session_id, consumed, entry):
+            self.stale += 1
+            HISTORY_SUMMARIES.inc(result="stale")
+            return False
+        with self._lock:
+            self._retry_at.pop(session_id, None)
+        count = sum(1 for item in consumed if not is_summary(item))
+        self.compacted += 1
+        self.messages_compacted += count
+        HISTORY_SUMMARIES.inc(result="ok")
+        logger.info(f"会话 {session_id} 的 {count} 条旧对话已压缩为摘要（约 {entry_tokens(entry)} tokens）")
+        return True
+
+    def get_stats(self):
+        with self._lock:
+            queued = len(self._queue)
+        return {
+            "enabled": self.enabled,
+            "trigger_messages": self.trigger,
+            "keep_messages": self.keep,
+            "queued": queued,
+            "compacted": self.compacted,
+            "messages_compacted": self.messages_compacted,
+            "failures": self.failures,
+            "skipped": self.skipped,
+            "stale": self.stale,
+        }
+
+
+# 创建全局实例，SUMMARY_TRIGGER_MESSAGES设为0时关闭
+history_summarizer = HistorySummarizer(
+    llm_client.summarize if llm_client else None,
+    session_store,
+    trigger=int(os.getenv("SUMMARY_TRIGGER_MESSAGES", "30")),
+    keep=int(os.getenv("SUMMARY_KEEP_MESSAGES", "10")),
+    max_chars=int(os.getenv("SUMMARY_MAX_CHARS", "300"))
+)
+if llm_client is not None and history_summarizer.enabled:
+    llm_client.summarizer = history_summarizer
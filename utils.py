@@ -1,22 +1,14 @@
 import re
 import logging
-import requests
-from collections import Counter
-import random    
-from regular_dialog import ban, ban_fail
-from llm_client import llm_client
-from typing import Callable
+from persistence import state_db, PersistentDict
+from prompts import prompt_registry
 logger = logging.getLogger(__name__)
 
-# 存储每个会话的风格设置，默认为嘴臭风格
-session_styles = {}
-probabilitys = {}
-ban_list = set()
-with open("ban.txt", "r") as f:
-    ban_list = f.readlines()
-    ban_list = set([line.strip() for line in ban_list])
-
-user_ban_times = Counter()
+# 存储每个会话的风格设置，默认为嘴臭风格（持久化到状态数据库）
+session_styles = PersistentDict(state_db, "style")
+probabilitys = PersistentDict(state_db, "probability")
+# 每个用户的违规分数 [分数, 更新时间]，由moderation.OffenseTable读写
+user_ban_times = PersistentDict(state_db, "ban_count")
 
 def get_session_style(session_id):
     """获取指定会话的风格，默认为嘴臭风格"""
@@ -73,8 +65,7 @@ def handle_system_command(command, params, session_id):
             return "请指定要切换的风格，例如：[切换风格 小红书]"
         
         # 检查风格是否存在
-        from prompts import prompt_mp
-        available_styles = list(prompt_mp.keys())
+        available_styles = get_available_styles()
         
         if params not in available_styles:
             return f"风格 '{params}' 不存在。可用风格：{', '.join(available_styles)}"
@@ -99,68 +90,8 @@ def handle_system_command(command, params, session_id):
 
 def get_available_styles():
     """获取所有可用的风格"""
-    from prompts import prompt_mp
-    return list(prompt_mp.keys())
+    return prompt_registry.styles()
 
 def get_all_session_styles():
     """获取所有会话的风格设置"""
-    return session_styles.copy() 
-
-def ban_user(url,group_id, user_id, duration = 30):
-    user_ban_times[user_id] += 1
-    duration = duration * user_ban_times[user_id]
-    time = random.randint(1, duration)
-    data = {
-        "group_id": group_id,
-        "user_id": user_id,
-        "duration": time
-    }
-    response = requests.post(url+"/set_group_ban", json=data).json()
-    return response["status"]
-
-def handle_banned_user(napcat_url, group_id, user_id, send_message_func: Callable):
-    """
-    处理用户发送违禁词的逻辑
-    
-    Args:
-        napcat_url (str): napcat服务的URL
-        group_id (int): 群组ID
-        user_id (int): 用户ID
-        llm_client: 大模型客户端
-        send_message_func: 发送消息的函数
-    """
-
-    
-    # 尝试禁言用户
-    status = ban_user(napcat_url, group_id, user_id)
-    
-    if status == "ok":
-        logger.info(f"用户 {user_id} 已被禁言")
-        # 使用大模型生成回复
-        try:
-            if llm_client:
-                ai_reply = llm_client.get_chat_response(ban)
-            else:
-                ai_reply = "抱歉，AI服务暂时不可用。"
-            send_message_func(group_id=group_id, message=ai_reply)
-        except Exception as e:
-            logger.error(f"大模型调用失败: {e}")
-            # 降级到默认回复
-            send_message_func(group_id=group_id, message="你已被禁言，请不要发送违禁词。")
-    else:
-        logger.error(f"禁言失败: {status}")
-        # 使用大模型生成回复
-        try:
-            if llm_client:
-                ai_reply = llm_client.get_chat_response(ban_fail)
-            else:
-                ai_reply = "抱歉，AI服务暂时不可用。"
-            send_message_func(group_id=group_id, message=ai_reply)
-        except Exception as e:
-            logger.error(f"大模型调用失败: {e}")
-            # 降级到默认回复
-            send_message_func(group_id=group_id, message="你已被警告，请不要发送违禁词。")
-
-if __name__ == "__main__":
-    res = ban_user("http://127.0.0.1:3000", 1047399248, 1277087689, duration=1)
-    print(res)
\ No newline at end of file
+    return session_styles.copy()